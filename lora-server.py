@@ -1,9 +1,49 @@
 import paho.mqtt.client as mqtt
+import argparse
 import json
 import base64
 import time
+import os
+import re
+import queue
+import threading
+import zlib
+import hashlib
+import hmac
+import struct
+import mmap
+import gc
+import bisect
+import glob
+import http.server
+import multiprocessing
+import shutil
+import signal
+import sys
+import sqlite3
+from array import array
+from collections import deque, OrderedDict
 from datetime import datetime
 
+# Décodeur JSON rapide si disponible (pip install orjson), module standard sinon
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Chiffrement AES-128 des payloads (pip install cryptography), trames en clair acceptées sans
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+# Lecture vectorisée des séries temporelles si NumPy est disponible
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Configuration
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
@@ -11,51 +51,1637 @@ MQTT_TOPIC = "lorawan/uplink"
 MQTT_AUTH_USER = "lorauser"
 MQTT_AUTH_PASS = "lorapass"
 APP_KEY = "a1b2c3d4e5f6a1b2c3d4e5f6a1b2c3d4"  # Doit correspondre à celui du nœud
+DEVICE_KEYS = {}  # Clés propres à certains nœuds (dev_id -> clé hexadécimale), APP_KEY sinon
+MIC_SIZE = 4      # Taille du MIC ajouté en fin de payload (octets)
+CIPHER_CACHE_SIZE = 4096  # Contextes AES conservés par worker (un par nœud, LRU)
+# Bloc compteur LoRaWAN (A_i): 0x01, 4 octets nuls, direction, DevAddr, FCnt, 0x00, i
+# Le bloc B0 du MIC a la même forme: 0x49, ..., FCnt, 0x00, longueur des données
+CTR_BLOCK = struct.Struct("<B4xBIIxB")
+
+# Persistance de l'état de l'IDS (compteurs, RSSI, passerelles)
+STATE_DIR = "ids_state"          # Répertoire des journaux et instantanés (None pour désactiver)
+STATE_FLUSH_INTERVAL = 1.0       # Période (s) d'écriture et de fsync des modifications
+STATE_SNAPSHOT_INTERVAL = 300.0  # Période (s) de compaction du journal en instantané
+
+# Séries temporelles des lectures capteurs
+TSDB_DIR = "ids_timeseries"       # Colonnes des lectures et agrégats (None: mémoire seulement)
+TSDB_RING_SIZE = 64               # Dernières lectures conservées en mémoire par (nœud, capteur)
+TSDB_FLUSH_INTERVAL = 2.0         # Période (s) d'écriture des colonnes par lots
+TSDB_ROLLUPS = (("1m", 60.0), ("1h", 3600.0))  # Agrégats min/moyenne/max par intervalle
+TSDB_SEGMENT = 3600.0             # Durée (s) couverte par un segment de lectures brutes
+TSDB_SEGMENT_BUCKETS = 60         # Intervalles d'agrégat par segment (1m: une heure, 1h: 60 heures)
+TSDB_RETENTION = {"raw": 7 * 86400.0, "1m": 90 * 86400.0}  # Durée (s) conservée par table (absente: illimitée)
+
+# Format binaire des trames capteurs (voir lora-simulation.py)
+PAYLOAD_VERSION = 1
+PAYLOAD_HEADER = struct.Struct("<BIB")  # version, horodatage epoch, nombre de lectures
+READING_HEADER = struct.Struct("<BB")   # type de capteur, numéro du capteur
+
+# Pipeline d'ingestion
+INGEST_WORKERS = os.cpu_count() or 1  # Nombre de workers (un shard par worker)
+INGEST_QUEUE_SIZE = 10000             # Capacité totale de la file d'ingestion
+INGEST_BACKPRESSURE = "block"         # "block", "drop_oldest" ou "drop_new"
+INGEST_TICK = 0.05                    # Période (s) des traitements différés des workers
+
+# Mode cluster: processus workers propriétaires d'une partition des dev_id
+CLUSTER_WORKERS = 0          # Nombre de processus workers (0: un seul processus, mode historique)
+CLUSTER_VNODES = 128         # Points de chaque worker sur l'anneau de hachage cohérent
+CLUSTER_BATCH_SIZE = 256     # Trames envoyées ensemble à un worker
+CLUSTER_FLUSH_INTERVAL = 0.02  # Période (s) d'envoi des lots incomplets et de surveillance des workers
+
+# Déduplication multi-passerelles
+DEDUP_WINDOW = 0.2       # Attente (s) des copies d'une même trame avant analyse
+DEDUP_RETENTION = 5.0    # Durée (s) pendant laquelle une copie tardive est reconnue (transmise à l'IDS sans fusion)
+DEDUP_MAX_ENTRIES = 100000  # Nombre maximal de trames suivies par shard
+
+# Contrôle d'admission (avant la déduplication et l'IDS)
+PROVISIONED_DEVICES = None    # dev_id provisionnés, avec ceux de DEVICE_KEYS (None: tout nœud est admis)
+DEVICE_RATE = 1.0             # Trames/s admises par nœud en régime établi (None: pas de limite)
+DEVICE_BURST = 10             # Rafale admise par nœud (copies multi-passerelles comprises)
+GATEWAY_RATE = 2000.0         # Trames/s non authentiques ou rejouées admises par passerelle (None: pas de limite)
+GATEWAY_BURST = 4000
+ADMISSION_MAX_BUCKETS = 100000  # Seaux suivis par shard, au-delà un seau de débordement commun
+
+# Journal d'événements (alertes, messages traités)
+EVENT_OUTPUTS = ("console", "jsonl")  # Sorties parmi "console", "jsonl" et "sqlite"
+EVENT_PATH = "ids_events"             # Chemin des journaux, sans extension
+EVENT_LEVEL = "INFO"                  # Niveau minimal: DEBUG, INFO, WARNING, ERROR ou CRITICAL
+EVENT_BUFFER_SIZE = 10000             # Nombre d'événements en attente d'écriture
+EVENT_FLUSH_INTERVAL = 0.5            # Période (s) d'écriture des événements
+ALERT_NOTIFY_INTERVAL = 60.0          # Délai minimal (s) entre deux notifications d'alertes critiques
+
+# Métriques (format Prometheus)
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"            # Point d'accès local uniquement
+METRICS_PORT = 9108                   # GET /metrics (None pour désactiver)
+METRICS_DUMP_PATH = "ids_metrics.prom"  # Copie périodique des métriques (None pour désactiver)
+METRICS_DUMP_INTERVAL = 60.0
+METRICS_LATENCY_SAMPLING = 64         # Une trame sur N est chronométrée (les compteurs restent exacts)
+METRICS_MAX_LABEL_VALUES = 100        # Valeurs distinctes d'une étiquette issue des trames (au-delà: "other")
+LATENCY_BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 5e-2, 0.1, 1.0)
+
+# Nombre de valeurs RSSI conservées par nœud (valeur courante incluse)
+RSSI_HISTORY_SIZE = 10
+
+# Table des nœuds bornée (les nœuds provisionnés ne sont jamais évincés)
+NODE_TABLE_CAPACITY = 200000       # Nœuds établis conservés, les moins récemment vus évincés au-delà
+NODE_QUARANTINE_CAPACITY = 100000  # Nœuds vus pour la première fois, pas encore confirmés
+NODE_PROMOTION_FRAMES = 2          # Trames sans anomalie pour sortir de quarantaine
+NODE_QUARANTINE_TTL = 3600.0       # Inactivité (s) avant éviction d'un nœud en quarantaine
+NODE_IDLE_TTL = 30 * 86400.0       # Inactivité (s) avant éviction d'un nœud établi (None: jamais)
+NODE_EXPIRE_INTERVAL = 10.0        # Période (s) minimale entre deux recherches de nœuds inactifs
+NODE_TOMBSTONE_CAPACITY = 200000   # Nœuds évincés dont le plus haut compteur reste connu (les plus anciens oubliés)
+
+# Registre des passerelles
+DEFAULT_GATEWAYS = {"farm_gateway_001": "Ferme principale"}  # Passerelles autorisées sans fichier
+GATEWAYS_PATH = "gateways.json"      # Passerelles autorisées (id -> {"location": ...}), relu à chaud
+GATEWAY_RELOAD_INTERVAL = 5.0        # Période (s) de vérification du fichier des passerelles
+GATEWAY_STALE_AFTER = 600.0          # Silence (s) au-delà duquel une passerelle n'est plus active
+GATEWAY_NEW_DEVICE_WINDOW = 300.0    # Fenêtre (s) de comptage des nœuds inconnus relayés
+GATEWAY_NEW_DEVICE_THRESHOLD = 50    # Nœuds inconnus par fenêtre à partir desquels on alerte...
+GATEWAY_NEW_DEVICE_FACTOR = 5.0      # ... s'ils dépassent aussi ce multiple de la moyenne des fenêtres passées
+
+# Protection anti-rejeu
+REPLAY_WINDOW_SIZE = 256     # Taille de la fenêtre glissante de compteurs (64 à 1024, multiple de 8)
+MAX_FCNT_GAP = 16384         # Saut de compteur maximal de la spécification LoRaWAN (trames perdues)
+COUNTER_JUMP_TOLERANCE = MAX_FCNT_GAP  # Au-delà: alerte, puis resynchronisation sur le nouveau compteur
+DUPLICATE_WINDOW = 2.0       # Délai (s) pendant lequel une trame identique est un doublon multi-passerelle
+RSSI_THRESHOLD = 20          # Écart (dBm) à la moyenne RSSI au-delà duquel on suspecte une usurpation
+
+# Détecteurs d'anomalies en flux (voir DETECTOR_TYPES)
+DETECTORS = ("rssi",)        # Détecteurs actifs parmi: rssi, rssi_gateways, snr, interval, payload_size
+DETECTOR_MIN_SAMPLES = 8     # Observations d'un nœud avant qu'un détecteur statistique puisse alerter
+DETECTOR_ZSCORE = 4.0        # Écart à la moyenne (en écarts-types) au-delà duquel une valeur est anormale
+DETECTOR_EWMA_ALPHA = 0.1    # Poids de la dernière observation dans les moyennes glissantes
+RSSI_MIN_DEVIATION = 3.0     # Écart-type plancher (dBm) des détecteurs RSSI et SNR...
+SNR_MIN_DEVIATION = 1.5      # ... (dB): évite d'alerter sur un nœud au signal parfaitement stable
+INTERVAL_MIN_RATIO = 0.2     # Trame trop rapprochée: intervalle sous cette fraction de l'intervalle habituel
+PAYLOAD_MIN_DEVIATION = 2.0  # Écart-type plancher (octets) de la taille des payloads
+
+# Fenêtre anti-rejeu de type IPsec (RFC 6479): un bitmap circulaire de taille fixe
+# indexé par compteur % taille. Les trames en désordre dans la fenêtre sont
+# acceptées une seule fois, celles trop anciennes ou déjà vues sont rejetées.
+class ReplayWindow:
+    __slots__ = ('top', 'bits')
+
+    def __init__(self, size=REPLAY_WINDOW_SIZE):
+        if size % 8 or not 64 <= size <= 1024:
+            raise ValueError(f"Taille de fenêtre anti-rejeu invalide: {size}")
+        self.top = None  # Plus haut compteur accepté
+        self.bits = bytearray(size // 8)
+
+    def check(self, counter, tolerance=COUNTER_JUMP_TOLERANCE):
+        """Retourne le type d'anomalie du compteur, ou None s'il est acceptable"""
+        top = self.top
+        if top is None:
+            return None
+        if counter > top:
+            return 'COUNTER_JUMP' if counter - top > tolerance else None
+        size = len(self.bits) << 3
+        if top - counter >= size:
+            return 'REPLAY_ATTACK'
+        index = counter % size
+        if self.bits[index >> 3] & (1 << (index & 7)):
+            return 'REPLAY_ATTACK'
+        return None
+
+    def accept(self, counter):
+        """Marque un compteur comme reçu en faisant glisser la fenêtre si besoin"""
+        bits = self.bits
+        size = len(bits) << 3
+        top = self.top
+        if top is None or counter - top >= size:
+            bits[:] = bytes(len(bits))
+            self.top = counter
+        elif counter > top:
+            # Libérer les positions des compteurs sautés
+            for skipped in range(top + 1, counter):
+                index = skipped % size
+                bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+            self.top = counter
+        index = counter % size
+        bits[index >> 3] |= 1 << (index & 7)
+
+    def restore(self, top):
+        """Reprend la fenêtre d'un nœud dont seul le plus haut compteur est connu: tout compteur <= top est refusé"""
+        self.top = top
+        self.bits[:] = b"\xff" * len(self.bits)
+
+# État compact d'un nœud: attributs à slots, horodatages en secondes epoch
+# et tampon circulaire RSSI avec somme glissante (moyenne en O(1))
+class NodeState:
+    __slots__ = ('first_seen', 'last_seen', 'replay_window', 'top_time', 'top_digest', 'top_gateways',
+                 'alerts', 'alert_counts', 'critical_since',
+                 'rssi_ring', 'rssi_pos', 'rssi_count', 'rssi_sum', 'detector_states')
+
+    def __init__(self, now):
+        self.first_seen = now
+        self.last_seen = now
+        self.replay_window = ReplayWindow()
+        # Réception, empreinte et passerelles de la trame au plus haut compteur (détection des doublons)
+        self.top_time = 0.0
+        self.top_digest = 0
+        self.top_gateways = ()
+        # Alertes récentes (epoch, type) par ordre chronologique et compteurs par type,
+        # alloués à la première alerte pour ne rien coûter aux nœuds sains
+        self.alerts = None
+        self.alert_counts = None
+        self.critical_since = None  # Début de l'alerte critique en cours
+        # Le tampon ne contient que les valeurs précédentes: la valeur courante
+        # est comparée à leur moyenne avant d'y être ajoutée
+        self.rssi_ring = array('d', bytes(8 * (RSSI_HISTORY_SIZE - 1)))
+        self.rssi_pos = 0
+        self.rssi_count = 0
+        self.rssi_sum = 0.0
+        self.detector_states = None  # États des détecteurs statistiques, alloués à la première trame
+
+    def rssi_average(self):
+        """Moyenne des valeurs RSSI précédentes (None si aucune)"""
+        if not self.rssi_count:
+            return None
+        return self.rssi_sum / self.rssi_count
+
+    def push_rssi(self, rssi):
+        """Ajoute une valeur RSSI en évinçant la plus ancienne si le tampon est plein"""
+        ring = self.rssi_ring
+        pos = self.rssi_pos
+        if self.rssi_count == len(ring):
+            self.rssi_sum -= ring[pos]
+        else:
+            self.rssi_count += 1
+        ring[pos] = rssi
+        self.rssi_sum += rssi
+        self.rssi_pos = (pos + 1) % len(ring)
+
+    def add_alert(self, now, alert_type):
+        if self.alerts is None:
+            self.alerts = deque()
+            self.alert_counts = {}
+        self.alerts.append((now, alert_type))
+        self.alert_counts[alert_type] = self.alert_counts.get(alert_type, 0) + 1
+
+    def expire_alerts(self, cutoff):
+        """Retire les alertes antérieures ou égales à cutoff (coût amorti O(1))"""
+        alerts = self.alerts
+        counts = self.alert_counts
+        while alerts and alerts[0][0] <= cutoff:
+            _, alert_type = alerts.popleft()
+            remaining = counts[alert_type] - 1
+            if remaining:
+                counts[alert_type] = remaining
+            else:
+                del counts[alert_type]
+
+    def rssi_history(self):
+        """Valeurs RSSI précédentes, de la plus ancienne à la plus récente"""
+        ring = self.rssi_ring
+        if self.rssi_count < len(ring):
+            return list(ring[:self.rssi_count])
+        return list(ring[self.rssi_pos:]) + list(ring[:self.rssi_pos])
+
+# Table des nœuds connus en trois régions: les nœuds provisionnés (épinglés), les
+# nœuds établis (LRU bornée, éviction après NODE_IDLE_TTL d'inactivité) et une
+# quarantaine bornée pour les nœuds vus pour la première fois, qui n'en sortent
+# qu'après NODE_PROMOTION_FRAMES trames sans anomalie. Une inondation d'identifiants
+# inconnus ne fait que renouveler la quarantaine. Un nœud évincé laisse une pierre
+# tombale (plus haut compteur accepté, trames sans anomalie s'il était en quarantaine):
+# à son retour, il reprend sa fenêtre anti-rejeu et sa progression au lieu de repartir
+# de zéro, si bien qu'une trame capturée avant l'éviction reste un rejeu. Les lectures
+# ne prennent pas de verrou; les statistiques sont approximatives entre threads.
+class NodeTable:
+    def __init__(self, capacity=NODE_TABLE_CAPACITY, quarantine_capacity=NODE_QUARANTINE_CAPACITY,
+                 promotion_frames=NODE_PROMOTION_FRAMES, quarantine_ttl=NODE_QUARANTINE_TTL,
+                 idle_ttl=NODE_IDLE_TTL, expire_interval=NODE_EXPIRE_INTERVAL,
+                 tombstone_capacity=NODE_TOMBSTONE_CAPACITY):
+        self.capacity = capacity
+        self.quarantine_capacity = quarantine_capacity
+        self.promotion_frames = promotion_frames
+        self.quarantine_ttl = quarantine_ttl
+        self.idle_ttl = idle_ttl
+        self.expire_interval = expire_interval
+        self.tombstone_capacity = tombstone_capacity
+        self.provisioned = None            # Ensemble des dev_id provisionnés (partagé avec l'IDS)
+        self.pinned = {}
+        self.established = OrderedDict()   # Du moins récemment vu au plus récent
+        self.quarantine = OrderedDict()
+        self.probation = {}                # dev_id en quarantaine -> trames sans anomalie
+        # dev_id évincé -> (plus haut compteur, trames sans anomalie en quarantaine ou None s'il était
+        # établi), du plus ancien au plus récent
+        self.tombstones = OrderedDict()
+        self.on_bury = None                # Appelé avec le dev_id de chaque nœud évincé (persistance)
+        self.stats = {'hits': 0, 'misses': 0, 'promoted': 0, 'evicted_lru': 0, 'evicted_idle': 0,
+                      'quarantine_evicted': 0, 'quarantine_expired': 0, 'returned': 0, 'tombstones_dropped': 0}
+        self._lock = threading.Lock()
+        self._expired_at = None
+
+    def __len__(self):
+        return len(self.pinned) + len(self.established) + len(self.quarantine)
+
+    def __contains__(self, dev_id):
+        return dev_id in self.established or dev_id in self.pinned or dev_id in self.quarantine
+
+    def get(self, dev_id, default=None):
+        """État d'un nœud, sans effet sur l'ordre d'éviction"""
+        node = self.established.get(dev_id)
+        if node is None:
+            node = self.pinned.get(dev_id)
+            if node is None:
+                node = self.quarantine.get(dev_id, default)
+        return node
+
+    def __getitem__(self, dev_id):
+        node = self.get(dev_id)
+        if node is None:
+            raise KeyError(dev_id)
+        return node
+
+    def __setitem__(self, dev_id, node):
+        """Place un nœud restauré (hors quarantaine)"""
+        with self._lock:
+            self.quarantine.pop(dev_id, None)
+            self.probation.pop(dev_id, None)
+            self.tombstones.pop(dev_id, None)
+            if self.provisioned is not None and dev_id in self.provisioned:
+                self.pinned[dev_id] = node
+            else:
+                self._establish(dev_id, node)
+
+    def pop(self, dev_id, default=None):
+        """Retire un nœud de toutes les régions, pierre tombale comprise (passage à un autre worker)"""
+        with self._lock:
+            self.probation.pop(dev_id, None)
+            self.tombstones.pop(dev_id, None)
+            node = self.established.pop(dev_id, None)
+            if node is None:
+                node = self.pinned.pop(dev_id, None)
+                if node is None:
+                    node = self.quarantine.pop(dev_id, default)
+            return node
+
+    def items(self):
+        """Copie des couples (dev_id, état) de toutes les régions"""
+        return list(self.pinned.items()) + list(self.established.items()) + list(self.quarantine.items())
+
+    def lookup(self, dev_id):
+        """État d'un nœud pour l'analyse d'une trame: compte les succès et le marque récemment vu"""
+        established = self.established
+        node = established.get(dev_id)
+        if node is not None:
+            try:
+                established.move_to_end(dev_id)
+            except KeyError:  # Évincé entre-temps par un autre worker
+                pass
+        else:
+            node = self.pinned.get(dev_id)
+            if node is None:
+                node = self.quarantine.get(dev_id)
+                if node is None:
+                    self.stats['misses'] += 1
+                    return None
+                try:
+                    self.quarantine.move_to_end(dev_id)
+                except KeyError:
+                    pass
+        self.stats['hits'] += 1
+        return node
+
+    def add(self, dev_id, node, now):
+        """Ajoute un nœud absent de la table: épinglé s'il est provisionné, en quarantaine sinon
+
+        Un nœud évincé reprend son plus haut compteur et sa région (établi, ou quarantaine
+        avec ses trames sans anomalie). Retourne False dans ce cas, True pour un nouveau nœud.
+        """
+        with self._lock:
+            if self._expired_at is None or now - self._expired_at >= self.expire_interval:
+                self._expire(now)
+            tombstone = self.tombstones.pop(dev_id, None)
+            probation = 0
+            if tombstone is not None:
+                top, probation = tombstone
+                node.replay_window.restore(top)
+                self.stats['returned'] += 1
+            if self.provisioned is not None and dev_id in self.provisioned:
+                self.pinned[dev_id] = node
+            elif probation is None:
+                self._establish(dev_id, node)
+            else:
+                quarantine = self.quarantine
+                while len(quarantine) >= self.quarantine_capacity:
+                    evicted, evicted_node = quarantine.popitem(last=False)
+                    self._bury(evicted, evicted_node.replay_window.top, self.probation.pop(evicted, 0))
+                    self.stats['quarantine_evicted'] += 1
+                quarantine[dev_id] = node
+                self.probation[dev_id] = probation
+            return tombstone is None
+
+    def bury(self, dev_id, top, probation=None):
+        """Remplace un nœud par sa pierre tombale (état restauré ou reçu d'un autre worker)"""
+        with self._lock:
+            self.probation.pop(dev_id, None)
+            for region in (self.established, self.pinned, self.quarantine):
+                region.pop(dev_id, None)
+            self._bury(dev_id, top, probation, notify=False)
+
+    def _bury(self, dev_id, top, probation, notify=True):
+        if top is None:
+            return
+        tombstones = self.tombstones
+        tombstones.pop(dev_id, None)
+        tombstones[dev_id] = (top, probation)
+        if len(tombstones) > self.tombstone_capacity:
+            tombstones.popitem(last=False)
+            self.stats['tombstones_dropped'] += 1
+        if notify and self.on_bury is not None:
+            self.on_bury(dev_id)
+
+    def confirm(self, dev_id):
+        """Compte une trame sans anomalie: le nœud sort de quarantaine au bout de promotion_frames"""
+        if dev_id not in self.probation:
+            return
+        with self._lock:
+            count = self.probation.get(dev_id)
+            if count is None:
+                return
+            if count + 1 < self.promotion_frames:
+                self.probation[dev_id] = count + 1
+                return
+            del self.probation[dev_id]
+            self._establish(dev_id, self.quarantine.pop(dev_id))
+            self.stats['promoted'] += 1
+
+    def provision(self, provisioned):
+        """Définit l'ensemble des nœuds provisionnés et épingle ceux déjà connus"""
+        with self._lock:
+            self.provisioned = provisioned
+            for region in (self.established, self.quarantine):
+                for dev_id in [dev_id for dev_id in list(region) if dev_id in provisioned]:
+                    self.pinned[dev_id] = region.pop(dev_id)
+                    self.probation.pop(dev_id, None)
+
+    def _establish(self, dev_id, node):
+        established = self.established
+        established[dev_id] = node
+        while len(established) > self.capacity:
+            evicted, evicted_node = established.popitem(last=False)
+            self._bury(evicted, evicted_node.replay_window.top, None)
+            self.stats['evicted_lru'] += 1
+
+    @staticmethod
+    def _expire_region(region, cutoff):
+        """Retire les nœuds inactifs en tête de région (ordre de dernière activité)"""
+        expired = []
+        # Lecture de la tête plutôt qu'itération: les workers réordonnent la région sans verrou
+        while region:
+            try:
+                dev_id = next(iter(region))
+                node = region[dev_id]
+            except (KeyError, RuntimeError, StopIteration):
+                break
+            if node.last_seen > cutoff:
+                break
+            region.pop(dev_id, None)
+            expired.append((dev_id, node))
+        return expired
+
+    def _expire(self, now):
+        self._expired_at = now
+        if self.idle_ttl is not None:
+            expired = self._expire_region(self.established, now - self.idle_ttl)
+            for dev_id, node in expired:
+                self._bury(dev_id, node.replay_window.top, None)
+            self.stats['evicted_idle'] += len(expired)
+        expired = self._expire_region(self.quarantine, now - self.quarantine_ttl)
+        for dev_id, node in expired:
+            self._bury(dev_id, node.replay_window.top, self.probation.pop(dev_id, 0))
+        self.stats['quarantine_expired'] += len(expired)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats.update(pinned=len(self.pinned), established=len(self.established), quarantined=len(self.quarantine),
+                     tombstones=len(self.tombstones))
+        return stats
+
+# État d'une passerelle autorisée: horodatage de la dernière trame (le statut
+# actif/inactif en est déduit à la lecture), trafic et statistiques RSSI, et nombre
+# de nœuds inconnus relayés par fenêtre, comparé à une moyenne glissante.
+class GatewayState:
+    __slots__ = ('location', 'last_seen', 'frames', 'rssi_count', 'rssi_sum', 'rssi_min', 'rssi_max',
+                 'window_start', 'new_devices', 'new_device_average', 'flagged')
+
+    def __init__(self, location):
+        self.location = location
+        self.last_seen = None     # Epoch de la dernière trame relayée
+        self.frames = 0
+        self.rssi_count = 0
+        self.rssi_sum = 0.0
+        self.rssi_min = None
+        self.rssi_max = None
+        self.window_start = None
+        self.new_devices = 0            # Nœuds inconnus relayés dans la fenêtre courante
+        self.new_device_average = None  # Moyenne glissante des fenêtres précédentes (None: apprentissage)
+        self.flagged = False            # Alerte déjà émise pour la fenêtre courante
+
+    def record(self, rssi, now):
+        """Compte une trame relayée"""
+        self.last_seen = now
+        self.frames += 1
+        if rssi is not None:
+            self.rssi_count += 1
+            self.rssi_sum += rssi
+            if self.rssi_min is None or rssi < self.rssi_min:
+                self.rssi_min = rssi
+            if self.rssi_max is None or rssi > self.rssi_max:
+                self.rssi_max = rssi
+
+    def status(self, now, stale_after=GATEWAY_STALE_AFTER):
+        if self.last_seen is not None and now - self.last_seen <= stale_after:
+            return 'active'
+        return 'stale'
+
+    def new_device(self, now, window, threshold, factor):
+        """Compte un nœud inconnu relayé; True si la fenêtre courante dépasse le seuil (une fois par fenêtre)"""
+        if self.window_start is None:
+            self.window_start = now
+        elif now - self.window_start >= window:
+            # Clôture de la fenêtre: les fenêtres écoulées sans nouveau nœud comptent pour zéro
+            elapsed = int((now - self.window_start) // window)
+            average = self.new_device_average
+            average = self.new_devices if average is None else 0.7 * average + 0.3 * self.new_devices
+            self.new_device_average = average * 0.7 ** (elapsed - 1)
+            self.window_start += elapsed * window
+            self.new_devices = 0
+            self.flagged = False
+        self.new_devices += 1
+        average = self.new_device_average
+        if (average is None or self.flagged or self.new_devices < threshold
+                or self.new_devices < factor * average):
+            return False
+        self.flagged = True
+        return True
+
+    def get_stats(self, now):
+        return {
+            'location': self.location,
+            'status': self.status(now),
+            'last_seen': self.last_seen,
+            'frames': self.frames,
+            'rssi_avg': self.rssi_sum / self.rssi_count if self.rssi_count else None,
+            'rssi_min': self.rssi_min,
+            'rssi_max': self.rssi_max,
+            'new_devices': self.new_devices,
+        }
+
+# Registre des passerelles autorisées. La liste peut être relue depuis un fichier
+# JSON sans redémarrage: le dictionnaire est reconstruit puis remplacé d'un bloc
+# (lectures sans verrou), l'état des passerelles conservées est repris tel quel.
+class GatewayRegistry:
+    def __init__(self, gateways=DEFAULT_GATEWAYS, reload_interval=GATEWAY_RELOAD_INTERVAL,
+                 stale_after=GATEWAY_STALE_AFTER, window=GATEWAY_NEW_DEVICE_WINDOW,
+                 threshold=GATEWAY_NEW_DEVICE_THRESHOLD, factor=GATEWAY_NEW_DEVICE_FACTOR):
+        self.gateways = {gateway_id: GatewayState(location) for gateway_id, location in gateways.items()}
+        self.reload_interval = reload_interval
+        self.stale_after = stale_after
+        self.window = window
+        self.threshold = threshold
+        self.factor = factor
+        self.path = None          # Fichier surveillé (voir watch)
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def __contains__(self, gateway_id):
+        return gateway_id in self.gateways
+
+    def __len__(self):
+        return len(self.gateways)
+
+    def get(self, gateway_id):
+        return self.gateways.get(gateway_id)
+
+    def items(self):
+        return list(self.gateways.items())
+
+    def register(self, gateway_id, location):
+        """Ajoute une passerelle autorisée; False si elle l'était déjà"""
+        with self._lock:
+            if gateway_id in self.gateways:
+                return False
+            gateways = dict(self.gateways)
+            gateways[gateway_id] = GatewayState(location)
+            self.gateways = gateways
+            return True
+
+    def load(self, path):
+        """Remplace la liste des passerelles par celle du fichier; retourne (ajoutées, retirées)"""
+        with open(path, encoding="utf-8") as f:
+            declared = json.load(f)
+        if not isinstance(declared, dict):
+            raise ValueError("le fichier doit contenir un objet JSON {passerelle: {\"location\": ...}}")
+        with self._lock:
+            current = self.gateways
+            gateways = {}
+            for gateway_id, info in declared.items():
+                location = info.get('location') if isinstance(info, dict) else info
+                state = current.get(gateway_id)
+                if state is None:
+                    state = GatewayState(location)
+                else:
+                    state.location = location
+                gateways[gateway_id] = state
+            self.gateways = gateways
+        return sorted(set(gateways) - set(current)), sorted(set(current) - set(gateways))
+
+    def watch(self, path):
+        """Charge le fichier s'il existe et le relit ensuite à chaque modification (maybe_reload)"""
+        self.path = path
+        self._next_check = 0.0
+        return self.maybe_reload()
+
+    def maybe_reload(self):
+        """Relit le fichier surveillé s'il a changé (au plus une vérification par reload_interval)"""
+        now = time.monotonic()
+        if self.path is None or now < self._next_check:
+            return None
+        self._next_check = now + self.reload_interval
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+        if mtime == self._mtime:
+            return None
+        self._mtime = mtime
+        try:
+            return self.load(self.path)
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Fichier des passerelles {self.path} ignoré: {str(e)}")
+            return None
+
+    def get_stats(self, now=None):
+        """Statistiques par passerelle, statut calculé à la lecture"""
+        if now is None:
+            now = time.time()
+        return {gateway_id: state.get_stats(now) for gateway_id, state in self.items()}
+
+# Statistiques en flux, en O(1) par observation et en mémoire constante
+class WelfordStats:
+    """Moyenne et variance cumulées (algorithme de Welford)"""
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def std(self):
+        return (self.m2 / (self.count - 1)) ** 0.5 if self.count > 1 else 0.0
+
+class EWMAStats:
+    """Moyenne et variance à oubli exponentiel: suit les dérives lentes d'un nœud"""
+    __slots__ = ('count', 'mean', 'var')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+
+    def update(self, value, alpha=DETECTOR_EWMA_ALPHA):
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return
+        delta = value - self.mean
+        self.mean += alpha * delta
+        self.var = (1 - alpha) * (self.var + alpha * delta * delta)
+
+    def std(self):
+        return self.var ** 0.5
+
+def deviates(stats, value, min_std, zscore=DETECTOR_ZSCORE, min_samples=DETECTOR_MIN_SAMPLES):
+    """True si value s'écarte de plus de zscore écarts-types (au moins min_std) de la moyenne"""
+    if stats.count < min_samples:
+        return False
+    std = stats.std()
+    return abs(value - stats.mean) > zscore * (std if std > min_std else min_std)
+
+# Détecteurs d'anomalies enfichables. Chaque détecteur est instancié par l'IDS
+# (dont il lit la configuration) et reçoit à chaque trame valide le nœud, son état
+# propre (créé par new_state, None s'il n'en a pas) et la trame. check retourne
+# les détails de l'anomalie ou None; anomaly_type sert de type d'alerte.
+class Detector:
+    name = None
+    anomaly_type = None
+    stateful = True
+
+    def __init__(self, ids):
+        self.ids = ids
+
+    def new_state(self):
+        return None
+
+    def check(self, node, state, frame, now):
+        raise NotImplementedError
+
+class RSSIDetector(Detector):
+    """Variation soudaine du RSSI de la meilleure passerelle, seuil fixe (possible usurpation)"""
+    name = 'rssi'
+    anomaly_type = 'RSSI_ANOMALY'
+    stateful = False  # Historique dans NodeState (tampon circulaire persisté)
+
+    def check(self, node, state, frame, now):
+        current_rssi = frame.gateways[0].get('rssi')
+        if current_rssi is None:
+            return None
+        details = None
+        # Comparer à la moyenne des RSSI précédents (au moins 4 valeurs)
+        if node.rssi_count >= 4:
+            avg_rssi = node.rssi_average()
+            if abs(current_rssi - avg_rssi) > self.ids.rssi_threshold:
+                details = f'Variation RSSI suspecte: actuel={current_rssi}, moyenne={avg_rssi:.2f}'
+        node.push_rssi(current_rssi)
+        return details
+
+class GatewayRSSIDetector(Detector):
+    """RSSI de chaque passerelle comparé à son propre historique pour ce nœud"""
+    name = 'rssi_gateways'
+    anomaly_type = 'RSSI_ANOMALY'
+
+    def new_state(self):
+        return {}  # passerelle -> EWMAStats
+
+    def check(self, node, state, frame, now):
+        details = None
+        for gateway in frame.gateways:
+            rssi = gateway.get('rssi')
+            if rssi is None:
+                continue
+            gateway_id = gateway.get('gtw_id')
+            stats = state.get(gateway_id)
+            if stats is None:
+                stats = state[gateway_id] = EWMAStats()
+            if details is None and deviates(stats, rssi, RSSI_MIN_DEVIATION):
+                details = f'Variation RSSI suspecte via {gateway_id}: actuel={rssi}, moyenne={stats.mean:.2f}'
+            stats.update(rssi)
+        return details
+
+class SNRDetector(Detector):
+    """Variation du SNR de la meilleure passerelle"""
+    name = 'snr'
+    anomaly_type = 'SNR_ANOMALY'
+
+    def new_state(self):
+        return EWMAStats()
+
+    def check(self, node, state, frame, now):
+        snr = frame.gateways[0].get('snr')
+        if snr is None:
+            return None
+        details = None
+        if deviates(state, snr, SNR_MIN_DEVIATION):
+            details = f'Variation SNR suspecte: actuel={snr}, moyenne={state.mean:.2f}'
+        state.update(snr)
+        return details
+
+class IntervalDetector(Detector):
+    """Trames bien plus rapprochées que la période habituelle du nœud (injection, rejeu rapide)"""
+    name = 'interval'
+    anomaly_type = 'TIMING_ANOMALY'
+
+    def new_state(self):
+        return [None, EWMAStats()]  # Réception de la trame précédente, intervalles
+
+    def check(self, node, state, frame, now):
+        previous, stats = state
+        state[0] = now
+        if previous is None:
+            return None
+        interval = now - previous
+        details = None
+        if stats.count >= DETECTOR_MIN_SAMPLES and interval < INTERVAL_MIN_RATIO * stats.mean:
+            details = f'Intervalle entre trames suspect: {interval:.3f} s, habituel={stats.mean:.3f} s'
+        stats.update(interval)
+        return details
+
+class PayloadSizeDetector(Detector):
+    """Taille de payload inhabituelle pour le nœud"""
+    name = 'payload_size'
+    anomaly_type = 'PAYLOAD_SIZE_ANOMALY'
+
+    def new_state(self):
+        return WelfordStats()
+
+    def check(self, node, state, frame, now):
+        size = len(frame.decoded)
+        details = None
+        if deviates(state, size, PAYLOAD_MIN_DEVIATION):
+            details = f'Taille de payload inhabituelle: {size} octets, moyenne={state.mean:.1f}'
+        state.update(size)
+        return details
+
+DETECTOR_TYPES = {}
+
+def register_detector(detector_type):
+    """Rend un type de détecteur activable par son nom dans DETECTORS"""
+    DETECTOR_TYPES[detector_type.name] = detector_type
+
+for _detector_type in (RSSIDetector, GatewayRSSIDetector, SNRDetector, IntervalDetector, PayloadSizeDetector):
+    register_detector(_detector_type)
+
+def make_detectors(ids, names=DETECTORS):
+    unknown = [name for name in names if name not in DETECTOR_TYPES]
+    if unknown:
+        raise ValueError(f"Détecteur inconnu: {', '.join(unknown)}")
+    return tuple(DETECTOR_TYPES[name](ids) for name in names)
+
+# Vérification du MIC (HMAC-SHA256 tronqué) avec un registre de clés par nœud.
+# Chaque clé est préparée une seule fois: par trame, on ne fait qu'une copie
+# de l'état HMAC déjà initialisé, ce qui évite de hacher la clé à chaque trame
+# comme le fait hmac.digest (python lora-benchmark.py mic).
+class MICVerifier:
+    def __init__(self, default_key=APP_KEY, device_keys=None):
+        self._default = self._prepare(default_key) if default_key else None
+        self._keyed = {}
+        for dev_id, key in (device_keys or {}).items():
+            self.register_device(dev_id, key)
+
+    @staticmethod
+    def _prepare(key):
+        return hmac.new(bytes.fromhex(key), digestmod=hashlib.sha256)
+
+    def register_device(self, dev_id, key):
+        """Associe une clé d'application propre à un nœud"""
+        self._keyed[dev_id] = self._prepare(key)
+
+    def verify(self, dev_id, frame, counter):
+        """Vérifie le MIC des MIC_SIZE derniers octets de la trame
+
+        Comme le bloc B0 de LoRaWAN, le MIC couvre l'adresse du nœud et le compteur:
+        une trame capturée ne peut être rejouée sous un autre compteur ou un autre dev_id.
+        """
+        if len(frame) <= MIC_SIZE:
+            return False
+        base = self._keyed.get(dev_id, self._default)
+        if base is None:
+            return False
+        h = base.copy()
+        h.update(CTR_BLOCK.pack(0x49, 0, dev_addr(dev_id), counter & 0xFFFFFFFF, (len(frame) - MIC_SIZE) & 0xFF))
+        h.update(memoryview(frame)[:-MIC_SIZE])
+        return hmac.compare_digest(h.digest()[:MIC_SIZE], frame[-MIC_SIZE:])
+
+# Trame reçue, décodée une seule fois puis partagée par tout le pipeline
+# (déduplication, IDS, traitement). Les vues sur le payload sont calculées
+# à la demande puis conservées.
+class Frame:
+    __slots__ = ('message', '_decoded', '_body', '_mic', '_digest', '_readings', '_plaintext', '_authentic')
+
+    def __init__(self, message):
+        self.message = message
+        self._authentic = None  # Résultat de la vérification du MIC, une fois faite
+        self._decoded = None
+        self._body = None
+        self._mic = None
+        self._digest = None
+        self._readings = None
+        self._plaintext = None
+
+    @classmethod
+    def parse(cls, raw):
+        """Construit une trame à partir du message MQTT brut"""
+        return cls(json_loads(raw))
+
+    @classmethod
+    def wrap(cls, message):
+        """Retourne la trame telle quelle, ou enveloppe un message déjà décodé"""
+        return message if isinstance(message, cls) else cls(message)
+
+    def get(self, key, default=None):
+        return self.message.get(key, default)
+
+    @property
+    def gateways(self):
+        return self.message.get('metadata', {}).get('gateways', [])
+
+    @property
+    def decoded(self):
+        """Payload décodé du base64 (MIC inclus)"""
+        if self._decoded is None:
+            self._decoded = base64.b64decode(self.message['payload_raw'])
+        return self._decoded
+
+    @property
+    def body(self):
+        """Vue sur les données, sans le MIC"""
+        if self._body is None:
+            self._body = memoryview(self.decoded)[:-MIC_SIZE]
+        return self._body
+
+    @property
+    def mic(self):
+        if self._mic is None:
+            self._mic = memoryview(self.decoded)[-MIC_SIZE:]
+        return self._mic
+
+    @property
+    def digest(self):
+        """Empreinte CRC32 du payload (détection des doublons)"""
+        if self._digest is None:
+            self._digest = zlib.crc32(self.decoded)
+        return self._digest
+
+    @property
+    def encrypted(self):
+        return bool(self.message.get('encrypted'))
+
+    @property
+    def plaintext(self):
+        """Données en clair: le corps, déchiffré au préalable par PayloadCipher s'il est chiffré"""
+        if self._plaintext is None:
+            if self.encrypted:
+                raise ValueError("payload chiffré non déchiffré")
+            self._plaintext = self.body
+        return self._plaintext
+
+    @property
+    def readings(self):
+        """Lectures des capteurs: (horodatage, [(sensor_id, type, valeur, unités)])"""
+        if self._readings is None:
+            self._readings = decode_sensor_payload(self.plaintext)
+        return self._readings
+
+# Chiffrement des payloads à la manière de LoRaWAN (FRMPayload): AES-128 en mode
+# compteur, le flux de clé étant le chiffrement AES (ECB) des blocs A_i construits à
+# partir du DevAddr, du compteur de trame et du numéro de bloc. Le MIC est calculé
+# sur le payload chiffré. Un contexte AES ECB par nœud (clé déjà étendue) est
+# conservé dans un cache LRU propre à chaque worker et réutilisé pour toutes ses
+# trames; le déchiffrement par lot chiffre les blocs de plusieurs trames d'un même
+# nœud en un seul appel.
+def dev_addr(dev_id):
+    """Adresse 32 bits dérivée du dev_id (même calcul que lora-simulation.py)"""
+    return zlib.crc32(dev_id.encode())
+
+def counter_blocks(address, counter, length, direction=0):
+    """Blocs A_1..A_n couvrant length octets"""
+    return b"".join(CTR_BLOCK.pack(1, direction, address, counter & 0xFFFFFFFF, i)
+                    for i in range(1, (length + 15) // 16 + 1))
+
+def xor_bytes(data, keystream):
+    length = len(data)
+    return (int.from_bytes(data, "little") ^ int.from_bytes(keystream[:length], "little")).to_bytes(length, "little")
+
+class PayloadCipher:
+    def __init__(self, default_key=APP_KEY, device_keys=None, cache_size=CIPHER_CACHE_SIZE):
+        self.default_key = bytes.fromhex(default_key) if default_key else None
+        self.keys = {dev_id: bytes.fromhex(key) for dev_id, key in (device_keys or {}).items()}
+        self.cache_size = cache_size
+        self.generation = 0   # Incrémenté à chaque changement de clé: les caches sont alors vidés
+        self._local = threading.local()
+
+    @staticmethod
+    def available():
+        return Cipher is not None
+
+    def register_device(self, dev_id, key):
+        """Associe une clé AES propre à un nœud"""
+        self.keys[dev_id] = bytes.fromhex(key)
+        self.generation += 1
+
+    def _cache(self):
+        local = self._local
+        if getattr(local, 'generation', None) != self.generation:
+            local.generation = self.generation
+            local.contexts = OrderedDict()
+            local.hits = local.misses = 0
+        return local
+
+    def context(self, dev_id):
+        """Contexte AES ECB du nœud, créé au premier usage puis réutilisé"""
+        local = self._cache()
+        contexts = local.contexts
+        context = contexts.get(dev_id)
+        if context is not None:
+            local.hits += 1
+            contexts.move_to_end(dev_id)
+            return context
+        if Cipher is None:
+            raise RuntimeError("le déchiffrement AES nécessite le module cryptography (pip install cryptography)")
+        key = self.keys.get(dev_id, self.default_key)
+        if key is None:
+            raise KeyError(f"aucune clé pour le nœud {dev_id}")
+        local.misses += 1
+        context = contexts[dev_id] = Cipher(algorithms.AES(key), modes.ECB()).encryptor()
+        if len(contexts) > self.cache_size:
+            contexts.popitem(last=False)
+        return context
+
+    def decrypt(self, dev_id, counter, data):
+        """Déchiffre (ou chiffre: l'opération est symétrique) les données d'une trame"""
+        keystream = self.context(dev_id).update(counter_blocks(dev_addr(dev_id), counter, len(data)))
+        return xor_bytes(data, keystream)
+
+    encrypt = decrypt
+
+    def decrypt_frames(self, frames):
+        """Déchiffre les trames chiffrées pas encore déchiffrées; retourne le nombre d'échecs
+
+        Trame par trame: un lot libéré par la déduplication ne contient en pratique qu'une
+        trame par nœud, et regrouper les blocs d'un nœud en un seul appel AES y coûte plus
+        qu'il ne rapporte (python lora-benchmark.py decrypt).
+        """
+        decrypt = self.decrypt
+        failures = 0
+        for frame in frames:
+            if frame._plaintext is None and frame.encrypted:
+                message = frame.message
+                try:
+                    frame._plaintext = decrypt(message.get('dev_id'), message['counter'], frame.body)
+                except Exception:
+                    failures += 1
+        return failures
+
+    def get_stats(self):
+        """Succès et échecs du cache du worker courant"""
+        local = self._cache()
+        return {'contexts': len(local.contexts), 'hits': local.hits, 'misses': local.misses}
+
+# Journal d'événements: remplace les print() du chemin critique. Les événements
+# sont placés dans un tampon borné en mémoire et écrits par lots par un thread
+# dédié (console, JSONL ou SQLite). Un événement sous le niveau configuré est
+# écarté avant toute mise en forme.
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+CRITICAL = 50
+EVENT_LEVELS = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR, "CRITICAL": CRITICAL}
+EVENT_LEVEL_NAMES = {value: name for name, value in EVENT_LEVELS.items()}
+
+def _format_invalid_message(record):
+    lines = [f"Message invalide: {record.get('reason', 'Raison inconnue')}"]
+    lines.extend(f"  - {a['type']}: {a['details']}" for a in record.get('anomalies') or ())
+    return "\n".join(lines)
+
+def _format_sensor_data(record):
+    lines = [f"Données de capteurs reçues du nœud {record['dev_id']}:"]
+    lines.extend(f"  - {sensor_type}: {value} {units}" for _, sensor_type, value, units in record['readings'])
+    gateway = record.get('gateway')
+    if gateway:
+        lines.append(f"  Passerelle: {gateway.get('gtw_id')} (RSSI: {gateway.get('rssi')} dBm, SNR: {gateway.get('snr')} dB)")
+    return "\n".join(lines)
+
+# Mise en forme console de chaque type d'événement (gabarit ou fonction)
+EVENT_FORMATS = {
+    "message_received": "Message reçu",
+    "json_error": "Erreur de décodage JSON",
+    "processing_error": "Erreur de traitement du message: {error}",
+    "data_error": "Erreur de traitement des données: {error}",
+    "analysis_error": "Erreur lors de l'analyse du message: {error}",
+    "new_gateway": "Nouvelle passerelle enregistrée: {gateway_id} à {location}",
+    "gateway_new_devices": ("ALERTE - Passerelle {gateway_id}: {count} nœuds inconnus relayés en moins de "
+                            "{window:g} secondes (moyenne habituelle: {average})"),
+    "gateways_reloaded": "Passerelles autorisées rechargées depuis {path}: ajoutées {added}, retirées {removed}",
+    "new_node": "Nouveau nœud enregistré: {dev_id}",
+    "node_returned": "Retour du nœud évincé {dev_id}: fenêtre anti-rejeu reprise au compteur {counter}",
+    "alert": "ALERTE - Nœud {dev_id}: {type} - {details}",
+    "critical_alert": "ALERTE CRITIQUE - Nœud {dev_id}: {count} alertes en {window} secondes",
+    "invalid_message": _format_invalid_message,
+    "sensor_data": _format_sensor_data,
+    "raw_data": "Format de données non-JSON, affichage brut:\n  Données: {data}",
+    "decrypt_error": "Échec du déchiffrement de la trame {counter} du nœud {dev_id}",
+}
+
+def format_event(record):
+    """Texte lisible d'un événement"""
+    template = EVENT_FORMATS.get(record['event'])
+    if template is None:
+        return f"{record['event']}: {record}"
+    if callable(template):
+        return template(record)
+    return template.format_map(record)
+
+class ConsoleEventWriter:
+    def write(self, records):
+        sys.stdout.write("".join(format_event(record) + "\n" for record in records))
+        sys.stdout.flush()
+
+    def close(self):
+        pass
+
+class JSONLEventWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def write(self, records):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write("".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class SQLiteEventWriter:
+    def __init__(self, path):
+        self.path = path
+        self.connection = None  # Ouverte par le thread d'écriture (sqlite3 lie la connexion au thread)
+
+    def write(self, records):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS events "
+                                    "(time REAL, level TEXT, event TEXT, dev_id TEXT, data TEXT)")
+        rows = [(record['time'], EVENT_LEVEL_NAMES.get(record['level'], record['level']), record['event'],
+                 record.get('dev_id'), json.dumps(record, ensure_ascii=False, default=str))
+                for record in records]
+        with self.connection:
+            self.connection.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+class MultiEventWriter:
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write(self, records):
+        for writer in self.writers:
+            writer.write(records)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+def make_event_writer(outputs=EVENT_OUTPUTS, path=EVENT_PATH):
+    """Construit l'écrivain des sorties configurées ("console", "jsonl", "sqlite")"""
+    writers = []
+    for output in outputs:
+        if output == "console":
+            writers.append(ConsoleEventWriter())
+        elif output == "jsonl":
+            writers.append(JSONLEventWriter(path + ".jsonl"))
+        elif output == "sqlite":
+            writers.append(SQLiteEventWriter(path + ".sqlite"))
+        else:
+            raise ValueError(f"Sortie d'événements inconnue: {output}")
+    return writers[0] if len(writers) == 1 else MultiEventWriter(writers)
+
+# Notification externe des alertes critiques (email, SMS, webhook...): limitée à un
+# envoi par intervalle, les alertes survenues entre deux envois sont regroupées
+class AlertNotifier:
+    def __init__(self, notify=None, interval=ALERT_NOTIFY_INTERVAL):
+        self.notify = notify or self.print_summary
+        self.interval = interval
+        self.pending = []
+        self.last_sent = None
+
+    @staticmethod
+    def print_summary(alerts):
+        nodes = sorted({alert['dev_id'] for alert in alerts})
+        print(f"NOTIFICATION - {len(alerts)} alerte(s) critique(s) sur {len(nodes)} nœud(s): {', '.join(nodes)}")
+
+    def add(self, record):
+        self.pending.append(record)
+
+    def poll(self, now, force=False):
+        """Envoie les alertes en attente si l'intervalle minimal est écoulé"""
+        if not self.pending:
+            return
+        if not force and self.last_sent is not None and now - self.last_sent < self.interval:
+            return
+        alerts, self.pending = self.pending, []
+        self.last_sent = now
+        self.notify(alerts)
+
+class EventSink:
+    def __init__(self, writer=None, level=EVENT_LEVEL, buffer_size=EVENT_BUFFER_SIZE,
+                 flush_interval=EVENT_FLUSH_INTERVAL, notifier=None):
+        self.writer = writer or ConsoleEventWriter()
+        self.level = EVENT_LEVELS[level] if isinstance(level, str) else level
+        self.flush_interval = flush_interval
+        self.notifier = notifier
+        self.buffer = deque(maxlen=buffer_size)  # Plein: les événements les plus anciens sont perdus
+        self.high_water = max(1, buffer_size // 2)
+        self.dropped = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def emit(self, level, event, **fields):
+        """Enregistre un événement; écriture immédiate tant que le thread n'est pas démarré"""
+        if level < self.level:
+            return
+        fields['time'] = time.time()
+        fields['level'] = level
+        fields['event'] = event
+        if self._thread is None:
+            self._write([fields])
+            return
+        buffer = self.buffer
+        if len(buffer) == buffer.maxlen:
+            self.dropped += 1
+        buffer.append(fields)
+        if len(buffer) >= self.high_water:
+            self._wake.set()
+
+    def _write(self, records):
+        try:
+            self.writer.write(records)
+        except Exception as e:
+            print(f"Erreur d'écriture du journal d'événements: {str(e)}")
+        notifier = self.notifier
+        if notifier is not None:
+            for record in records:
+                if record['event'] == 'critical_alert':
+                    notifier.add(record)
+            notifier.poll(time.monotonic(), force=self._thread is None)
+
+    def flush(self):
+        """Écrit par lot les événements en attente"""
+        buffer = self.buffer
+        records = []
+        while buffer:
+            records.append(buffer.popleft())
+        if records:
+            self._write(records)
+        elif self.notifier is not None:
+            self.notifier.poll(time.monotonic())
+
+    def _drain(self):
+        """Dernier lot, notifications en attente et fermeture des sorties"""
+        self.flush()
+        if self.notifier is not None:
+            self.notifier.poll(time.monotonic(), force=True)
+        self.writer.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        # Les sorties (connexion SQLite) restent confinées au thread d'écriture
+        self._drain()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ids-events", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Arrête le thread d'écriture après avoir vidé le tampon et les notifications"""
+        if self._thread is None:
+            self._drain()
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+# Métriques du serveur: compteurs et histogrammes de latence par étape. Chaque
+# thread écrit dans ses propres compteurs (pas de verrou sur le chemin critique),
+# agrégés à la lecture. Les latences sont mesurées sur un échantillon régulier des
+# trames. Exposition au format texte Prometheus.
+METRIC_HELP = {
+    "lorawan_messages_received_total": ("counter", "Messages MQTT reçus"),
+    "lorawan_messages_total": ("counter", "Trames analysées par résultat"),
+    "lorawan_json_errors_total": ("counter", "Messages au JSON invalide"),
+    "lorawan_admission_dropped_total": ("counter", "Trames écartées par le contrôle d'admission par raison"),
+    "lorawan_anomalies_total": ("counter", "Anomalies détectées par type"),
+    "lorawan_unauthorized_gateway_total": ("counter", "Trames reçues via une passerelle non autorisée"),
+    "lorawan_gateway_alerts_total": ("counter", "Passerelles relayant soudain de nombreux nœuds inconnus"),
+    "lorawan_decrypt_errors_total": ("counter", "Trames valides dont le payload n'a pas pu être déchiffré"),
+    "lorawan_stage_duration_seconds": ("histogram", "Durée des étapes de traitement"),
+}
+
+RESULT_VALID = ('lorawan_messages_total', (('result', 'valid'),))
+RESULT_INVALID = ('lorawan_messages_total', (('result', 'invalid'),))
+RESULT_DUPLICATE = ('lorawan_messages_total', (('result', 'duplicate'),))
+
+class LatencyHistogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Dernier compartiment: au-delà de la plus grande borne
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Estimation d'un quantile (borne supérieure du compartiment)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+class MetricsShard:
+    """Compteurs et histogrammes d'un thread"""
+    __slots__ = ('counters', 'histograms', 'sampling', 'received', 'analyzed', 'valid', 'timing')
+
+    def __init__(self, sampling):
+        self.counters = {}    # (nom, étiquettes) -> valeur
+        self.histograms = {}  # étape -> LatencyHistogram
+        self.sampling = sampling
+        self.received = 0     # Messages reçus (compteur de lorawan_messages_received_total)
+        self.analyzed = 0
+        self.valid = 0        # Trames valides (compteur sans clé, incrémenté directement par analyze_frame)
+        self.timing = False   # La trame en cours d'analyse est chronométrée
+
+    def receive(self):
+        """Compte un message reçu; True si son décodage doit être chronométré"""
+        self.received += 1
+        return self.received % self.sampling == 0
+
+    def analyze(self):
+        """Compte une trame analysée; True si ses étapes doivent être chronométrées"""
+        self.analyzed += 1
+        self.timing = self.analyzed % self.sampling == 0
+        return self.timing
+
+    def inc(self, key, amount=1):
+        counters = self.counters
+        counters[key] = counters.get(key, 0) + amount
+
+    def count_result(self, analysis):
+        counters = self.counters
+        if analysis.get('valid', False):
+            self.valid += 1
+            return
+        if analysis.get('duplicate'):
+            key = RESULT_DUPLICATE
+        else:
+            key = RESULT_INVALID
+            for anomaly in analysis.get('anomalies') or ():
+                self.inc(('lorawan_anomalies_total', (('type', anomaly['type']),)))
+        counters[key] = counters.get(key, 0) + 1
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.observe(seconds)
+
+class Metrics:
+    def __init__(self, sampling=METRICS_LATENCY_SAMPLING):
+        self.sampling = sampling
+        self.started = time.time()
+        self.gauges = {}  # nom -> fonction retournant la valeur courante
+        self.totals = {}  # nom -> fonction retournant un total cumulé (exposé comme compteur)
+        self.max_label_values = METRICS_MAX_LABEL_VALUES
+        self.label_values = set()
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def shard(self):
+        """Compteurs du thread appelant"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = MetricsShard(self.sampling)
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def label(self, value):
+        """Valeur d'étiquette reprise d'une trame (non authentifiée): le nombre de valeurs
+        distinctes est borné pour que de fausses passerelles ne fassent pas grossir l'exposition"""
+        values = self.label_values
+        if value in values:
+            return value
+        with self._lock:
+            if len(values) < self.max_label_values:
+                values.add(value)
+                return value
+        return "other"
+
+    def counters(self):
+        totals = {}
+        with self._lock:
+            shards = list(self._shards)
+        received = ('lorawan_messages_received_total', ())
+        for shard in shards:
+            if shard.received:
+                totals[received] = totals.get(received, 0) + shard.received
+            if shard.valid:
+                totals[RESULT_VALID] = totals.get(RESULT_VALID, 0) + shard.valid
+            for key, value in list(shard.counters.items()):
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def histograms(self):
+        merged = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            for stage, histogram in list(shard.histograms.items()):
+                if stage not in merged:
+                    merged[stage] = LatencyHistogram(histogram.bounds)
+                merged[stage].merge(histogram)
+        return merged
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+    def render(self):
+        """Texte au format d'exposition Prometheus"""
+        series = {}
+        for (name, labels), value in sorted(self.counters().items(), key=lambda item: (item[0][0], item[0][1])):
+            series.setdefault(name, []).append(f"{name}{self._labels(labels)} {value}")
+        histogram_lines = []
+        for stage, histogram in sorted(self.histograms().items()):
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                histogram_lines.append(f'lorawan_stage_duration_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {cumulative}')
+            histogram_lines.append(f'lorawan_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            histogram_lines.append(f'lorawan_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum:.9f}')
+            histogram_lines.append(f'lorawan_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+        if histogram_lines:
+            series["lorawan_stage_duration_seconds"] = histogram_lines
+
+        lines = []
+        for name, samples in series.items():
+            kind, description = METRIC_HELP.get(name, ("counter", name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(samples)
+        gauges = dict(self.gauges, lorawan_uptime_seconds=lambda: time.time() - self.started)
+        sources = [(name, "gauge", read) for name, read in gauges.items()]
+        sources += [(name, "counter", read) for name, read in self.totals.items()]
+        for name, kind, read in sorted(sources):
+            value = read()
+            lines.append(f"# TYPE {name} {kind}")
+            if isinstance(value, dict):
+                # Jauge étiquetée: {étiquettes: valeur}
+                lines.extend(f"{name}{self._labels(labels)} {sample}" for labels, sample in sorted(value.items()))
+            else:
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """Écrit les métriques dans un fichier (remplacement atomique)"""
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(path + ".tmp", path)
+
+# Point d'accès HTTP local (GET /metrics) et copie périodique dans un fichier
+class MetricsExporter:
+    def __init__(self, metrics, host=METRICS_HOST, port=METRICS_PORT,
+                 dump_path=METRICS_DUMP_PATH, dump_interval=METRICS_DUMP_INTERVAL):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self.httpd = None
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _handler(self):
+        metrics = self.metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _dump_loop(self):
+        while not self._stop.wait(self.dump_interval):
+            try:
+                self.metrics.dump(self.dump_path)
+            except Exception as e:
+                print(f"Erreur d'écriture des métriques: {str(e)}")
+
+    def start(self):
+        if self.port is not None:
+            try:
+                self.httpd = http.server.ThreadingHTTPServer((self.host, self.port), self._handler())
+            except OSError as e:
+                print(f"Point d'accès des métriques indisponible sur le port {self.port}: {str(e)}")
+            else:
+                self._threads.append(threading.Thread(target=self.httpd.serve_forever, name="metrics-http", daemon=True))
+                print(f"Métriques disponibles sur http://{self.host}:{self.port}/metrics")
+        if self.dump_path:
+            self._threads.append(threading.Thread(target=self._dump_loop, name="metrics-dump", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.dump_path:
+            self.metrics.dump(self.dump_path)
 
 # Classe IDS simplifié pour LoRaWAN
 class LoRaWANIDS:
     def __init__(self):
-        self.known_nodes = {}  # Stocke les informations sur les nœuds connus
+        self.known_nodes = NodeTable()  # Stocke les informations sur les nœuds connus
         self.message_history = {}  # Pour la détection des attaques par rejeu
         self.alert_threshold = 3  # Nombre d'alertes avant notification
         self.alert_window = 300   # Fenêtre de temps pour les alertes (en secondes)
-        self.authorized_gateways = {
-            "farm_gateway_001": {
-                "location": "Ferme principale",
-                "last_seen": None,
-                "status": "active"
-            }
-        }
+        self.mic_verifier = MICVerifier(APP_KEY, DEVICE_KEYS)
+        self.counter_jump_tolerance = COUNTER_JUMP_TOLERANCE
+        self.duplicate_window = DUPLICATE_WINDOW
+        self.rssi_threshold = RSSI_THRESHOLD
+        self.set_detectors(DETECTORS)
+        self.state_store = None  # IDSStateStore éventuel, notifié de chaque nœud modifié
+        self.events = EventSink()  # Écriture directe sur la console, remplacé par le serveur
+        self.metrics = None        # Metrics éventuel (durée du MIC, passerelles non autorisées)
+        self.provisioned_devices = None  # Ensemble des dev_id provisionnés (None: aucun filtrage)
+        if PROVISIONED_DEVICES is not None:
+            self.provision_devices(PROVISIONED_DEVICES)
+        self.gateways = GatewayRegistry()  # Passerelles autorisées et leurs statistiques
         
     def is_gateway_authorized(self, gateway_id):
         """Vérifie si une passerelle est autorisée"""
-        return gateway_id in self.authorized_gateways
+        return gateway_id in self.gateways.gateways
         
     def register_gateway(self, gateway_id, location):
         """Enregistre une nouvelle passerelle autorisée"""
-        if gateway_id not in self.authorized_gateways:
-            self.authorized_gateways[gateway_id] = {
-                "location": location,
-                "last_seen": datetime.now().isoformat(),
-                "status": "active"
-            }
-            print(f"Nouvelle passerelle enregistrée: {gateway_id} à {location}")
+        if self.gateways.register(gateway_id, location):
+            self.events.emit(INFO, 'new_gateway', gateway_id=gateway_id, location=location)
         
-    def register_node(self, node_id):
-        """Enregistre un nouveau nœud dans l'IDS"""
-        if node_id not in self.known_nodes:
-            self.known_nodes[node_id] = {
-                'first_seen': datetime.now().isoformat(),
-                'last_seen': datetime.now().isoformat(),
-                'counters': {},
-                'alerts': [],
-                'rssi_history': []
-            }
-            print(f"Nouveau nœud enregistré: {node_id}")
+    def set_detectors(self, names):
+        """Active les détecteurs nommés (avant l'analyse: les états des nœuds suivent l'ordre des détecteurs)"""
+        self.detectors = make_detectors(self, names)
+        self.stateful_detectors = any(detector.stateful for detector in self.detectors)
+
+    def provision_devices(self, dev_ids):
+        """Ajoute des nœuds provisionnés: seuls ceux-ci (et ceux de DEVICE_KEYS) sont ensuite admis"""
+        if self.provisioned_devices is None:
+            self.provisioned_devices = set(DEVICE_KEYS)
+        self.provisioned_devices.update(dev_ids)
+        self.known_nodes.provision(self.provisioned_devices)
+
+    def authenticate(self, frame):
+        """Vérifie une seule fois le MIC d'une trame complète (le résultat est conservé dans la trame)"""
+        if frame._authentic is None:
+            message = frame.message
+            try:
+                frame._authentic = self.mic_verifier.verify(message['dev_id'], frame.decoded, message['counter'])
+            except Exception:
+                # Payload ou compteur illisible: l'IDS le signalera lors de l'analyse
+                return False
+        return frame._authentic
+
+    def is_fresh(self, dev_id, counter):
+        """True si le compteur n'a pas déjà été reçu du nœud (ni rejeu, ni hors fenêtre)"""
+        node = self.known_nodes.get(dev_id)
+        return node is None or node.replay_window.check(counter, self.counter_jump_tolerance) != 'REPLAY_ATTACK'
+
+    def register_node(self, node_id, now=None):
+        """Enregistre un nœud absent de la table (nouveau, ou évincé qui reprend sa pierre tombale)"""
+        node = self.known_nodes.get(node_id)
+        if node is None:
+            if now is None:
+                now = time.time()
+            node = NodeState(now)
+            if self.known_nodes.add(node_id, node, now):
+                self.events.emit(INFO, 'new_node', dev_id=node_id)
+            else:
+                self.events.emit(INFO, 'node_returned', dev_id=node_id, counter=node.replay_window.top)
+        return node
     
-    def analyze_message(self, message):
-        """Analyse un message LoRaWAN pour détecter des anomalies"""
+    def count_new_device(self, relays, now):
+        """Signale une passerelle qui relaie soudain beaucoup de nœuds inconnus"""
+        registry = self.gateways
+        for gateway_id, state in relays:
+            if state.new_device(now, registry.window, registry.threshold, registry.factor):
+                self.events.emit(WARNING, 'gateway_new_devices', gateway_id=gateway_id, count=state.new_devices,
+                                 average=round(state.new_device_average, 1), window=registry.window)
+                if self.metrics is not None:
+                    self.metrics.shard().inc(('lorawan_gateway_alerts_total',
+                                              (('gateway', self.metrics.label(gateway_id)),)))
+
+    def record_alerts(self, dev_id, node, anomalies, now):
+        """Enregistre les anomalies d'un nœud et déclenche l'alerte critique si le seuil est atteint"""
+        events = self.events
+        for anomaly in anomalies:
+            node.add_alert(now, anomaly['type'])
+            events.emit(WARNING, 'alert', dev_id=dev_id, type=anomaly['type'], details=anomaly['details'])
+        
+        # Nettoyer les alertes trop anciennes
+        cutoff = now - self.alert_window
+        node.expire_alerts(cutoff)
+        
+        # Vérifier le seuil d'alerte
+        if len(node.alerts) >= self.alert_threshold:
+            # Une seule alerte critique par fenêtre tant que le nœud reste au-dessus du seuil
+            if node.critical_since is None or node.critical_since <= cutoff:
+                node.critical_since = now
+                # Transmis au notificateur externe du journal d'événements (AlertNotifier)
+                events.emit(CRITICAL, 'critical_alert', dev_id=dev_id, count=self.alert_threshold,
+                            window=self.alert_window)
+        else:
+            node.critical_since = None
+    
+    def reject_frame(self, dev_id, anomaly_type, details, now):
+        """Rejette une trame avant analyse complète (alerte imputée au nœud s'il est connu)"""
+        anomalies = [{'type': anomaly_type, 'details': details}]
+        node = self.known_nodes.get(dev_id)
+        if node is not None:
+            self.record_alerts(dev_id, node, anomalies, now)
+        return {'valid': False, 'anomalies': anomalies, 'node_id': dev_id}
+    
+    def analyze_message(self, message, now=None):
+        """Analyse un message LoRaWAN (dict ou Frame) pour détecter des anomalies
+
+        now permet de rejouer une capture avec ses horodatages d'origine.
+        """
         try:
+            frame = Frame.wrap(message)
+            message = frame.message
+            
             # Extraction des informations pertinentes
             dev_id = message.get('dev_id')
             counter = message.get('counter')
@@ -70,109 +1696,121 @@ class LoRaWANIDS:
             if not gateways:
                 return {'valid': False, 'reason': 'Aucune passerelle dans les métadonnées'}
                 
+            if now is None:
+                now = time.time()
+            
+            # 1. Vérification du MIC, avant toute autre analyse: une trame falsifiée
+            # ne doit ni enregistrer de nœud ni faire avancer son compteur
+            try:
+                decoded = frame.decoded
+            except Exception as e:
+                return self.reject_frame(dev_id, 'PAYLOAD_ERROR', f'Erreur de décodage: {str(e)}', now)
+            counters = self.metrics.shard() if self.metrics is not None else None
+            valid_mic = frame._authentic  # Déjà vérifié par le contrôle d'admission, sinon None
+            if valid_mic is None:
+                if counters is not None and counters.timing:
+                    start = time.perf_counter()
+                    valid_mic = self.mic_verifier.verify(dev_id, decoded, counter)
+                    counters.observe('mic', time.perf_counter() - start)
+                else:
+                    valid_mic = self.mic_verifier.verify(dev_id, decoded, counter)
+            if not valid_mic:
+                return self.reject_frame(dev_id, 'INVALID_MIC', 'Échec de la vérification du code d\'intégrité', now)
+            
+            # Vérification des anomalies
+            anomalies = []
+            
+            authorized = self.gateways.gateways
+            relays = []
             for gateway in gateways:
                 gateway_id = gateway.get('gtw_id')
                 if not gateway_id:
                     continue
                     
-                if not self.is_gateway_authorized(gateway_id):
+                state = authorized.get(gateway_id)
+                if state is None:
                     anomalies.append({
                         'type': 'UNAUTHORIZED_GATEWAY',
                         'details': f'Passerelle non autorisée détectée: {gateway_id}'
                     })
+                    if counters is not None:
+                        counters.inc(('lorawan_unauthorized_gateway_total',
+                                      (('gateway', self.metrics.label(gateway_id)),)))
                 else:
-                    # Mise à jour du statut de la passerelle
-                    self.authorized_gateways[gateway_id]['last_seen'] = datetime.now().isoformat()
-                    self.authorized_gateways[gateway_id]['status'] = 'active'
+                    # Trafic de la passerelle (le statut est déduit de last_seen à la lecture)
+                    state.record(gateway.get('rssi'), now)
+                    relays.append((gateway_id, state))
             
-            # Vérifier si le nœud est connu
-            if dev_id not in self.known_nodes:
-                self.register_node(dev_id)
+            # Vérifier si le nœud est connu et mettre à jour ses informations
+            node = self.known_nodes.lookup(dev_id)
+            if node is None:
+                # Un nœud évincé qui revient n'est pas un nouveau nœud pour ses passerelles
+                returning = dev_id in self.known_nodes.tombstones
+                node = self.register_node(dev_id, now)
+                if not returning:
+                    self.count_new_device(relays, now)
+            node.last_seen = now
             
-            # Mettre à jour les informations du nœud
-            node_info = self.known_nodes[dev_id]
-            node_info['last_seen'] = datetime.now().isoformat()
-            
-            # Vérification des anomalies
-            anomalies = []
-            
-            # 1. Vérification du compteur (détection de rejeu)
-            if dev_id in self.known_nodes and 'last_counter' in self.known_nodes[dev_id]['counters']:
-                last_counter = self.known_nodes[dev_id]['counters']['last_counter']
-                if counter <= last_counter:
-                    anomalies.append({
-                        'type': 'REPLAY_ATTACK',
-                        'details': f'Compteur non incrémenté: actuel={counter}, précédent={last_counter}'
-                    })
-                elif counter > last_counter + 10:
-                    anomalies.append({
-                        'type': 'COUNTER_JUMP',
-                        'details': f'Saut de compteur suspect: actuel={counter}, précédent={last_counter}'
-                    })
-            
-            # Mise à jour du compteur
-            self.known_nodes[dev_id]['counters']['last_counter'] = counter
-            
-            # 2. Vérification du MIC
-            try:
-                decoded = base64.b64decode(payload_raw)
-                # Dans un scénario réel, nous vérifierions le MIC avec l'app_key
-                # Simulation simplifiée ici
-                valid_mic = True  # Supposons que c'est valide par défaut
-                
-                if not valid_mic:
-                    anomalies.append({
-                        'type': 'INVALID_MIC',
-                        'details': 'Échec de la vérification du code d\'intégrité'
-                    })
-            except Exception as e:
+            # 2. Vérification du compteur (détection de rejeu). La fenêtre n'est mise à jour
+            # qu'après les détecteurs: une trame dont l'analyse échoue ne consomme pas son compteur
+            window = node.replay_window
+            counter_anomaly = window.check(counter, self.counter_jump_tolerance)
+            if counter_anomaly is None:
+                pass
+            elif (not anomalies and counter == window.top and now - node.top_time <= self.duplicate_window
+                  and frame.digest == node.top_digest
+                  and not any(gateway.get('gtw_id') in node.top_gateways for gateway in gateways)):
+                # Même trame relayée par une autre passerelle: ni alerte ni retraitement.
+                # Une copie venant d'une passerelle qui l'a déjà relayée est un rejeu.
+                node.top_gateways += tuple(gateway.get('gtw_id') for gateway in gateways)
+                return {'valid': False, 'duplicate': True, 'reason': 'Doublon multi-passerelle', 'node_id': dev_id}
+            elif counter_anomaly == 'REPLAY_ATTACK':
                 anomalies.append({
-                    'type': 'PAYLOAD_ERROR',
-                    'details': f'Erreur de décodage: {str(e)}'
+                    'type': 'REPLAY_ATTACK',
+                    'details': f'Compteur déjà reçu ou hors fenêtre: actuel={counter}, plus haut={window.top}'
+                })
+            else:
+                anomalies.append({
+                    'type': 'COUNTER_JUMP',
+                    'details': f'Saut de compteur suspect: actuel={counter}, plus haut={window.top}'
                 })
             
-            # 3. Analyse RSSI pour détecter les usurpations potentielles
-            if gateways:
-                current_rssi = gateways[0].get('rssi', 0)
-                self.known_nodes[dev_id]['rssi_history'].append(current_rssi)
-                
-                # Conserver uniquement les 10 dernières valeurs RSSI
-                if len(self.known_nodes[dev_id]['rssi_history']) > 10:
-                    self.known_nodes[dev_id]['rssi_history'] = self.known_nodes[dev_id]['rssi_history'][-10:]
-                
-                # Calculer la moyenne et l'écart-type des RSSI précédents
-                if len(self.known_nodes[dev_id]['rssi_history']) >= 5:
-                    avg_rssi = sum(self.known_nodes[dev_id]['rssi_history'][:-1]) / (len(self.known_nodes[dev_id]['rssi_history']) - 1)
-                    
-                    # Variation soudaine de RSSI (possible usurpation)
-                    if abs(current_rssi - avg_rssi) > 20:  # Seuil arbitraire de 20 dBm
-                        anomalies.append({
-                            'type': 'RSSI_ANOMALY',
-                            'details': f'Variation RSSI suspecte: actuel={current_rssi}, moyenne={avg_rssi:.2f}'
-                        })
+            # 3. Détecteurs en flux (RSSI, SNR, intervalle, taille...) pour détecter les usurpations
+            detectors = self.detectors
+            states = None
+            if self.stateful_detectors:
+                states = node.detector_states
+                if states is None or len(states) != len(detectors):
+                    states = node.detector_states = [detector.new_state() for detector in detectors]
+            timing = counters is not None and counters.timing
+            for index, detector in enumerate(detectors):
+                state = states[index] if states is not None else None
+                if timing:
+                    start = time.perf_counter()
+                    details = detector.check(node, state, frame, now)
+                    counters.observe('detector_' + detector.name, time.perf_counter() - start)
+                else:
+                    details = detector.check(node, state, frame, now)
+                if details is not None:
+                    anomalies.append({'type': detector.anomaly_type, 'details': details})
+            
+            if counter_anomaly != 'REPLAY_ATTACK':
+                # Après un saut de compteur, le MIC est déjà vérifié: la trame est authentique, le nœud
+                # a perdu beaucoup de trames ou redémarré. On se resynchronise pour ne pas le bloquer.
+                window.accept(counter)
+                if counter == window.top:
+                    node.top_time = now
+                    node.top_digest = frame.digest
+                    node.top_gateways = tuple(gateway.get('gtw_id') for gateway in gateways)
+            
+            if self.state_store is not None:
+                self.state_store.mark_dirty(dev_id)
             
             # 4. Enregistrement des alertes si des anomalies sont détectées
             if anomalies:
-                timestamp = datetime.now().isoformat()
-                for anomaly in anomalies:
-                    self.known_nodes[dev_id]['alerts'].append({
-                        'timestamp': timestamp,
-                        'type': anomaly['type'],
-                        'details': anomaly['details']
-                    })
-                    print(f"ALERTE - Nœud {dev_id}: {anomaly['type']} - {anomaly['details']}")
-                
-                # Nettoyer les alertes trop anciennes
-                current_time = time.time()
-                self.known_nodes[dev_id]['alerts'] = [
-                    alert for alert in self.known_nodes[dev_id]['alerts']
-                    if (datetime.fromisoformat(alert['timestamp']).timestamp() + self.alert_window) > current_time
-                ]
-                
-                # Vérifier le seuil d'alerte
-                if len(self.known_nodes[dev_id]['alerts']) >= self.alert_threshold:
-                    print(f"ALERTE CRITIQUE - Nœud {dev_id}: {self.alert_threshold} alertes en {self.alert_window} secondes")
-                    # Ici, on pourrait déclencher une notification externe (email, SMS, etc.)
+                self.record_alerts(dev_id, node, anomalies, now)
+            else:
+                self.known_nodes.confirm(dev_id)
             
             return {
                 'valid': len(anomalies) == 0,
@@ -181,17 +1819,1294 @@ class LoRaWANIDS:
             }
             
         except Exception as e:
-            print(f"Erreur lors de l'analyse du message: {str(e)}")
+            self.events.emit(ERROR, 'analysis_error', error=str(e))
             return {'valid': False, 'reason': f'Erreur d\'analyse: {str(e)}'}
 
+# Persistance de l'état de l'IDS: journal binaire en ajout seul (WAL) et instantanés
+# compacts. Chaque enregistrement contient l'état complet d'un nœud ou d'une passerelle,
+# le dernier lu l'emporte. Les nœuds modifiés sont regroupés et écrits par lots depuis
+# un thread dédié, hors du chemin critique. Au démarrage, on recharge le dernier
+# instantané puis les journaux de génération supérieure ou égale.
+RECORD_HEADER = struct.Struct("<BHII")         # type, longueur de la clé, longueur du corps, CRC32
+NODE_RECORD = struct.Struct("<ddqBBdH")        # first_seen, last_seen, compteur max, position, nombre
+                                               # et somme RSSI, taille du bitmap anti-rejeu
+GATEWAY_RECORD = struct.Struct("<H")           # longueur de last_seen (epoch en texte, ISO 8601 avant)
+RECORD_NODE = 1
+RECORD_GATEWAY = 2
+RECORD_QUARANTINE = 3  # Nœud en quarantaine, transmis d'un worker à l'autre (jamais écrit sur disque)
+RECORD_TOMBSTONE = 4   # Nœud évincé: plus haut compteur accepté, trames sans anomalie (-1 s'il était établi)
+TOMBSTONE_RECORD = struct.Struct("<qh")
+
+class IDSStateStore:
+    def __init__(self, ids, directory=STATE_DIR, flush_interval=STATE_FLUSH_INTERVAL,
+                 snapshot_interval=STATE_SNAPSHOT_INTERVAL):
+        self.ids = ids
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.generation = 0
+        self.wal = None
+        self.dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._gateways_written = {}
+        self._write_lock = threading.RLock()  # Écritures du thread de fond et des passages de nœuds
+        self._merged = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_snapshot = time.monotonic()
+        # Sans répertoire, le magasin ne sert qu'à sérialiser les nœuds passés d'un worker à l'autre
+        if directory:
+            ids.state_store = self
+            ids.known_nodes.on_bury = self.mark_dirty
+
+    def _path(self, generation, kind, directory=None):
+        return os.path.join(directory or self.directory, f"ids-{generation:08d}.{kind}")
+
+    def _generations(self, kind, directory=None):
+        suffix = "." + kind
+        return sorted(int(name[4:-len(suffix)]) for name in os.listdir(directory or self.directory)
+                      if name.startswith("ids-") and name.endswith(suffix))
+
+    def mark_dirty(self, dev_id):
+        """Signale qu'un nœud a changé (appelé par l'IDS à chaque trame)"""
+        with self._dirty_lock:
+            self.dirty.add(dev_id)
+
+    @staticmethod
+    def _record(record_type, key, body):
+        key = key.encode()
+        record = key + body
+        return RECORD_HEADER.pack(record_type, len(key), len(body), zlib.crc32(record)) + record
+
+    def _encode_node(self, dev_id, node, probation=None):
+        window = node.replay_window
+        top = -1 if window.top is None else window.top
+        body = (NODE_RECORD.pack(node.first_seen, node.last_seen, top, node.rssi_pos,
+                                 node.rssi_count, node.rssi_sum, len(window.bits))
+                + window.bits + node.rssi_ring.tobytes())
+        if probation is None:
+            return self._record(RECORD_NODE, dev_id, body)
+        # Nœud en quarantaine: le nombre de trames sans anomalie suit l'historique RSSI
+        return self._record(RECORD_QUARANTINE, dev_id, body + bytes((min(probation, 255),)))
+
+    def _encode_tombstone(self, dev_id, tombstone):
+        top, probation = tombstone
+        return self._record(RECORD_TOMBSTONE, dev_id,
+                            TOMBSTONE_RECORD.pack(top, -1 if probation is None else min(probation, 255)))
+
+    def _encode_gateway(self, gateway_id, last_seen):
+        value = (repr(last_seen) if last_seen is not None else "").encode()
+        return self._record(RECORD_GATEWAY, gateway_id, GATEWAY_RECORD.pack(len(value)) + value)
+
+    def _apply(self, record_type, record, key_len):
+        """Applique un enregistrement (clé suivie du corps) à l'état de l'IDS"""
+        key = record[:key_len].decode()
+        if record_type == RECORD_NODE or record_type == RECORD_QUARANTINE:
+            first_seen, last_seen, top, rssi_pos, rssi_count, rssi_sum, bits_len = NODE_RECORD.unpack_from(record, key_len)
+            # Construction directe (sans __init__) pour restaurer rapidement de grandes flottes
+            window = ReplayWindow.__new__(ReplayWindow)
+            window.top = None if top < 0 else top
+            bits_start = key_len + NODE_RECORD.size
+            bits_end = bits_start + bits_len
+            if bits_len * 8 == REPLAY_WINDOW_SIZE:
+                window.bits = bytearray(record[bits_start:bits_end])
+            else:
+                # Taille de fenêtre modifiée: par prudence, tout compteur <= top est refusé
+                window.bits = bytearray(b"\xff" * (REPLAY_WINDOW_SIZE // 8))
+            node = NodeState.__new__(NodeState)
+            node.first_seen = first_seen
+            node.last_seen = last_seen
+            node.replay_window = window
+            node.top_time = 0.0
+            node.top_digest = 0
+            node.top_gateways = ()
+            node.alerts = None
+            node.alert_counts = None
+            node.critical_since = None
+            node.detector_states = None
+            ring_end = len(record) - 1 if record_type == RECORD_QUARANTINE else len(record)
+            ring = array('d')
+            ring.frombytes(record[bits_end:ring_end])
+            if len(ring) == RSSI_HISTORY_SIZE - 1:
+                node.rssi_ring = ring
+                node.rssi_pos = rssi_pos
+                node.rssi_count = rssi_count
+                node.rssi_sum = rssi_sum
+            else:
+                node.rssi_ring = array('d', bytes(8 * (RSSI_HISTORY_SIZE - 1)))
+                node.rssi_pos = 0
+                node.rssi_count = 0
+                node.rssi_sum = 0.0
+            if record_type == RECORD_QUARANTINE:
+                known_nodes = self.ids.known_nodes
+                known_nodes.pop(key)
+                known_nodes.add(key, node, time.time())
+                if key in known_nodes.probation:
+                    known_nodes.probation[key] = record[-1]
+            else:
+                self.ids.known_nodes[key] = node
+        elif record_type == RECORD_TOMBSTONE:
+            top, probation = TOMBSTONE_RECORD.unpack_from(record, key_len)
+            self.ids.known_nodes.bury(key, top, None if probation < 0 else probation)
+        elif record_type == RECORD_GATEWAY:
+            length, = GATEWAY_RECORD.unpack_from(record, key_len)
+            gateway = self.ids.gateways.get(key)
+            if gateway is not None and length:
+                value_start = key_len + GATEWAY_RECORD.size
+                value = record[value_start:value_start + length].decode()
+                try:
+                    gateway.last_seen = float(value)
+                except ValueError:
+                    # Journaux antérieurs: horodatage ISO 8601
+                    gateway.last_seen = datetime.fromisoformat(value).timestamp()
+
+    def _merge(self, record_type, record, key_len):
+        """Applique un nœud reçu d'ailleurs, sauf si l'état déjà présent est plus récent"""
+        if record_type == RECORD_TOMBSTONE:
+            self._merge_tombstone(record, key_len)
+            return
+        if record_type != RECORD_NODE and record_type != RECORD_QUARANTINE:
+            return
+        key = record[:key_len].decode()
+        current = self.ids.known_nodes.get(key)
+        if current is not None and current.last_seen >= NODE_RECORD.unpack_from(record, key_len)[1]:
+            return
+        self._apply(record_type, record, key_len)
+        self._merged.append(key)
+
+    def _merge_tombstone(self, record, key_len):
+        """Pierre tombale reçue d'ailleurs: le plus haut compteur connu l'emporte, nœud présent compris"""
+        key = record[:key_len].decode()
+        top, probation = TOMBSTONE_RECORD.unpack_from(record, key_len)
+        known_nodes = self.ids.known_nodes
+        current = known_nodes.get(key)
+        if current is not None:
+            window = current.replay_window
+            if window.top is not None and window.top >= top:
+                return
+            window.restore(top)
+        else:
+            tombstone = known_nodes.tombstones.get(key)
+            if tombstone is not None and tombstone[0] >= top:
+                return
+            known_nodes.bury(key, top, None if probation < 0 else probation)
+        self._merged.append(key)
+
+    @staticmethod
+    def _replay(buffer, apply):
+        """Applique les enregistrements d'un tampon et s'arrête au premier enregistrement tronqué ou corrompu"""
+        applied = 0
+        size = len(buffer)
+        offset = 0
+        header_size = RECORD_HEADER.size
+        unpack_header = RECORD_HEADER.unpack_from
+        crc32 = zlib.crc32
+        while offset + header_size <= size:
+            record_type, key_len, body_len, crc = unpack_header(buffer, offset)
+            start = offset + header_size
+            end = start + key_len + body_len
+            if end > size:
+                break
+            record = buffer[start:end]
+            if crc32(record) != crc:
+                break
+            apply(record_type, record, key_len)
+            applied += 1
+            offset = end
+        return applied
+
+    def _replay_file(self, path, apply):
+        if os.path.getsize(path) == 0:
+            return 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return self._replay(mapped, apply)
+
+    def _restore(self, directory, apply):
+        """Rejoue le dernier instantané puis les journaux d'un répertoire; retourne les générations lues"""
+        snapshots = self._generations("snapshot", directory)
+        base = snapshots[-1] if snapshots else 0
+        wals = [g for g in self._generations("wal", directory) if g >= base]
+        # Les objets restaurés ne forment pas de cycles: inutile de laisser le
+        # ramasse-miettes parcourir le tas à chaque millier d'allocations
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if snapshots:
+                self._replay_file(self._path(base, "snapshot", directory), apply)
+            for generation in wals:
+                self._replay_file(self._path(generation, "wal", directory), apply)
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return base, wals
+
+    def load(self):
+        """Restaure l'état de l'IDS et ouvre un nouveau journal; retourne le nombre de nœuds"""
+        os.makedirs(self.directory, exist_ok=True)
+        base, wals = self._restore(self.directory, self._apply)
+        # Les journaux vides des démarrages précédents ne servent plus
+        for generation in wals:
+            path = self._path(generation, "wal")
+            if os.path.getsize(path) == 0:
+                os.remove(path)
+        self.generation = max([base] + wals) + 1
+        self.wal = open(self._path(self.generation, "wal"), "ab")
+        self._gateways_written = {gid: g.last_seen for gid, g in self.ids.gateways.items()}
+        return len(self.ids.known_nodes)
+
+    def export_nodes(self, dev_ids):
+        """Retire des nœuds de la table et retourne leurs enregistrements, pour le worker qui les reprend"""
+        known_nodes = self.ids.known_nodes
+        records = []
+        for dev_id in dev_ids:
+            # Un nœud en quarantaine y reste chez son nouveau propriétaire
+            probation = known_nodes.probation.get(dev_id, 0) if dev_id in known_nodes.quarantine else None
+            tombstone = known_nodes.tombstones.get(dev_id)
+            node = known_nodes.pop(dev_id)
+            if node is not None:
+                records.append(self._encode_node(dev_id, node, probation))
+            elif tombstone is not None:
+                records.append(self._encode_tombstone(dev_id, tombstone))
+        return b"".join(records)
+
+    def import_nodes(self, data):
+        """Fusionne les nœuds reçus d'un autre worker et les écrit avant de rendre la main"""
+        self._merged = []
+        self._replay(data, self._merge)
+        return self._persist_merged()
+
+    def adopt(self, directory):
+        """Fusionne l'état laissé par un worker disparu (instantané et journaux de son répertoire)"""
+        self._merged = []
+        self._restore(directory, self._merge)
+        return self._persist_merged()
+
+    def _persist_merged(self):
+        merged, self._merged = self._merged, None
+        if merged and self.wal is not None:
+            with self._dirty_lock:
+                self.dirty.update(merged)
+            self.flush()
+        return len(merged)
+
+    def flush(self):
+        """Écrit par lot les nœuds modifiés et les passerelles vues, puis fsync"""
+        with self._write_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._dirty_lock:
+            dirty, self.dirty = self.dirty, set()
+        known_nodes = self.ids.known_nodes
+        records = []
+        quarantine = known_nodes.quarantine
+        tombstones = known_nodes.tombstones
+        for dev_id in dirty:
+            node = known_nodes.get(dev_id)
+            # Les nœuds en quarantaine ne sont pas conservés d'un démarrage à l'autre
+            if node is not None:
+                if dev_id not in quarantine:
+                    records.append(self._encode_node(dev_id, node))
+            else:
+                tombstone = tombstones.get(dev_id)
+                if tombstone is not None and tombstone[1] is None:
+                    records.append(self._encode_tombstone(dev_id, tombstone))
+        for gateway_id, gateway in self.ids.gateways.items():
+            last_seen = gateway.last_seen
+            if last_seen != self._gateways_written.get(gateway_id):
+                records.append(self._encode_gateway(gateway_id, last_seen))
+                self._gateways_written[gateway_id] = last_seen
+        if records:
+            self.wal.write(b"".join(records))
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+        return len(records)
+
+    def snapshot(self):
+        """Compacte l'état dans un instantané et supprime les journaux devenus inutiles"""
+        with self._write_lock:
+            self._snapshot()
+
+    def _snapshot(self):
+        # Les modifications en cours seront dans le nouveau journal: l'instantané
+        # n'a besoin que d'être au moins aussi récent que la rotation
+        self.flush()
+        self.wal.close()
+        self.generation += 1
+        self.wal = open(self._path(self.generation, "wal"), "ab")
+
+        path = self._path(self.generation, "snapshot")
+        with open(path + ".tmp", "wb") as f:
+            batch = []
+            known_nodes = self.ids.known_nodes
+            for dev_id, node in list(known_nodes.pinned.items()) + list(known_nodes.established.items()):
+                batch.append(self._encode_node(dev_id, node))
+                if len(batch) >= 10000:
+                    f.write(b"".join(batch))
+                    batch = []
+            for dev_id, tombstone in list(known_nodes.tombstones.items()):
+                if tombstone[1] is None:
+                    batch.append(self._encode_tombstone(dev_id, tombstone))
+                    if len(batch) >= 10000:
+                        f.write(b"".join(batch))
+                        batch = []
+            for gateway_id, gateway in self.ids.gateways.items():
+                batch.append(self._encode_gateway(gateway_id, gateway.last_seen))
+            f.write(b"".join(batch))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        for kind in ("snapshot", "wal"):
+            for generation in self._generations(kind):
+                if generation < self.generation:
+                    os.remove(self._path(generation, kind))
+        self._last_snapshot = time.monotonic()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                if time.monotonic() - self._last_snapshot >= self.snapshot_interval:
+                    self.snapshot()
+                else:
+                    self.flush()
+            except Exception as e:
+                print(f"Erreur de persistance de l'état IDS: {str(e)}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ids-state", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Arrête le thread d'écriture et vide le dernier lot sur disque"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.wal is not None:
+            # Arrêt propre: un instantané complet évite de rejouer le journal au redémarrage
+            self.snapshot()
+            self.wal.close()
+            self.wal = None
+
+# Stockage en colonnes des lectures capteurs. En mémoire, chaque série (nœud, capteur)
+# garde ses dernières lectures dans deux tableaux circulaires et l'agrégat en cours
+# de chaque résolution. Sur disque, chaque table ("raw" et une par résolution) est
+# découpée en segments de temps, chacun formé de fichiers d'une seule colonne (valeurs
+# binaires brutes) complétés par lots depuis un thread dédié. Un segment terminé est
+# réécrit trié par série, avec un index (série, première ligne, nombre): une requête ne
+# lit que les segments de sa plage, les lignes de sa série et les colonnes demandées.
+# Les segments sortis de la rétention de leur table sont supprimés.
+TSDB_COLUMNS_RAW = (("series", "I"), ("time", "d"), ("value", "d"))
+TSDB_COLUMNS_ROLLUP = (("series", "I"), ("time", "d"), ("min", "d"), ("mean", "d"), ("max", "d"), ("count", "I"))
+TSDB_BUCKET = 5  # Agrégat en cours: début, min, max, somme, nombre
+
+class TimeSeries:
+    __slots__ = ('index', 'dev_id', 'sensor_id', 'sensor_type', 'units', 'times', 'values', 'pos', 'count',
+                 'buckets')
+
+    def __init__(self, index, dev_id, sensor_id, sensor_type, units, ring_size, rollups):
+        self.index = index
+        self.dev_id = dev_id
+        self.sensor_id = sensor_id
+        self.sensor_type = sensor_type
+        self.units = units
+        self.times = array('d', bytes(8 * ring_size))
+        self.values = array('d', bytes(8 * ring_size))
+        self.pos = 0
+        self.count = 0
+        self.buckets = array('d', bytes(8 * TSDB_BUCKET * rollups))
+
+    def push(self, timestamp, value):
+        pos = self.pos
+        self.times[pos] = timestamp
+        self.values[pos] = value
+        self.pos = (pos + 1) % len(self.times)
+        if self.count < len(self.times):
+            self.count += 1
+
+    def latest(self):
+        """(horodatage, valeur) de la dernière lecture, None si aucune"""
+        if not self.count:
+            return None
+        last = (self.pos - 1) % len(self.times)
+        return self.times[last], self.values[last]
+
+    def recent(self):
+        """Lectures conservées en mémoire, de la plus ancienne à la plus récente"""
+        size = len(self.times)
+        start = (self.pos - self.count) % size
+        return [(self.times[(start + i) % size], self.values[(start + i) % size]) for i in range(self.count)]
+
+class TimeSeriesStore:
+    def __init__(self, directory=TSDB_DIR, ring_size=TSDB_RING_SIZE, flush_interval=TSDB_FLUSH_INTERVAL,
+                 rollups=TSDB_ROLLUPS, segment=TSDB_SEGMENT, retention=TSDB_RETENTION):
+        self.directory = directory
+        self.ring_size = ring_size
+        self.flush_interval = flush_interval
+        self.rollups = tuple(rollups)
+        self.tables = {"raw": TSDB_COLUMNS_RAW}
+        self.tables.update((name, TSDB_COLUMNS_ROLLUP) for name, _ in self.rollups)
+        self.spans = {"raw": segment}  # Durée couverte par un segment de chaque table
+        self.spans.update((name, width * TSDB_SEGMENT_BUCKETS) for name, width in self.rollups)
+        self.retention = dict(retention or {})
+        self.segments = {table: {} for table in self.tables}  # table -> {numéro: lignes triées et indexées}
+        self.max_time = float("-inf")  # Horodatage le plus récent écrit (référence de la rétention)
+        self._unsorted = set()  # (table, numéro) des segments ayant des lignes hors index
+        self._indexes = {}      # (table, numéro) -> (séries, premières lignes, nombres) triés par série
+        self.series = {}      # (dev_id, sensor_id) -> TimeSeries
+        self.by_index = []
+        self.by_device = {}   # dev_id -> [TimeSeries]
+        self.readings = 0
+        self._new_series = []
+        self._pending = self._empty_batch()
+        self._lock = threading.Lock()        # Séries et lot en attente
+        self._write_lock = threading.Lock()  # Écriture des fichiers
+        self._files = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _empty_batch(self):
+        return {table: tuple(array(code) for _, code in columns) for table, columns in self.tables.items()}
+
+    def _segment_path(self, table, number, name=None):
+        directory = os.path.join(self.directory, table, str(number))
+        return directory if name is None else os.path.join(directory, name)
+
+    def _segment_rows(self, table, number):
+        """Nombre de lignes complètes d'un segment (la colonne la plus courte)"""
+        return min(os.path.getsize(path) // array(code).itemsize if os.path.exists(path) else 0
+                   for path, code in ((self._segment_path(table, number, column), code)
+                                      for column, code in self.tables[table]))
+
+    def load(self):
+        """Recharge le catalogue des séries et les segments (colonnes tronquées à un nombre de lignes commun)"""
+        os.makedirs(self.directory, exist_ok=True)
+        catalog = os.path.join(self.directory, "series.jsonl")
+        if os.path.exists(catalog):
+            with open(catalog, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        index, dev_id, sensor_id, sensor_type, units = json.loads(line)
+                    except ValueError:
+                        break  # Ligne tronquée par un arrêt brutal
+                    self._create(dev_id, sensor_id, sensor_type, units, index)
+        for table, columns in self.tables.items():
+            root = os.path.join(self.directory, table)
+            if not os.path.isdir(root):
+                continue
+            # Tri d'un segment interrompu: l'ancienne version reste la bonne
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                if name.endswith(".old"):
+                    if os.path.isdir(path[:-4]):
+                        shutil.rmtree(path)
+                    else:
+                        os.replace(path, path[:-4])
+            for name in os.listdir(root):
+                if name.endswith(".tmp"):
+                    shutil.rmtree(os.path.join(root, name))
+                    continue
+                try:
+                    number = int(name)
+                except ValueError:
+                    continue
+                rows = self._segment_rows(table, number)
+                for column, code in columns:
+                    path = self._segment_path(table, number, column)
+                    if os.path.exists(path) and os.path.getsize(path) != rows * array(code).itemsize:
+                        os.truncate(path, rows * array(code).itemsize)
+                indexed = sum(self._index(table, number)[2])
+                if indexed > rows:
+                    self._indexes[(table, number)] = (array('I'), array('I'), array('I'))
+                    indexed = 0
+                self.segments[table][number] = indexed
+                if rows > indexed:
+                    self._unsorted.add((table, number))
+                self.max_time = max(self.max_time, number * self.spans[table])
+        return len(self.by_index)
+
+    def _create(self, dev_id, sensor_id, sensor_type, units, index=None):
+        if index is None:
+            index = len(self.by_index)
+            self._new_series.append(index)
+        series = TimeSeries(index, dev_id, sensor_id, sensor_type, units, self.ring_size, len(self.rollups))
+        self.series[(dev_id, sensor_id)] = series
+        self.by_index.append(series)
+        self.by_device.setdefault(dev_id, []).append(series)
+        return series
+
+    def append(self, dev_id, timestamp, readings):
+        """Ajoute les lectures [(sensor_id, type, valeur, unités)] d'une trame"""
+        persist = self.directory is not None
+        rollups = self.rollups
+        with self._lock:
+            raw_series, raw_time, raw_value = self._pending["raw"]
+            for sensor_id, sensor_type, value, units in readings:
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                series = self.series.get((dev_id, sensor_id or sensor_type))
+                if series is None:
+                    series = self._create(dev_id, sensor_id or sensor_type, sensor_type, units)
+                series.push(timestamp, value)
+                self.readings += 1
+                if not persist:
+                    continue
+                raw_series.append(series.index)
+                raw_time.append(timestamp)
+                raw_value.append(value)
+
+                buckets = series.buckets
+                for r in range(len(rollups)):
+                    o = r * TSDB_BUCKET
+                    width = rollups[r][1]
+                    start = timestamp - timestamp % width
+                    if buckets[o + 4] and buckets[o] != start:
+                        self._close_bucket(series, r)
+                    if buckets[o + 4]:
+                        if value < buckets[o + 1]:
+                            buckets[o + 1] = value
+                        elif value > buckets[o + 2]:
+                            buckets[o + 2] = value
+                        buckets[o + 3] += value
+                        buckets[o + 4] += 1
+                    else:
+                        buckets[o] = start
+                        buckets[o + 1] = buckets[o + 2] = buckets[o + 3] = value
+                        buckets[o + 4] = 1
+
+    def _close_bucket(self, series, r):
+        """Place l'agrégat en cours d'une résolution dans le lot à écrire"""
+        buckets = series.buckets
+        o = r * TSDB_BUCKET
+        count = buckets[o + 4]
+        columns = self._pending[self.rollups[r][0]]
+        for column, value in zip(columns, (series.index, buckets[o], buckets[o + 1], buckets[o + 3] / count,
+                                           buckets[o + 2], int(count))):
+            column.append(value)
+        buckets[o + 4] = 0
+
+    def flush(self, close_buckets=False):
+        """Écrit les séries nouvelles et les lignes en attente; retourne le nombre de lignes brutes"""
+        if self.directory is None:
+            return 0
+        with self._write_lock:
+            with self._lock:
+                if close_buckets:
+                    for series in self.by_index:
+                        for r in range(len(self.rollups)):
+                            if series.buckets[r * TSDB_BUCKET + 4]:
+                                self._close_bucket(series, r)
+                batch, self._pending = self._pending, self._empty_batch()
+                new_series, self._new_series = self._new_series, []
+                catalog = [self.by_index[i] for i in new_series]
+            # Le catalogue d'abord: une ligne écrite ne référence jamais une série inconnue
+            if catalog:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(os.path.join(self.directory, "series.jsonl"), "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps([s.index, s.dev_id, s.sensor_id, s.sensor_type, s.units]) + "\n"
+                                 for s in catalog)
+            for table, columns in batch.items():
+                if not columns[0]:
+                    continue
+                span = self.spans[table]
+                times = columns[1]
+                first, last = int(min(times) // span), int(max(times) // span)
+                self.max_time = max(self.max_time, max(times))
+                if first == last:
+                    self._write_segment(table, first, columns)
+                    continue
+                # Lot à cheval sur plusieurs segments: répartition des lignes
+                rows = {}
+                for i, timestamp in enumerate(times):
+                    rows.setdefault(int(timestamp // span), []).append(i)
+                for number, selected in rows.items():
+                    self._write_segment(table, number, tuple(array(column.typecode, (column[i] for i in selected))
+                                                             for column in columns))
+            self._compact()
+            return len(batch["raw"][0])
+
+    def _write_segment(self, table, number, columns):
+        """Ajoute des lignes à la fin d'un segment (hors index jusqu'au prochain tri)"""
+        for (column, _), values in zip(self.tables[table], columns):
+            f = self._files.get((table, number, column))
+            if f is None:
+                os.makedirs(self._segment_path(table, number), exist_ok=True)
+                f = self._files[(table, number, column)] = open(self._segment_path(table, number, column), "ab")
+            values.tofile(f)
+            f.flush()
+        self.segments[table].setdefault(number, 0)
+        self._unsorted.add((table, number))
+
+    def _close_segment(self, table, number):
+        for column, _ in self.tables[table]:
+            f = self._files.pop((table, number, column), None)
+            if f is not None:
+                f.close()
+
+    def _compact(self):
+        """Trie les segments terminés et supprime ceux sortis de la rétention (appelé sous _write_lock)"""
+        for table, segments in self.segments.items():
+            span = self.spans[table]
+            retention = self.retention.get(table)
+            for number in sorted(segments):
+                end = (number + 1) * span
+                if retention is not None and end <= self.max_time - retention:
+                    self._close_segment(table, number)
+                    shutil.rmtree(self._segment_path(table, number), ignore_errors=True)
+                    del segments[number]
+                    self._unsorted.discard((table, number))
+                    self._indexes.pop((table, number), None)
+                elif (table, number) in self._unsorted and end <= self.max_time:
+                    self._sort_segment(table, number)
+
+    def _sort_segment(self, table, number):
+        """Réécrit un segment trié par (série, horodatage) et son index, puis remplace l'ancien"""
+        self._close_segment(table, number)
+        rows = self._segment_rows(table, number)
+        columns = [self._read_rows(table, number, column, 0, rows) for column, _ in self.tables[table]]
+        if np is not None:
+            order = np.lexsort((columns[1], columns[0]))
+            columns = [column[order] for column in columns]
+            ids, firsts, counts = np.unique(columns[0], return_index=True, return_counts=True)
+            index = (array('I', ids.tolist()), array('I', firsts.tolist()), array('I', counts.tolist()))
+        else:
+            order = sorted(range(rows), key=lambda i: (columns[0][i], columns[1][i]))
+            columns = [array(column.typecode, (column[i] for i in order)) for column in columns]
+            index = (array('I'), array('I'), array('I'))
+            for row, series_id in enumerate(columns[0]):
+                if not index[0] or index[0][-1] != series_id:
+                    index[0].append(series_id)
+                    index[1].append(row)
+                    index[2].append(0)
+                index[2][-1] += 1
+        directory = self._segment_path(table, number)
+        if os.path.isdir(directory + ".tmp"):
+            shutil.rmtree(directory + ".tmp")
+        os.makedirs(directory + ".tmp")
+        for (column, _), values in zip(self.tables[table], columns):
+            with open(os.path.join(directory + ".tmp", column), "wb") as f:
+                values.tofile(f)
+        with open(os.path.join(directory + ".tmp", "index"), "wb") as f:
+            for entries in index:
+                entries.tofile(f)
+        os.replace(directory, directory + ".old")
+        os.replace(directory + ".tmp", directory)
+        shutil.rmtree(directory + ".old")
+        self.segments[table][number] = rows
+        self._indexes[(table, number)] = index
+        self._unsorted.discard((table, number))
+
+    def _index(self, table, number):
+        """Index d'un segment trié: (séries, premières lignes, nombres), vide si non trié"""
+        index = self._indexes.get((table, number))
+        if index is None:
+            entries = array('I')
+            path = self._segment_path(table, number, "index")
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    entries.frombytes(f.read())
+            size = len(entries) // 3
+            index = self._indexes[(table, number)] = (entries[:size], entries[size:2 * size],
+                                                      entries[2 * size:3 * size])
+        return index
+
+    def _lookup(self, table, number, series_index):
+        """(première ligne, nombre) de la série dans la partie triée d'un segment, None si absente"""
+        ids, firsts, counts = self._index(table, number)
+        position = bisect.bisect_left(ids, series_index)
+        if position < len(ids) and ids[position] == series_index:
+            return firsts[position], counts[position]
+        return None
+
+    def _read_rows(self, table, number, column, first, count):
+        """Lit count lignes d'une colonne d'un segment à partir de first (NumPy si disponible)"""
+        code = dict(self.tables[table])[column]
+        path = self._segment_path(table, number, column)
+        if np is not None:
+            dtype = np.dtype(code)
+            return np.fromfile(path, dtype=dtype, count=count, offset=first * dtype.itemsize) if count \
+                else np.zeros(0, dtype=dtype)
+        values = array(code)
+        if count:
+            with open(path, "rb") as f:
+                f.seek(first * values.itemsize)
+                values.fromfile(f, count)
+        return values
+
+    def latest(self, dev_id, sensor_id=None):
+        """Dernière lecture d'un capteur, ou de tous les capteurs du nœud ({sensor_id: (horodatage, valeur)})"""
+        if sensor_id is not None:
+            series = self.series.get((dev_id, sensor_id))
+            return series.latest() if series is not None else None
+        return {s.sensor_id: s.latest() for s in list(self.by_device.get(dev_id, ())) if s.count}
+
+    def points(self, dev_id, sensor_id, start=None, end=None, resolution="raw", fields=("value",)):
+        """Lignes [(horodatage, champs...)] d'une série sur [start, end[ à la résolution demandée"""
+        series = self.series.get((dev_id, sensor_id))
+        if series is None:
+            return []
+        if resolution not in self.tables:
+            raise ValueError(f"Résolution inconnue: {resolution}")
+        low = float("-inf") if start is None else start
+        high = float("inf") if end is None else end
+        if self.directory is None:
+            if resolution != "raw":
+                raise ValueError("Les agrégats nécessitent un répertoire de stockage (TSDB_DIR)")
+            return [point for point in series.recent() if low <= point[0] < high]
+        self.flush()
+        span = self.spans[resolution]
+        rows = []
+        with self._write_lock:
+            for number in sorted(self.segments[resolution]):
+                if (number + 1) * span <= low or number * span >= high:
+                    continue
+                # Lignes de la série dans la partie indexée, puis lignes ajoutées depuis le tri
+                indexed = self.segments[resolution][number]
+                ranges = [self._lookup(resolution, number, series.index)] if indexed else []
+                if (resolution, number) in self._unsorted:
+                    ranges.append((indexed, self._segment_rows(resolution, number) - indexed))
+                for first, count in filter(None, ranges):
+                    columns = {name: self._read_rows(resolution, number, name, first, count)
+                               for name in ("series", "time") + tuple(fields)}
+                    rows.extend(self._select(columns, series.index, low, high, fields))
+        if resolution != "raw":
+            # Agrégats en cours, pas encore écrits
+            r = [name for name, _ in self.rollups].index(resolution)
+            buckets = series.buckets
+            o = r * TSDB_BUCKET
+            if buckets[o + 4] and low <= buckets[o] < high:
+                current = {"min": buckets[o + 1], "mean": buckets[o + 3] / buckets[o + 4], "max": buckets[o + 2],
+                           "count": int(buckets[o + 4]), "series": series.index}
+                rows.append((buckets[o],) + tuple(current[name] for name in fields))
+        return rows
+
+    @staticmethod
+    def _select(columns, index, low, high, fields):
+        """Lignes (horodatage, champs...) de la série index sur [low, high["""
+        if np is not None:
+            mask = (columns["series"] == index) & (columns["time"] >= low) & (columns["time"] < high)
+            return list(zip(columns["time"][mask].tolist(), *(columns[name][mask].tolist() for name in fields)))
+        return [row[1:] for row in zip(columns["series"], columns["time"], *(columns[name] for name in fields))
+                if row[0] == index and low <= row[1] < high]
+
+    def query(self, dev_id, sensor_id, start=None, end=None, resolution="raw"):
+        """Agrégat {count, min, mean, max} d'une série sur [start, end[, None si aucune lecture"""
+        if resolution == "raw":
+            rows = self.points(dev_id, sensor_id, start, end)
+            if not rows:
+                return None
+            values = [row[1] for row in rows]
+            return {"count": len(values), "min": min(values), "mean": sum(values) / len(values), "max": max(values)}
+        rows = self.points(dev_id, sensor_id, start, end, resolution, ("min", "mean", "max", "count"))
+        if not rows:
+            return None
+        count = sum(row[4] for row in rows)
+        return {"count": count, "min": min(row[1] for row in rows),
+                "mean": sum(row[2] * row[4] for row in rows) / count, "max": max(row[3] for row in rows)}
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Erreur d'écriture des séries temporelles: {str(e)}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="timeseries", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Arrête le thread d'écriture, écrit les agrégats en cours et ferme les colonnes"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush(close_buckets=True)
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+# Extraction rapide du dev_id sans décoder tout le JSON (utilisée pour le sharding)
+DEV_ID_PATTERN = re.compile(rb'"dev_id"\s*:\s*"([^"]*)"')
+
+def frame_dev_id(raw):
+    """dev_id d'un message brut (octets, b"" si absent), identique à celui du décodage JSON
+
+    L'expression régulière suffit pour un message sans échappement et avec une seule clé
+    "dev_id". Sinon (clé répétée ou aussi présente dans un objet imbriqué, échappement
+    \\u006e...), le message est décodé: un nœud ne doit jamais être confié à un autre
+    worker que son propriétaire.
+    """
+    if b"\\" not in raw and raw.count(b'"dev_id"') == 1:
+        match = DEV_ID_PATTERN.search(raw)
+        return match.group(1) if match else b""
+    try:
+        dev_id = json_loads(raw).get('dev_id')
+        return dev_id.encode() if isinstance(dev_id, str) else b""
+    except Exception:
+        return b""
+
+# File d'ingestion bornée avec pool de workers partitionné par dev_id
+class IngestPipeline:
+    BACKPRESSURE_POLICIES = ("block", "drop_oldest", "drop_new")
+
+    def __init__(self, handler, num_workers=INGEST_WORKERS, queue_size=INGEST_QUEUE_SIZE,
+                 backpressure=INGEST_BACKPRESSURE, tick=None, tick_interval=INGEST_TICK):
+        if backpressure not in self.BACKPRESSURE_POLICIES:
+            raise ValueError(f"Politique de contre-pression inconnue: {backpressure}")
+        # handler(raw, shard) traite un message, tick(shard) les traitements différés du shard
+        self.handler = handler
+        self.tick = tick
+        self.tick_interval = tick_interval
+        self.num_workers = max(1, num_workers)
+        self.backpressure = backpressure
+        # Une file par worker: tous les messages d'un même nœud passent par le même
+        # worker, ce qui préserve l'ordre des compteurs de trames
+        shard_size = max(1, queue_size // self.num_workers)
+        self.queues = [queue.Queue(maxsize=shard_size) for _ in range(self.num_workers)]
+        self.workers = []
+        self.stats = {'enqueued': 0, 'processed': 0, 'dropped_new': 0, 'dropped_oldest': 0, 'errors': 0}
+        self._stats_lock = threading.Lock()
+
+    def shard_for(self, dev_id):
+        """Retourne l'indice du worker responsable d'un nœud"""
+        if not dev_id:
+            return 0
+        return zlib.crc32(dev_id) % self.num_workers
+
+    def submit(self, raw):
+        """Place un message brut dans la file de son shard selon la politique de contre-pression"""
+        shard = self.queues[self.shard_for(frame_dev_id(raw))]
+
+        if self.backpressure == "block":
+            shard.put(raw)
+        elif self.backpressure == "drop_new":
+            try:
+                shard.put_nowait(raw)
+            except queue.Full:
+                self._count('dropped_new')
+                return False
+        else:
+            while True:
+                try:
+                    shard.put_nowait(raw)
+                    break
+                except queue.Full:
+                    # Éjecter le message le plus ancien pour faire de la place
+                    try:
+                        shard.get_nowait()
+                        shard.task_done()
+                        self._count('dropped_oldest')
+                    except queue.Empty:
+                        pass
+        self._count('enqueued')
+        return True
+
+    def depth(self):
+        """Nombre total de messages en attente dans les files"""
+        return sum(q.qsize() for q in self.queues)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['depth'] = self.depth()
+        stats['shard_depths'] = [q.qsize() for q in self.queues]
+        return stats
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _run_tick(self, index):
+        try:
+            self.tick(index)
+        except Exception as e:
+            self._count('errors')
+            print(f"Erreur dans le worker d'ingestion: {str(e)}")
+
+    def _worker(self, index, shard):
+        while True:
+            try:
+                raw = shard.get(timeout=self.tick_interval) if self.tick else shard.get()
+            except queue.Empty:
+                self._run_tick(index)
+                continue
+            try:
+                if raw is None:
+                    return
+                self.handler(raw, index)
+                self._count('processed')
+            except Exception as e:
+                self._count('errors')
+                print(f"Erreur dans le worker d'ingestion: {str(e)}")
+            finally:
+                shard.task_done()
+            if self.tick:
+                self._run_tick(index)
+
+    def start(self):
+        for i, shard in enumerate(self.queues):
+            worker = threading.Thread(target=self._worker, args=(i, shard), name=f"ingest-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def join(self):
+        """Attend que tous les messages en file soient traités"""
+        for shard in self.queues:
+            shard.join()
+
+    def stop(self):
+        for shard in self.queues:
+            shard.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+# Seaux à jetons indexés par clé (dev_id ou passerelle). Un seau redevenu plein
+# est équivalent à un seau absent: il est supprimé lors des purges. Si la table
+# est pleine malgré la purge, les nouvelles clés partagent un seau de débordement.
+class RateLimiter:
+    __slots__ = ('rate', 'burst', 'max_entries', 'buckets', 'overflow', 'refill_time', 'purged_at')
+
+    def __init__(self, rate, burst, max_entries=ADMISSION_MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_entries = max_entries
+        self.buckets = {}                   # clé -> [jetons, dernière mise à jour]
+        self.overflow = [float(burst), 0.0]
+        self.refill_time = burst / rate     # Durée au bout de laquelle un seau est de nouveau plein
+        self.purged_at = 0.0
+
+    def purge(self, now):
+        """Supprime les seaux redevenus pleins"""
+        self.purged_at = now
+        cutoff = now - self.refill_time
+        buckets = self.buckets
+        for key in [key for key, bucket in buckets.items() if bucket[1] <= cutoff]:
+            del buckets[key]
+
+    def _bucket(self, key, now):
+        """Seau de key, ou None s'il n'existe pas encore et peut être créé plein"""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            # Purge au plus une fois par durée de remplissage (la purge parcourt toute la table)
+            if len(self.buckets) >= self.max_entries and now - self.purged_at >= self.refill_time:
+                self.purge(now)
+            if len(self.buckets) < self.max_entries:
+                return None
+            bucket = self.overflow
+        return bucket
+
+    def available(self, key, now):
+        """True si le seau de key contient au moins un jeton (sans le retirer)"""
+        bucket = self._bucket(key, now)
+        return bucket is None or bucket[0] + (now - bucket[1]) * self.rate >= 1.0
+
+    def take(self, key, now):
+        """Retire un jeton du seau de key: False si le seau est vide"""
+        bucket = self._bucket(key, now)
+        if bucket is None:
+            self.buckets[key] = [self.burst - 1.0, now]
+            return True
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        bucket[1] = now
+        if tokens < 1.0:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1.0
+        return True
+
+# Contrôle d'admission placé devant la déduplication: les trames mal formées, sans
+# passerelle, de nœuds non provisionnés ou au-delà du débit autorisé sont écartées
+# avant l'IDS. Les trames authentiques (MIC valide) et nouvelles (compteur pas encore
+# reçu) ne sont débitées que du seau de leur nœud. Les autres (MIC invalide, rejeu)
+# ne relèvent que du seau de leur passerelle: des trames forgées ou rejouées ne
+# peuvent épuiser ni le débit d'un nœud, ni celui d'une passerelle dont elles
+# usurpent l'identifiant pour le trafic légitime qu'elle relaie.
+# Une instance par shard: le débit par passerelle est réparti entre les shards, sans verrou.
+class AdmissionControl:
+    def __init__(self, ids, device_rate=DEVICE_RATE, device_burst=DEVICE_BURST,
+                 gateway_rate=GATEWAY_RATE, gateway_burst=GATEWAY_BURST, max_buckets=ADMISSION_MAX_BUCKETS):
+        self.ids = ids  # Fournit les nœuds provisionnés (provisioned_devices) et le MIC (authenticate)
+        self.devices = RateLimiter(device_rate, device_burst, max_buckets) if device_rate else None
+        self.gateways = RateLimiter(gateway_rate, gateway_burst, max_buckets) if gateway_rate else None
+        self.stats = {'admitted': 0, 'incomplete': 0, 'no_gateway': 0, 'unprovisioned': 0,
+                      'device_rate': 0, 'gateway_rate': 0}
+
+    def check(self, frame, now):
+        """Retourne None si la trame est admise, sinon la raison du rejet"""
+        message = frame.message
+        dev_id = message.get('dev_id')
+        if not dev_id or message.get('counter') is None or not message.get('payload_raw'):
+            return 'incomplete'
+        gateways = frame.gateways
+        if not gateways:
+            return 'no_gateway'
+        provisioned = self.ids.provisioned_devices
+        if provisioned is not None and dev_id not in provisioned:
+            return 'unprovisioned'
+        devices = self.devices
+        limiter = self.gateways
+        if devices is None and limiter is None:
+            return None
+        if self.ids.authenticate(frame) and self.ids.is_fresh(dev_id, message['counter']):
+            if devices is not None and not devices.take(dev_id, now):
+                return 'device_rate'
+            return None
+        if limiter is not None:
+            # Toutes les passerelles sont consultées avant d'en débiter une: une trame rejetée ne coûte rien
+            gateway_ids = [gateway.get('gtw_id') for gateway in gateways]
+            for gateway_id in gateway_ids:
+                if not limiter.available(gateway_id, now):
+                    return 'gateway_rate'
+            for gateway_id in gateway_ids:
+                limiter.take(gateway_id, now)
+        return None
+
+    def admit(self, frame, now):
+        """Comme check, en comptant les trames admises et les rejets par raison"""
+        reason = self.check(frame, now)
+        self.stats['admitted' if reason is None else reason] += 1
+        return reason
+
+# Rejets d'admission signalés comme message invalide (les autres ne sont que comptés)
+ADMISSION_MALFORMED = {
+    'incomplete': 'Message incomplet',
+    'no_gateway': 'Aucune passerelle dans les métadonnées',
+}
+
+# Étage de déduplication placé devant l'IDS: les copies d'une même trame reçues
+# via plusieurs passerelles (clé dev_id, compteur, payload) sont retenues pendant
+# DEDUP_WINDOW puis fusionnées en une seule trame, avec la liste des passerelles
+# triée par RSSI décroissant. Une copie arrivée après l'émission, ou relayée par
+# une passerelle qui a déjà relayé la trame (rejeu immédiat), n'est pas fusionnée:
+# elle est transmise telle quelle à l'IDS, après la trame, et c'est lui qui
+# distingue un doublon tardif d'un rejeu.
+# L'index expire en ordre FIFO, sa taille est bornée.
+class UplinkDeduplicator:
+    def __init__(self, window=DEDUP_WINDOW, retention=DEDUP_RETENTION, max_entries=DEDUP_MAX_ENTRIES):
+        self.window = window
+        self.retention = max(retention, window)
+        self.max_entries = max_entries
+        self.entries = {}        # clé -> trame en attente, ou None une fois émise
+        self.pending = deque()   # (échéance d'émission, clé)
+        self.emitted = deque()   # (fin de rétention, clé)
+        self.late = []           # Copies arrivées après l'émission, à analyser au prochain flush
+        self.repeats = {}        # clé -> copies d'une trame en attente relayées par une même passerelle
+        self.stats = {'frames': 0, 'merged': 0, 'late': 0, 'repeated': 0}
+
+    @staticmethod
+    def frame_key(frame):
+        message = frame.message
+        dev_id = message.get('dev_id')
+        counter = message.get('counter')
+        payload_raw = message.get('payload_raw')
+        if not dev_id or counter is None or not payload_raw:
+            return None
+        return (dev_id, counter, payload_raw)
+
+    @staticmethod
+    def signal_key(gateway):
+        """Clé de tri d'une passerelle: RSSI puis SNR, une mesure absente (ou null) passant en dernier"""
+        rssi = gateway.get('rssi')
+        snr = gateway.get('snr')
+        return (-1000 if rssi is None else rssi, -1000 if snr is None else snr)
+
+    @classmethod
+    def merge_gateways(cls, target, gateways):
+        """Fusionne les passerelles d'une copie: une entrée par passerelle, la meilleure d'abord"""
+        merged = {}
+        for gateway in target + gateways:
+            gateway_id = gateway.get('gtw_id')
+            best = merged.get(gateway_id)
+            if best is None or cls.signal_key(gateway)[0] > cls.signal_key(best)[0]:
+                merged[gateway_id] = gateway
+        target[:] = sorted(merged.values(), key=cls.signal_key, reverse=True)
+
+    def add(self, frame, now):
+        """Ajoute une trame: True si nouvelle, False si copie d'une trame connue, None si incomplète.
+        Une copie tardive (trame déjà émise) est rendue par le flush suivant."""
+        frame = Frame.wrap(frame)
+        key = self.frame_key(frame)
+        if key is None:
+            return None
+        if key in self.entries:
+            held = self.entries[key]
+            if held is None:
+                self.stats['late'] += 1
+                self.late.append(frame)
+                return False
+            target = held.message.setdefault('metadata', {}).setdefault('gateways', [])
+            relayed = {gateway.get('gtw_id') for gateway in target}
+            if any(gateway.get('gtw_id') in relayed for gateway in frame.gateways):
+                # Une passerelle ne relaie pas deux fois la même trame: émise après elle, l'IDS la jugera
+                self.stats['repeated'] += 1
+                self.repeats.setdefault(key, []).append(frame)
+            else:
+                self.stats['merged'] += 1
+                self.merge_gateways(target, frame.gateways)
+            return False
+        self.stats['frames'] += 1
+        self.entries[key] = frame
+        self.pending.append((now + self.window, key))
+        return True
+
+    def flush(self, now, force=False):
+        """Retourne les trames dont la fenêtre de déduplication est écoulée"""
+        entries = self.entries
+        emitted = self.emitted
+        while emitted and (emitted[0][0] <= now or len(entries) > self.max_entries):
+            _, key = emitted.popleft()
+            del entries[key]
+        ready = []
+        pending = self.pending
+        # Trop de trames en attente: émission anticipée des plus anciennes
+        while pending and (force or pending[0][0] <= now or len(pending) > self.max_entries):
+            _, key = pending.popleft()
+            ready.append(entries[key])
+            entries[key] = None
+            emitted.append((now + self.retention, key))
+            if key in self.repeats:
+                ready.extend(self.repeats.pop(key))
+        if self.late:
+            ready.extend(self.late)
+            self.late = []
+        return ready
+
+# Registre des codecs de capteurs: identifiant binaire -> décodeur de la valeur
+class SensorCodec:
+    __slots__ = ('sensor_type', 'id_prefix', 'units', 'value_format', 'scale', '_sensor_ids')
+
+    def __init__(self, sensor_type, id_prefix, units, value_format, scale):
+        self.sensor_type = sensor_type
+        self.id_prefix = id_prefix
+        self.units = units
+        self.value_format = struct.Struct(value_format)
+        self.scale = scale
+        self._sensor_ids = {}
+
+    def sensor_id(self, index):
+        """Identifiant texte du capteur (mis en cache pour éviter un formatage par lecture)"""
+        sensor_id = self._sensor_ids.get(index)
+        if sensor_id is None:
+            sensor_id = self._sensor_ids[index] = f"{self.id_prefix}_{index:03d}"
+        return sensor_id
+
+SENSOR_CODECS = {}
+
+def register_sensor_codec(type_id, sensor_type, id_prefix, units, value_format, scale):
+    """Déclare un type de capteur décodable dans les trames binaires"""
+    SENSOR_CODECS[type_id] = SensorCodec(sensor_type, id_prefix, units, value_format, scale)
+
+register_sensor_codec(1, "temperature", "temp", "°C", "<h", 100)
+register_sensor_codec(2, "soil_moisture", "humidity", "%", "<H", 100)
+register_sensor_codec(3, "light_intensity", "light", "lux", "<I", 100)
+register_sensor_codec(4, "pest_detection", "pest", "count", "<H", 100)
+
+def decode_binary_payload(data):
+    """Décode une trame binaire sans copie: retourne (horodatage, [(sensor_id, type, valeur, unités)])"""
+    view = memoryview(data)
+    version, timestamp, count = PAYLOAD_HEADER.unpack_from(view, 0)
+    if version != PAYLOAD_VERSION:
+        raise ValueError(f"Version de trame inconnue: {version}")
+    offset = PAYLOAD_HEADER.size
+    unpack_header = READING_HEADER.unpack_from
+    header_size = READING_HEADER.size
+    readings = []
+    for _ in range(count):
+        type_id, index = unpack_header(view, offset)
+        codec = SENSOR_CODECS.get(type_id)
+        if codec is None:
+            raise ValueError(f"Type de capteur inconnu: {type_id}")
+        value_format = codec.value_format
+        raw_value, = value_format.unpack_from(view, offset + header_size)
+        offset += header_size + value_format.size
+        readings.append((codec.sensor_id(index), codec.sensor_type, raw_value / codec.scale, codec.units))
+    return timestamp, readings
+
+def decode_sensor_payload(data):
+    """Décode les données capteurs, binaires ou au format JSON historique"""
+    if data and data[0] == PAYLOAD_VERSION:
+        return decode_binary_payload(data)
+    readings = [(r.get('sensor_id'), r['type'], r['value'], r['units']) for r in json_loads(bytes(data))]
+    return None, readings
+
 # Gestionnaire de messages MQTT
+def worker_path(path, worker):
+    """Chemin propre à un worker du mode cluster (ids_state -> ids_state.worker_0)"""
+    if path is None or worker is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.worker_{worker}{extension}"
+
 class LoRaWANServer:
-    def __init__(self):
+    def __init__(self, num_workers=INGEST_WORKERS, queue_size=INGEST_QUEUE_SIZE,
+                 backpressure=INGEST_BACKPRESSURE, worker=None, cluster_size=1):
+        # worker: numéro du processus en mode cluster (journaux, état et métriques séparés)
+        self.worker = worker
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.username_pw_set(MQTT_AUTH_USER, MQTT_AUTH_PASS)
         self.ids = LoRaWANIDS()
+        self.cipher = PayloadCipher(APP_KEY, DEVICE_KEYS)
+        # Les workers ne font qu'ajouter les événements à un tampon, écrit par lots en tâche de fond
+        self.events = EventSink(make_event_writer(EVENT_OUTPUTS, worker_path(EVENT_PATH, worker)),
+                                notifier=AlertNotifier())
+        self.ids.events = self.events
+        self.metrics = Metrics() if METRICS_ENABLED else None
+        self.ids.metrics = self.metrics
+        self.state_store = IDSStateStore(self.ids, worker_path(STATE_DIR, worker)) if STATE_DIR else None
+        self.timeseries = TimeSeriesStore(worker_path(TSDB_DIR, worker))
+        self.pipeline = IngestPipeline(self.handle_payload, num_workers, queue_size, backpressure,
+                                       tick=self.on_tick)
+        # Un dédoublonneur par shard: les copies d'une trame arrivent toutes au même worker
+        self.deduplicators = [UplinkDeduplicator() for _ in range(self.pipeline.num_workers)]
+        # Un contrôle d'admission par shard, le débit de chaque passerelle étant réparti entre eux
+        # (et entre les processus du cluster)
+        shards = self.pipeline.num_workers * cluster_size
+        self.admissions = [AdmissionControl(self.ids, DEVICE_RATE, DEVICE_BURST,
+                                            GATEWAY_RATE / shards if GATEWAY_RATE else None,
+                                            max(1.0, GATEWAY_BURST / shards))
+                           for _ in range(self.pipeline.num_workers)]
+        self.metrics_exporter = None
+        if self.metrics is not None:
+            self.metrics.gauges.update({
+                'lorawan_ingest_queue_depth': self.pipeline.depth,
+                'lorawan_known_nodes': lambda: len(self.ids.known_nodes),
+                'lorawan_quarantined_nodes': lambda: len(self.ids.known_nodes.quarantine),
+                'lorawan_node_table_hit_ratio': lambda: self.ids.known_nodes.get_stats()['hit_rate'],
+                'lorawan_gateway_rssi_average': lambda: {(('gateway', gid),): g.rssi_sum / g.rssi_count
+                                                         for gid, g in self.ids.gateways.items() if g.rssi_count},
+                'lorawan_gateway_active': lambda: {(('gateway', gid),): int(g.status(time.time()) == 'active')
+                                                   for gid, g in self.ids.gateways.items()},
+                'lorawan_timeseries_series': lambda: len(self.timeseries.by_index),
+                'lorawan_timeseries_readings': lambda: self.timeseries.readings,
+                'lorawan_admission_buckets': lambda: sum(len(limiter.buckets) for a in self.admissions
+                                                         for limiter in (a.devices, a.gateways) if limiter),
+            })
+            self.metrics.totals.update({
+                'lorawan_ingest_dropped_total': lambda: sum(self.pipeline.get_stats()[k]
+                                                            for k in ('dropped_new', 'dropped_oldest')),
+                'lorawan_dedup_merged_total': lambda: sum(d.stats['merged'] for d in self.deduplicators),
+                'lorawan_dedup_repeated_total': lambda: sum(d.stats['repeated'] for d in self.deduplicators),
+                'lorawan_node_evictions_total': lambda: sum(self.ids.known_nodes.stats[key] for key in
+                                                            ('evicted_lru', 'evicted_idle', 'quarantine_evicted',
+                                                             'quarantine_expired')),
+                'lorawan_gateway_frames_total': lambda: {(('gateway', gid),): g.frames
+                                                         for gid, g in self.ids.gateways.items()},
+                'lorawan_events_dropped_total': lambda: self.events.dropped,
+            })
+            port = METRICS_PORT
+            if port is not None and worker is not None:
+                port += 1 + worker  # Le port de base reste celui du processus de routage
+            self.metrics_exporter = MetricsExporter(self.metrics, port=port,
+                                                    dump_path=worker_path(METRICS_DUMP_PATH, worker))
         
     def on_connect(self, client, userdata, flags, rc):
         print(f"Connecté au broker MQTT avec code {rc}")
@@ -199,58 +3114,187 @@ class LoRaWANServer:
         print(f"Abonné au topic {MQTT_TOPIC}")
         
     def on_message(self, client, userdata, msg):
-        print(f"Message reçu sur {msg.topic}")
+        # Le thread réseau se contente de placer le message en file
+        self.pipeline.submit(msg.payload)
+
+    def handle_payload(self, raw, shard=0):
+        """Décode un message brut et le confie à l'étage de déduplication (exécuté par un worker)"""
+        events = self.events
+        if events.level <= DEBUG:
+            events.emit(DEBUG, 'message_received')
+        metrics = self.metrics
         try:
-            # Décodage du message JSON
-            payload = json.loads(msg.payload.decode())
+            # Décodage du message JSON, une seule fois pour tout le pipeline
+            if metrics is not None and metrics.shard().receive():
+                start = time.perf_counter()
+                frame = Frame.parse(raw)
+                metrics.shard().observe('json_decode', time.perf_counter() - start)
+            else:
+                frame = Frame.parse(raw)
+            
+            # Rejet précoce, avant la déduplication et tout décodage du payload
+            now = time.monotonic()
+            reason = self.admissions[shard].admit(frame, now)
+            if reason is not None:
+                if metrics is not None:
+                    metrics.shard().inc(('lorawan_admission_dropped_total', (('reason', reason),)))
+                if reason in ADMISSION_MALFORMED and events.level <= WARNING:
+                    events.emit(WARNING, 'invalid_message', dev_id=frame.message.get('dev_id'),
+                                reason=ADMISSION_MALFORMED[reason])
+                return
             
+            self.deduplicators[shard].add(frame, now)
+                
+        except json.JSONDecodeError:
+            if metrics is not None:
+                metrics.shard().inc(('lorawan_json_errors_total', ()))
+            events.emit(ERROR, 'json_error')
+        except Exception as e:
+            events.emit(ERROR, 'processing_error', error=str(e))
+    
+    def on_tick(self, shard):
+        """Traitements différés d'un shard (le premier surveille aussi le fichier des passerelles)"""
+        self.flush_duplicates(shard)
+        if shard == 0:
+            self.reload_gateways()
+
+    def reload_gateways(self):
+        """Relit la liste des passerelles autorisées si le fichier a changé"""
+        changes = self.ids.gateways.maybe_reload()
+        if changes is not None:
+            added, removed = changes
+            self.events.emit(INFO, 'gateways_reloaded', path=self.ids.gateways.path,
+                             added=", ".join(added) or "aucune", removed=", ".join(removed) or "aucune")
+        return changes
+
+    def flush_duplicates(self, shard, force=False):
+        """Analyse les trames du shard dont la fenêtre de déduplication est écoulée"""
+        frames = self.deduplicators[shard].flush(time.monotonic(), force)
+        if frames:
+            self.process_frames(frames)
+    
+    def process_message(self, frame):
+        """Analyse une trame dédoublonnée puis traite ses données si elle est valide"""
+        self.process_frames((frame,))
+
+    def process_frames(self, frames):
+        """Analyse des trames dédoublonnées puis traite les données de celles que l'IDS accepte"""
+        accepted = []
+        for frame in frames:
+            timed = self.analyze_frame(frame)
+            if timed is not None:
+                accepted.append((frame, timed))
+        if not accepted:
+            return
+        # Déchiffrement après l'IDS: une trame forgée ou rejouée ne coûte aucun calcul AES
+        self.cipher.decrypt_frames([frame for frame, _ in accepted])
+        counters = self.metrics.shard() if self.metrics is not None else None
+        for frame, timed in accepted:
+            if timed:
+                start = time.perf_counter()
+                self.process_valid_data(frame)
+                counters.observe('process_valid_data', time.perf_counter() - start)
+            else:
+                self.process_valid_data(frame)
+
+    def analyze_frame(self, frame):
+        """Analyse une trame par l'IDS et signale son rejet
+
+        Retourne None si la trame est rejetée, sinon True si le traitement de ses
+        données doit être chronométré (trame échantillonnée pour les latences).
+        """
+        counters = self.metrics.shard() if self.metrics is not None else None
+        timed = counters is not None and counters.analyze()
+        try:
             # Analyse via l'IDS
-            analysis = self.ids.analyze_message(payload)
+            if timed:
+                start = time.perf_counter()
+                analysis = self.ids.analyze_message(frame)
+                counters.observe('analyze', time.perf_counter() - start)
+            else:
+                analysis = self.ids.analyze_message(frame)
             
-            # Traitement des données en fonction de la validité
             if analysis.get('valid', False):
-                self.process_valid_data(payload)
-            else:
-                print(f"Message invalide: {analysis.get('reason', 'Raison inconnue')}")
-                if 'anomalies' in analysis and analysis['anomalies']:
-                    for anomaly in analysis['anomalies']:
-                        print(f"  - {anomaly['type']}: {anomaly['details']}")
+                if counters is not None:
+                    counters.valid += 1
+                return timed
+            if counters is not None:
+                counters.count_result(analysis)
+            if self.events.level <= WARNING:
+                self.events.emit(WARNING, 'invalid_message', dev_id=analysis.get('node_id'),
+                                 reason=analysis.get('reason', 'Raison inconnue'), anomalies=analysis.get('anomalies'))
                 
-        except json.JSONDecodeError:
-            print("Erreur de décodage JSON")
         except Exception as e:
-            print(f"Erreur de traitement du message: {str(e)}")
+            self.events.emit(ERROR, 'processing_error', error=str(e))
+        return None
     
     def process_valid_data(self, message):
-        """Traite les données valides des capteurs"""
+        """Traite les données valides des capteurs (dict ou Frame)"""
+        events = self.events
         try:
-            # Décodage du payload brut
-            decoded = base64.b64decode(message['payload_raw'])
-            
-            # Dans un cas réel, nous déchiffrerions avec l'app_key
-            # Ici on suppose que le format est JSON pour la simplicité
-            # (ce ne serait pas le cas dans LoRaWAN réel qui utilise des formats binaires optimisés)
-            data_part = decoded[:-4]  # Ignorer les 4 derniers octets (MIC simulé)
+            frame = Frame.wrap(message)
+            message = frame.message
             
+            # Trame chiffrée qui n'est pas passée par process_frames, ou dont le
+            # déchiffrement a échoué (compteur illisible, module cryptography absent)
+            if frame._plaintext is None and frame.encrypted and self.cipher.decrypt_frames((frame,)):
+                if self.metrics is not None:
+                    self.metrics.shard().inc(('lorawan_decrypt_errors_total', ()))
+                events.emit(WARNING, 'decrypt_error', dev_id=message.get('dev_id'), counter=message.get('counter'))
+                return
+            # Le format binaire compact est reconnu à son octet de version,
+            # sinon on retombe sur l'ancien format JSON
             try:
-                sensor_data = json.loads(data_part.decode())
-                print(f"Données de capteurs reçues du nœud {message['dev_id']}:")
-                for reading in sensor_data:
-                    print(f"  - {reading['type']}: {reading['value']} {reading['units']}")
-                
-                # Afficher les informations sur la passerelle
-                if message.get('metadata', {}).get('gateways'):
-                    gateway = message['metadata']['gateways'][0]
-                    print(f"  Passerelle: {gateway.get('gtw_id')} (RSSI: {gateway.get('rssi')} dBm, SNR: {gateway.get('snr')} dB)")
+                timestamp, readings = frame.readings
+                if self.timeseries is not None:
+                    # Le format JSON historique ne porte pas d'horodatage: heure de traitement
+                    self.timeseries.append(message['dev_id'], time.time() if timestamp is None else timestamp,
+                                           readings)
+                if events.level <= INFO:
+                    # Informations sur la passerelle de meilleure réception
+                    events.emit(INFO, 'sensor_data', dev_id=message['dev_id'], readings=readings,
+                                gateway=frame.gateways[0] if frame.gateways else None)
             except:
-                print("Format de données non-JSON, affichage brut:")
-                print(f"  Données: {data_part}")
+                events.emit(INFO, 'raw_data', dev_id=message.get('dev_id'), data=bytes(frame.body))
                 
         except Exception as e:
-            print(f"Erreur de traitement des données: {str(e)}")
+            events.emit(ERROR, 'data_error', error=str(e))
     
+    def open(self):
+        """Restaure l'état et démarre les tâches de fond (sans connexion au broker)"""
+        # Avant la restauration de l'état, qui complète les passerelles déclarées
+        if not self.cipher.available():
+            print("Module cryptography absent: les trames chiffrées ne pourront pas être déchiffrées")
+        if GATEWAYS_PATH:
+            self.ids.gateways.watch(GATEWAYS_PATH)
+            print(f"Passerelles autorisées: {', '.join(sorted(self.ids.gateways.gateways))}")
+        if self.state_store is not None:
+            restored = self.state_store.load()
+            print(f"État IDS restauré: {restored} nœuds depuis {self.state_store.directory}")
+            self.state_store.start()
+        if self.timeseries.directory is not None:
+            series = self.timeseries.load()
+            print(f"Séries temporelles: {series} séries dans {self.timeseries.directory}")
+            self.timeseries.start()
+        self.events.start()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.start()
+
+    def close(self):
+        """Analyse les trames encore retenues puis arrête les tâches de fond"""
+        for shard in range(self.pipeline.num_workers):
+            self.flush_duplicates(shard, force=True)
+        if self.state_store is not None:
+            self.state_store.close()
+        self.timeseries.close()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.close()
+        self.events.close()
+
     def start(self):
         try:
+            self.open()
+            self.pipeline.start()
             self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
             print(f"Démarrage du serveur LoRaWAN sur {MQTT_BROKER}:{MQTT_PORT}")
             self.client.loop_forever()
@@ -260,9 +3304,380 @@ class LoRaWANServer:
             print(f"Erreur de connexion: {str(e)}")
         finally:
             self.client.disconnect()
+            self.pipeline.stop()
+            self.close()
+            print("Serveur arrêté")
+
+# Mode cluster: un processus de routage reçoit les messages MQTT et les répartit
+# entre des processus workers, chacun propriétaire d'une partition des dev_id sur
+# un anneau de hachage cohérent. Tout l'état d'un nœud (anti-rejeu, historique,
+# déduplication) vit donc dans un seul processus. Quand un worker arrive ou part,
+# seuls les nœuds dont le propriétaire change sont transmis, au format des
+# enregistrements de IDSStateStore. Les abonnements partagés MQTT ($share/...)
+# répartissent les messages sans tenir compte du dev_id: ils ne conviendraient pas.
+class HashRing:
+    def __init__(self, members=(), vnodes=CLUSTER_VNODES):
+        self.members = tuple(sorted(members))
+        points = sorted((int.from_bytes(hashlib.blake2b(f"{member}#{i}".encode(), digest_size=4).digest(), "little"),
+                         member) for member in self.members for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [member for _, member in points]
+
+    def owner(self, key):
+        """Membre responsable d'une clé (bytes): premier point de l'anneau après son empreinte"""
+        if not self.owners:
+            return None
+        i = bisect.bisect(self.hashes, zlib.crc32(key))
+        return self.owners[i if i < len(self.owners) else 0]
+
+def export_foreign_nodes(store, ring, worker):
+    """Enregistrements des nœuds qui n'appartiennent plus à ce worker, groupés par nouveau propriétaire"""
+    foreign = {}
+    known_nodes = store.ids.known_nodes
+    # Les pierres tombales suivent leur nœud, pour qu'un rejeu reste détecté chez le nouveau propriétaire
+    for dev_id in [dev_id for dev_id, _ in known_nodes.items()] + list(known_nodes.tombstones):
+        owner = ring.owner(dev_id.encode())
+        if owner != worker:
+            foreign.setdefault(owner, []).append(dev_id)
+    return {owner: store.export_nodes(dev_ids) for owner, dev_ids in foreign.items()}
+
+def run_cluster_worker(worker, conn, members, inherited=()):
+    """Boucle d'un processus worker: lots de trames et commandes reçus du processus de routage"""
+    # L'arrêt est piloté par le processus de routage
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for other in inherited:
+        other.close()
+    # Un seul shard, traité par ce thread: le parallélisme vient des processus
+    server = LoRaWANServer(num_workers=1, worker=worker, cluster_size=len(members))
+    store = server.state_store or IDSStateStore(server.ids, directory=None)
+    server.open()
+    processed = 0
+    next_tick = time.monotonic() + INGEST_TICK
+    try:
+        while True:
+            if not conn.poll(max(0.0, next_tick - time.monotonic())):
+                server.on_tick(0)
+                next_tick = time.monotonic() + INGEST_TICK
+                continue
+            message = conn.recv()
+            kind = message[0]
+            if kind == "frames":
+                for raw in message[1]:
+                    server.handle_payload(raw, 0)
+                processed += len(message[1])
+            elif kind == "ring":
+                # Les trames retenues sont analysées avant de céder l'état de leurs nœuds
+                server.flush_duplicates(0, force=True)
+                conn.send(("handoff", export_foreign_nodes(store, HashRing(message[1]), worker), 0))
+            elif kind == "adopt":
+                adopted = store.adopt(message[1])
+                conn.send(("handoff", export_foreign_nodes(store, HashRing(message[2]), worker), adopted))
+            elif kind == "import":
+                conn.send(("imported", store.import_nodes(message[1])))
+            elif kind == "stats":
+                if message[1]:
+                    server.flush_duplicates(0, force=True)
+                counters = server.metrics.counters() if server.metrics is not None else {}
+                conn.send(("stats", {'worker': worker, 'pid': os.getpid(), 'processed': processed,
+                                     'known_nodes': len(server.ids.known_nodes), 'counters': counters}))
+            elif kind == "stop":
+                break
+            if time.monotonic() >= next_tick:
+                server.on_tick(0)
+                next_tick = time.monotonic() + INGEST_TICK
+    except EOFError:
+        pass  # Processus de routage disparu
+    finally:
+        server.close()
+    conn.send(("stopped", processed))
+
+class LoRaWANCluster:
+    def __init__(self, num_workers=CLUSTER_WORKERS, batch_size=CLUSTER_BATCH_SIZE, vnodes=CLUSTER_VNODES,
+                 flush_interval=CLUSTER_FLUSH_INTERVAL):
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_message = self.on_message
+        self.client.username_pw_set(MQTT_AUTH_USER, MQTT_AUTH_PASS)
+        # fork: les workers héritent de la configuration, même si le script a été chargé comme module
+        self.context = multiprocessing.get_context("fork")
+        self.num_workers = max(1, num_workers)
+        self.batch_size = batch_size
+        self.vnodes = vnodes
+        self.flush_interval = flush_interval
+        self.ring = HashRing((), vnodes)
+        self.workers = {}   # numéro -> (processus, connexion)
+        self.batches = {}   # numéro -> trames en attente d'envoi
+        self.routed = {}
+        self.next_worker = 0
+        self.stats = {'rebalances': 0, 'handed_off': 0, 'adopted': 0, 'lost_workers': 0}
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.metrics = Metrics() if METRICS_ENABLED else None
+        self.metrics_exporter = None
+        if self.metrics is not None:
+            self.metrics.gauges.update({
+                'lorawan_cluster_workers': lambda: len(self.workers),
+            })
+            self.metrics.totals.update({
+                'lorawan_cluster_routed_total': lambda: {(('worker', str(w)),): n for w, n in list(self.routed.items())},
+                'lorawan_cluster_rebalances_total': lambda: self.stats['rebalances'],
+                'lorawan_cluster_handed_off_nodes_total': lambda: self.stats['handed_off'],
+                'lorawan_cluster_lost_workers_total': lambda: self.stats['lost_workers'],
+            })
+            self.metrics_exporter = MetricsExporter(self.metrics, port=METRICS_PORT, dump_path=METRICS_DUMP_PATH)
+
+    def on_connect(self, client, userdata, flags, rc):
+        print(f"Connecté au broker MQTT avec code {rc}")
+        client.subscribe(MQTT_TOPIC)
+        print(f"Abonné au topic {MQTT_TOPIC}")
+
+    def on_message(self, client, userdata, msg):
+        self.route(msg.payload)
+
+    def route(self, raw):
+        """Ajoute un message brut au lot du worker propriétaire de son dev_id"""
+        dev_id = frame_dev_id(raw)
+        with self._lock:
+            worker = self.ring.owner(dev_id)
+            batch = self.batches[worker]
+            batch.append(raw)
+            if len(batch) >= self.batch_size:
+                self._send(worker)
+
+    def _send(self, worker):
+        batch = self.batches[worker]
+        self.batches[worker] = []
+        try:
+            self.workers[worker][1].send(("frames", batch))
+        except (OSError, EOFError):
+            # Worker disparu: son anneau est redistribué et le lot confié aux nouveaux propriétaires
+            self._lose(worker)
+            for raw in batch:
+                self.route(raw)
+            return
+        self.routed[worker] += len(batch)
+
+    def flush(self):
+        """Envoie les lots incomplets"""
+        with self._lock:
+            for worker in [w for w, batch in self.batches.items() if batch]:
+                if worker in self.batches:
+                    self._send(worker)
+
+    def _spawn(self, worker, members):
+        conn, child = self.context.Pipe()
+        inherited = [c for _, c in self.workers.values()]
+        process = self.context.Process(target=run_cluster_worker, args=(worker, child, members, inherited),
+                                       name=f"ids-worker-{worker}", daemon=True)
+        process.start()
+        child.close()
+        self.workers[worker] = (process, conn)
+        self.batches[worker] = []
+        self.routed[worker] = 0
+
+    def _request(self, worker, message):
+        conn = self.workers[worker][1]
+        conn.send(message)
+        return conn.recv()
+
+    def _broadcast(self, message):
+        """Envoie une commande à tous les workers puis recueille leurs réponses"""
+        sent = []
+        failed = []
+        for worker, (_, conn) in list(self.workers.items()):
+            try:
+                conn.send(message)
+                sent.append(worker)
+            except (OSError, EOFError):
+                failed.append(worker)
+        replies = {}
+        for worker in sent:
+            try:
+                replies[worker] = self.workers[worker][1].recv()
+            except (OSError, EOFError):
+                failed.append(worker)
+        return replies, failed
+
+    def _deliver(self, replies):
+        """Transmet les nœuds cédés à leurs nouveaux propriétaires, une fois toutes les réponses reçues"""
+        parts = {}
+        for reply in replies.values():
+            for owner, data in reply[1].items():
+                if data:
+                    parts.setdefault(owner, []).append(data)
+        parts = {owner: chunks for owner, chunks in parts.items() if owner in self.workers}
+        for owner, chunks in parts.items():
+            self.workers[owner][1].send(("import", b"".join(chunks)))
+        for owner in parts:
+            self.stats['handed_off'] += self.workers[owner][1].recv()[1]
+
+    def _rebalance(self, members):
+        """Nouvel anneau: chaque worker cède les nœuds qui ne lui appartiennent plus"""
+        self.flush()
+        self.ring = HashRing(members, self.vnodes)
+        replies, failed = self._broadcast(("ring", self.ring.members))
+        # Les workers qui quittent l'anneau cèdent tous leurs nœuds; un worker qui
+        # n'a pas répondu est traité comme disparu une fois les autres servis
+        replies = {w: r for w, r in replies.items() if w not in failed}
+        self._deliver(replies)
+        self.stats['rebalances'] += 1
+        for worker in failed:
+            if worker in self.workers:
+                self._lose(worker)
+
+    def _adopt(self, directory):
+        """Répartit l'état persisté d'un worker qui n'est plus dans l'anneau"""
+        adopter = self.ring.members[0]
+        reply = self._request(adopter, ("adopt", directory, self.ring.members))
+        self._deliver({adopter: reply})
+        self.stats['adopted'] += reply[2]
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def _lose(self, worker):
+        """Worker arrêté de façon inattendue: son état persisté est repris par les autres"""
+        process, conn = self.workers.pop(worker)
+        self.batches.pop(worker, None)
+        conn.close()
+        process.join(timeout=1)
+        self.stats['lost_workers'] += 1
+        print(f"Worker {worker} perdu (code {process.exitcode}), redistribution de sa partition")
+        if not self.workers:
+            raise RuntimeError("plus aucun worker dans le cluster")
+        self._rebalance(list(self.workers))
+        directory = worker_path(STATE_DIR, worker)
+        if directory and os.path.isdir(directory):
+            self._adopt(directory)
+
+    def add_worker(self):
+        """Démarre un worker et lui transmet sa part des nœuds; retourne son numéro"""
+        with self._lock:
+            worker = self.next_worker
+            self.next_worker += 1
+            members = list(self.workers) + [worker]
+            self._spawn(worker, members)
+            self._rebalance(members)
+            return worker
+
+    def remove_worker(self, worker=None):
+        """Arrête un worker (le plus récent par défaut) après qu'il a cédé tous ses nœuds"""
+        with self._lock:
+            if worker is None:
+                worker = max(self.workers)
+            if len(self.workers) <= 1:
+                raise ValueError("le cluster doit garder au moins un worker")
+            self._rebalance([w for w in self.workers if w != worker])
+            process, conn = self.workers.pop(worker)
+            self.batches.pop(worker)
+            self._request_stop(process, conn)
+            # Tous ses nœuds sont désormais écrits par leurs nouveaux propriétaires
+            directory = worker_path(STATE_DIR, worker)
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def _request_stop(process, conn):
+        try:
+            conn.send(("stop",))
+            conn.recv()
+        except (OSError, EOFError):
+            pass
+        conn.close()
+        process.join()
+
+    def _orphan_directories(self):
+        """Répertoires d'état de workers absents de l'anneau (cluster réduit, arrêt brutal)"""
+        if not STATE_DIR:
+            return []
+        root, extension = os.path.splitext(STATE_DIR)
+        orphans = []
+        for path in sorted(glob.glob(f"{glob.escape(root)}.worker_*{extension}")):
+            number = path[len(root) + len(".worker_"):len(path) - len(extension)]
+            if number.isdigit() and int(number) not in self.workers and os.path.isdir(path):
+                orphans.append(path)
+        return orphans
+
+    def drain(self, force=True):
+        """Attend que chaque worker ait traité les lots envoyés; retourne leurs statistiques
+
+        Avec force, les trames retenues par la déduplication sont aussi analysées.
+        """
+        with self._lock:
+            self.flush()
+            replies, failed = self._broadcast(("stats", force))
+            for worker in failed:
+                if worker in self.workers:
+                    self._lose(worker)
+            return [reply[1] for _, reply in sorted(replies.items())]
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, workers=sorted(self.workers), routed=dict(self.routed))
+
+    def _watch(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                with self._lock:
+                    self.flush()
+                    for worker, (process, _) in list(self.workers.items()):
+                        if not process.is_alive():
+                            self._lose(worker)
+            except Exception as e:
+                print(f"Erreur du routage cluster: {str(e)}")
+
+    def open(self):
+        """Démarre les workers et répartit l'état restauré de chacun selon l'anneau"""
+        with self._lock:
+            members = list(range(self.num_workers))
+            self.next_worker = self.num_workers
+            for worker in members:
+                self._spawn(worker, members)
+            # Le nombre de workers a pu changer depuis le dernier démarrage
+            self._rebalance(members)
+            for directory in self._orphan_directories():
+                self._adopt(directory)
+        print(f"Cluster démarré: {len(members)} workers, {self.stats['handed_off'] + self.stats['adopted']} "
+              "nœuds redistribués")
+        self._thread = threading.Thread(target=self._watch, name="cluster-router", daemon=True)
+        self._thread.start()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.start()
+
+    def close(self):
+        """Envoie les derniers lots puis arrête les workers"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self.flush()
+            for worker in list(self.workers):
+                process, conn = self.workers.pop(worker)
+                self._request_stop(process, conn)
+            self.batches.clear()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.close()
+
+    def start(self):
+        try:
+            self.open()
+            self.client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            print(f"Démarrage du routeur LoRaWAN sur {MQTT_BROKER}:{MQTT_PORT}")
+            self.client.loop_forever()
+        except KeyboardInterrupt:
+            print("Serveur arrêté par l'utilisateur")
+        except Exception as e:
+            print(f"Erreur de connexion: {str(e)}")
+        finally:
+            self.client.disconnect()
+            self.close()
             print("Serveur arrêté")
 
 # Point d'entrée principal
 if __name__ == "__main__":
-    server = LoRaWANServer()
-    server.start()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Serveur LoRaWAN avec IDS")
+    parser.add_argument("--cluster", type=int, default=CLUSTER_WORKERS, metavar="WORKERS",
+                        help="Répartit les nœuds entre WORKERS processus (0: un seul processus)")
+    args = parser.parse_args()
+    server = LoRaWANCluster(args.cluster) if args.cluster else LoRaWANServer()
+    server.start()
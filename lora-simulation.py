@@ -6,6 +6,24 @@ import paho.mqtt.client as mqtt
 import hashlib
 import hmac
 import base64
+import struct
+import argparse
+import heapq
+import math
+import os
+import zlib
+
+# Chiffrement AES-128 des payloads (pip install cryptography), envoi en clair sans
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+# NumPy n'est nécessaire que pour le mode flotte (pip install numpy)
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Configuration
 NODE_ID = "agriculture_node_001"
@@ -16,6 +34,49 @@ MQTT_PORT = 1883
 MQTT_TOPIC = "lorawan/uplink"
 MQTT_AUTH_USER = "lorauser"
 MQTT_AUTH_PASS = "lorapass"
+PAYLOAD_FORMAT = "binary"  # "binary" (trame compacte) ou "json" (format historique)
+PAYLOAD_ENCRYPTION = True  # Chiffrement AES-128 (mode compteur LoRaWAN) si cryptography est installé
+
+# Bloc compteur LoRaWAN (A_i): 0x01, 4 octets nuls, direction, DevAddr, FCnt, 0x00, i
+# et bloc B0 du MIC (0x49, ..., FCnt, 0x00, longueur). Doit correspondre à lora-server.py
+CTR_BLOCK = struct.Struct("<B4xBIIxB")
+
+def dev_addr(dev_id):
+    """Adresse 32 bits dérivée du dev_id"""
+    return zlib.crc32(dev_id.encode())
+
+def mic_block(dev_id, counter, length):
+    """Bloc B0 placé devant les données dans le calcul du MIC (adresse et compteur authentifiés)"""
+    return CTR_BLOCK.pack(0x49, 0, dev_addr(dev_id), counter & 0xFFFFFFFF, length & 0xFF)
+
+def make_cipher_context(app_key):
+    """Contexte AES ECB réutilisable (clé étendue une seule fois), None sans chiffrement"""
+    if not PAYLOAD_ENCRYPTION or Cipher is None:
+        return None
+    return Cipher(algorithms.AES(bytes.fromhex(app_key)), modes.ECB()).encryptor()
+
+def encrypt_payload(context, dev_id, counter, data):
+    """Chiffre les données d'une trame uplink: XOR avec le chiffrement AES des blocs A_1..A_n"""
+    address = dev_addr(dev_id)
+    blocks = b"".join(CTR_BLOCK.pack(1, 0, address, counter & 0xFFFFFFFF, i)
+                      for i in range(1, (len(data) + 15) // 16 + 1))
+    keystream = context.update(blocks)
+    return (int.from_bytes(data, "little") ^ int.from_bytes(keystream[:len(data)], "little")).to_bytes(len(data), "little")
+
+# Format binaire des trames capteurs (version 1):
+#   en-tête: version (u8), horodatage epoch (u32), nombre de lectures (u8)
+#   lecture: type de capteur (u8), numéro du capteur (u8), valeur en virgule fixe
+# Doit correspondre au registre de décodage de lora-server.py
+PAYLOAD_VERSION = 1
+PAYLOAD_HEADER = struct.Struct("<BIB")
+READING_HEADER = struct.Struct("<BB")
+# type de capteur -> (identifiant, format de la valeur, facteur d'échelle)
+SENSOR_CODECS = {
+    "temperature": (1, struct.Struct("<h"), 100),
+    "soil_moisture": (2, struct.Struct("<H"), 100),
+    "light_intensity": (3, struct.Struct("<I"), 100),
+    "pest_detection": (4, struct.Struct("<H"), 100),
+}
 
 # Simulation des capteurs
 class VirtualSensor:
@@ -61,6 +122,7 @@ class LoRaWANSimulator:
         self.node_id = node_id
         self.app_key = app_key
         self.frame_counter = 0
+        self.cipher = make_cipher_context(app_key)
         self.mqtt_client = mqtt.Client()
         self.mqtt_client.username_pw_set(MQTT_AUTH_USER, MQTT_AUTH_PASS)
         
@@ -80,6 +142,7 @@ class LoRaWANSimulator:
             "counter": self.frame_counter,
             "port": 1,
             "payload_raw": self._encode_sensor_data(sensor_data),
+            "encrypted": self.cipher is not None,
             "metadata": {
                 "time": datetime.now().isoformat(),
                 "frequency": 868.1,
@@ -95,18 +158,32 @@ class LoRaWANSimulator:
         }
         return payload
         
+    def _encode_binary(self, sensor_data):
+        # Trame compacte: un seul horodatage, identifiants et valeurs sur quelques octets
+        frame = bytearray(PAYLOAD_HEADER.pack(PAYLOAD_VERSION, int(time.time()), len(sensor_data)))
+        for reading in sensor_data:
+            type_id, value_format, scale = SENSOR_CODECS[reading["type"]]
+            index = int(reading["sensor_id"].rsplit("_", 1)[1])
+            frame += READING_HEADER.pack(type_id, index)
+            frame += value_format.pack(round(reading["value"] * scale))
+        return bytes(frame)
+        
     def _encode_sensor_data(self, sensor_data):
-        # Simulation du chiffrement et de l'encodage des données capteur
-        # Dans LoRaWAN réel, ceci utiliserait AES-128 avec l'app_key
-        data_str = json.dumps(sensor_data)
+        # Encodage puis chiffrement AES-128 des données capteur avec l'app_key
+        if PAYLOAD_FORMAT == "binary":
+            data = self._encode_binary(sensor_data)
+        else:
+            data = json.dumps(sensor_data).encode()
+        if self.cipher is not None:
+            data = encrypt_payload(self.cipher, self.node_id, self.frame_counter, data)
         
-        # Création d'un MIC (Message Integrity Code) simulé
+        # Création d'un MIC (Message Integrity Code) simulé, sur les données chiffrées
         key = bytes.fromhex(self.app_key)
-        h = hmac.new(key, data_str.encode(), hashlib.sha256)
+        h = hmac.new(key, mic_block(self.node_id, self.frame_counter, len(data)) + data, hashlib.sha256)
         mic = h.digest()[:4]  # 4 octets pour le MIC
         
         # Encodage en base64 (simulant le payload LoRaWAN)
-        combined = data_str.encode() + mic
+        combined = data + mic
         return base64.b64encode(combined).decode()
         
     def send_data(self, sensor_data):
@@ -123,8 +200,283 @@ class LoRaWANSimulator:
         self.frame_counter += 1
         return True
 
+# Mode flotte: des milliers à des millions de nœuds dans un seul processus. Les
+# marches aléatoires des capteurs et l'encodage des trames binaires sont calculés
+# en tableaux NumPy pour tous les nœuds qui émettent en même temps; les instants
+# d'émission sont tirés d'un tas (heapq) qui respecte le rapport cyclique de
+# chaque nœud, sans time.sleep par nœud.
+FLEET_NODE_PREFIX = "fleet_node"
+FLEET_INTERVAL = 60.0      # Période moyenne d'émission d'un nœud (s)
+FLEET_JITTER = 0.1         # Variation aléatoire de la période (fraction)
+FLEET_DUTY_CYCLE = 0.01    # Rapport cyclique maximal (1 % en bande EU868)
+FLEET_CONNECTIONS = 4      # Connexions MQTT du pool de publication
+FLEET_BATCH_SIZE = 1000    # Nombre maximal de trames préparées et publiées ensemble
+
+# Conversion des formats struct vers les types NumPy équivalents
+NUMPY_FORMATS = {"b": "i1", "B": "u1", "h": "<i2", "H": "<u2", "i": "<i4", "I": "<u4"}
+
+def lora_airtime(payload_size, spreading_factor=7, bandwidth=125000, coding_rate=1, preamble=8):
+    """Temps d'émission (s) d'une trame LoRa (formule Semtech, en-tête explicite, CRC)"""
+    symbol_time = (2 ** spreading_factor) / bandwidth
+    low_rate = 1 if symbol_time > 0.016 else 0
+    payload_symbols = 8 + max(math.ceil((8 * payload_size - 4 * spreading_factor + 28 + 16)
+                                        / (4 * (spreading_factor - 2 * low_rate))) * (coding_rate + 4), 0)
+    return (preamble + 4.25 + payload_symbols) * symbol_time
+
+class FleetSimulator:
+    def __init__(self, num_nodes, interval=FLEET_INTERVAL, jitter=FLEET_JITTER,
+                 duty_cycle=FLEET_DUTY_CYCLE, app_key=APP_KEY, seed=None):
+        if np is None:
+            raise RuntimeError("Le mode flotte nécessite NumPy (pip install numpy)")
+        self.num_nodes = num_nodes
+        self.rng = np.random.default_rng(seed)
+        self.node_ids = [f"{FLEET_NODE_PREFIX}_{i:06d}" for i in range(num_nodes)]
+        self.counters = np.zeros(num_nodes, dtype=np.int64)
+        # Un nœud = les quatre capteurs de la liste sensors; une ligne par nœud
+        self.low = np.array([s.min_val for s in sensors], dtype=np.float64)
+        self.high = np.array([s.max_val for s in sensors], dtype=np.float64)
+        self.values = self.rng.uniform(self.low, self.high, size=(num_nodes, len(sensors)))
+        self.base_rssi = self.rng.integers(-120, -70, size=num_nodes)
+        self.base_snr = self.rng.integers(-5, 12, size=num_nodes)
+
+        # Trame binaire de taille fixe: un champ NumPy par octet d'en-tête et par valeur
+        fields = [("version", "u1"), ("timestamp", "<u4"), ("count", "u1")]
+        self.scales = []
+        for n, sensor in enumerate(sensors):
+            type_id, value_format, scale = SENSOR_CODECS[sensor.sensor_type]
+            fields += [(f"type{n}", "u1"), (f"index{n}", "u1"), (f"value{n}", NUMPY_FORMATS[value_format.format[-1]])]
+            self.scales.append(scale)
+        self.frame_dtype = np.dtype(fields)
+        self.frame_template = np.zeros(1, dtype=self.frame_dtype)
+        self.frame_template["version"] = PAYLOAD_VERSION
+        self.frame_template["count"] = len(sensors)
+        for n, sensor in enumerate(sensors):
+            self.frame_template[f"type{n}"] = SENSOR_CODECS[sensor.sensor_type][0]
+            self.frame_template[f"index{n}"] = int(sensor.sensor_id.rsplit("_", 1)[1])
+        self.mic_key = bytes.fromhex(app_key)
+
+        # Chiffrement: un bloc compteur A_i par tranche de 16 octets de trame, DevAddr précalculées
+        self.cipher = make_cipher_context(app_key)
+        self.block_count = (self.frame_dtype.itemsize + 15) // 16
+        self.block_dtype = np.dtype({"names": ["flag", "address", "counter", "index"],
+                                     "formats": ["u1", "<u4", "<u4", "u1"],
+                                     "offsets": [0, 6, 10, 15], "itemsize": CTR_BLOCK.size})
+        self.addresses = np.array([dev_addr(node_id) for node_id in self.node_ids], dtype=np.uint32)
+
+        # Période propre à chaque nœud, jamais plus courte que ne l'autorise le rapport cyclique
+        airtime = lora_airtime(self.frame_dtype.itemsize + 4 + 13)  # données, MIC, en-tête LoRaWAN
+        self.min_period = airtime / duty_cycle
+        self.periods = np.maximum(interval * self.rng.uniform(1 - jitter, 1 + jitter, size=num_nodes),
+                                  self.min_period)
+        self.jitter = jitter
+        offsets = self.rng.uniform(0, self.periods)
+        self.schedule = list(zip(offsets.tolist(), range(num_nodes)))
+        heapq.heapify(self.schedule)
+
+    def next_time(self):
+        return self.schedule[0][0] if self.schedule else None
+
+    def pop_due(self, now, limit=FLEET_BATCH_SIZE):
+        """Nœuds dont l'émission est due, replanifiés à leur prochaine émission"""
+        schedule = self.schedule
+        due_times = []
+        due_nodes = []
+        while schedule and schedule[0][0] <= now and len(due_nodes) < limit:
+            t, node = heapq.heappop(schedule)
+            due_times.append(t)
+            due_nodes.append(node)
+        if not due_nodes:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        nodes = np.array(due_nodes, dtype=np.int64)
+        times = np.array(due_times)
+        jitter = self.rng.uniform(1 - self.jitter, 1 + self.jitter, size=len(nodes))
+        next_times = times + np.maximum(self.periods[nodes] * jitter, self.min_period)
+        for t, node in zip(next_times.tolist(), due_nodes):
+            heapq.heappush(schedule, (t, node))
+        return nodes, times
+
+    def step_sensors(self, nodes):
+        """Marche aléatoire de tous les capteurs des nœuds donnés (±10 % de l'étendue, bornée)"""
+        span = self.high - self.low
+        values = self.values[nodes] + self.rng.uniform(-0.1, 0.1, size=(len(nodes), len(sensors))) * span
+        np.clip(values, self.low, self.high, out=values)
+        self.values[nodes] = values
+        return values
+
+    def encrypt_frames(self, frames, nodes, counters):
+        """Chiffre toutes les trames d'un lot: un seul appel AES pour tous les blocs compteurs"""
+        size = self.frame_dtype.itemsize
+        blocks = np.zeros((len(nodes), self.block_count), dtype=self.block_dtype)
+        blocks["flag"] = 1
+        blocks["address"] = self.addresses[nodes][:, None]
+        blocks["counter"] = (counters & 0xFFFFFFFF)[:, None]
+        blocks["index"] = np.arange(1, self.block_count + 1)
+        keystream = np.frombuffer(self.cipher.update(blocks.tobytes()), dtype=np.uint8)
+        keystream = keystream.reshape(len(nodes), -1)[:, :size]
+        data = frames.view(np.uint8).reshape(len(nodes), size)
+        return (data ^ keystream).tobytes()
+
+    def encode_frames(self, nodes, epochs, counters):
+        """Trames binaires (chiffrées si possible, MIC inclus, base64) des nœuds donnés,
+        chacune horodatée de sa propre émission (epochs)"""
+        values = self.step_sensors(nodes)
+        frames = np.repeat(self.frame_template, len(nodes))
+        frames["timestamp"] = np.asarray(epochs).astype(np.uint32)
+        for n, scale in enumerate(self.scales):
+            frames[f"value{n}"] = np.round(values[:, n] * scale)
+        if self.cipher is not None:
+            raw = self.encrypt_frames(frames, nodes, counters)
+        else:
+            raw = frames.tobytes()
+        size = self.frame_dtype.itemsize
+        # Blocs B0 du MIC (adresse et compteur de chaque trame), construits en une fois
+        b0 = np.zeros(len(nodes), dtype=self.block_dtype)
+        b0["flag"] = 0x49
+        b0["address"] = self.addresses[nodes]
+        b0["counter"] = counters & 0xFFFFFFFF
+        b0["index"] = size & 0xFF
+        b0 = b0.tobytes()
+        block = CTR_BLOCK.size
+        key = self.mic_key
+        digest = hmac.digest
+        b64encode = base64.b64encode
+        encoded = []
+        for k, offset in enumerate(range(0, len(raw), size)):
+            data = raw[offset:offset + size]
+            mic = digest(key, b0[k * block:(k + 1) * block] + data, "sha256")[:4]
+            encoded.append(b64encode(data + mic).decode())
+        return encoded
+
+    def build_messages(self, nodes, epochs):
+        """Messages uplink JSON (format de create_payload) des nœuds donnés, émis aux instants epochs"""
+        counters = self.counters[nodes]
+        self.counters[nodes] += 1
+        payloads = self.encode_frames(nodes, epochs, counters)
+        encrypted = "true" if self.cipher is not None else "false"
+        rssi = (self.base_rssi[nodes] + self.rng.integers(-3, 4, size=len(nodes))).tolist()
+        snr = self.base_snr[nodes].tolist()
+        fromtimestamp = datetime.fromtimestamp
+        node_ids = self.node_ids
+        return [
+            f'{{"dev_id": "{node_ids[node]}", "counter": {counter}, "port": 1, "payload_raw": "{payload}", '
+            f'"encrypted": {encrypted}, "metadata": {{"time": "{fromtimestamp(epoch).isoformat()}", "frequency": 868.1, '
+            f'"modulation": "LORA", "data_rate": "SF7BW125", "coding_rate": "4/5", '
+            f'"gateways": [{{"gtw_id": "{GATEWAY_ID}", "rssi": {r}, "snr": {s}}}]}}}}'
+            for node, counter, payload, epoch, r, s in zip(nodes.tolist(), counters.tolist(), payloads,
+                                                          np.asarray(epochs).tolist(), rssi, snr)
+        ]
+
+# Publication par lots sur un petit pool de connexions MQTT
+class MQTTPublisherPool:
+    def __init__(self, connections=FLEET_CONNECTIONS):
+        self.clients = []
+        for i in range(connections):
+            client = mqtt.Client(client_id=f"fleet_{os.getpid()}_{i}",
+                                 callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+            client.username_pw_set(MQTT_AUTH_USER, MQTT_AUTH_PASS)
+            self.clients.append(client)
+        self.next_client = 0
+
+    def connect(self):
+        for client in self.clients:
+            client.connect(MQTT_BROKER, MQTT_PORT, 60)
+            client.loop_start()
+        print(f"Connecté au broker MQTT {MQTT_BROKER}:{MQTT_PORT} ({len(self.clients)} connexions)")
+
+    def publish(self, messages, times):
+        # Un lot entier par connexion, les connexions servies à tour de rôle
+        client = self.clients[self.next_client]
+        self.next_client = (self.next_client + 1) % len(self.clients)
+        for message in messages:
+            client.publish(MQTT_TOPIC, message)
+
+    def close(self):
+        for client in self.clients:
+            client.loop_stop()
+            client.disconnect()
+
+# Écriture des trames dans une capture JSONL (lora-batch-analysis.py) au lieu du broker
+class CaptureWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def connect(self):
+        self.file = open(self.path, "w")
+        print(f"Écriture des trames dans {self.path}")
+
+    def publish(self, messages, times):
+        self.file.write("".join(f'{message[:-1]}, "received_at": {t:.6f}}}\n'
+                                for message, t in zip(messages, times)))
+
+    def close(self):
+        self.file.close()
+
+def run_fleet(num_nodes, duration, speed=1.0, interval=FLEET_INTERVAL, duty_cycle=FLEET_DUTY_CYCLE,
+              connections=FLEET_CONNECTIONS, output=None, seed=None):
+    """Simule la flotte pendant duration secondes simulées (speed: accélération, 0 = au plus vite)"""
+    print(f"Initialisation d'une flotte de {num_nodes} nœuds...")
+    fleet = FleetSimulator(num_nodes, interval, duty_cycle=duty_cycle, seed=seed)
+    publisher = CaptureWriter(output) if output else MQTTPublisherPool(connections)
+    publisher.connect()
+    print(f"Période moyenne {interval} s, période minimale {fleet.min_period:.2f} s "
+          f"(rapport cyclique {duty_cycle:.1%}), débit attendu ~{num_nodes / interval:.0f} trames/s")
+
+    start_epoch = time.time()
+    start_wall = time.monotonic()
+    sent = 0
+    last_report = start_wall
+    try:
+        while True:
+            next_time = fleet.next_time()
+            if next_time is None or next_time > duration:
+                break
+            if speed:
+                # Une seule attente par lot, jusqu'à la prochaine émission due
+                delay = next_time / speed - (time.monotonic() - start_wall)
+                if delay > 0:
+                    time.sleep(delay)
+                now = (time.monotonic() - start_wall) * speed
+            else:
+                now = next_time
+            nodes, times = fleet.pop_due(min(now, duration))
+            if not len(nodes):
+                continue
+            # Chaque trame porte l'instant de son émission planifiée (intervalles propres à chaque nœud)
+            epochs = start_epoch + times
+            publisher.publish(fleet.build_messages(nodes, epochs), epochs.tolist())
+            sent += len(nodes)
+
+            wall = time.monotonic()
+            if wall - last_report >= 5:
+                print(f"  {sent} trames envoyées ({sent / (wall - start_wall):.0f} trames/s)")
+                last_report = wall
+    except KeyboardInterrupt:
+        print("Simulation interrompue par l'utilisateur")
+    finally:
+        publisher.close()
+    elapsed = time.monotonic() - start_wall
+    print(f"Fin de la simulation: {sent} trames en {elapsed:.1f} s ({sent / max(elapsed, 1e-9):.0f} trames/s)")
+    return sent
+
 # Programme principal
 def main():
+    parser = argparse.ArgumentParser(description="Simulation de nœuds LoRaWAN")
+    parser.add_argument("--fleet", type=int, metavar="NŒUDS", help="Simule une flotte de NŒUDS nœuds")
+    parser.add_argument("--duration", type=float, default=3600, help="Durée simulée du mode flotte (s)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Accélération du temps (0: au plus vite)")
+    parser.add_argument("--interval", type=float, default=FLEET_INTERVAL, help="Période moyenne d'émission (s)")
+    parser.add_argument("--duty-cycle", type=float, default=FLEET_DUTY_CYCLE, help="Rapport cyclique maximal")
+    parser.add_argument("--connections", type=int, default=FLEET_CONNECTIONS, help="Connexions MQTT")
+    parser.add_argument("--output", help="Écrit les trames dans une capture JSONL au lieu de les publier")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    if args.fleet:
+        run_fleet(args.fleet, args.duration, args.speed, args.interval, args.duty_cycle,
+                  args.connections, args.output, args.seed)
+        return
+
     print(f"Démarrage de la simulation du nœud LoRa {NODE_ID}")
     
     # Initialisation du simulateur LoRaWAN